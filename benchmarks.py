@@ -0,0 +1,406 @@
+"""
+Benchmarks for the lidar control plugin.
+
+Run with ``python benchmarks.py <name>``, e.g. ``python benchmarks.py parse``.
+"""
+import argparse
+import inspect
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import utils
+from sweeps import segment_sweeps
+
+HPL_HEADER = """Filename:\t{name}
+System ID:\t196
+Number of gates:\t{n_gates}
+Range gate length (m):\t30.0
+Gate length (pts):\t10
+Pulses/ray:\t10000
+No. of waypoints in file:\t1
+Scan type:\tUser file 2 - csm
+Focus range:\t65535
+Start time:\t20240601 {hour:02d}:00:00.00
+Resolution (m/s):\t0.0382
+Altitude of measurement (center of gate) = (range gate + 0.5) * Gate length
+Data line 1: Decimal time (hours)  Azimuth (degrees)  Elevation (degrees) Pitch (degrees) Roll (degrees)
+f9.6,1x,f6.2,1x,f6.2
+Data line 2: Range Gate  Doppler (m/s)  Intensity (SNR + 1)  Beta (m-1 sr-1) Spectral Width
+i3,1x,f6.4,1x,f8.6,1x,e12.6,1x,f6.4 - repeat for no. gates
+****
+"""
+
+
+def write_synthetic_hpl(file_path, n_rays, n_gates=200, n_cols=5, hour=12,
+                        elevation=60., ray_seconds=1., wind=(5., 3.)):
+    """
+    Writes a synthetic PPI .hpl file with a uniform wind field.
+
+    Parameters
+    ----------
+    file_path: str
+        The output file path.
+    n_rays: int
+        The number of rays in the file.
+    n_gates: int
+        The number of range gates per ray.
+    n_cols: int
+        The number of columns per range gate line (4 or 5).
+    hour: int
+        The start hour of the file.
+    elevation: float or float 1D array
+        The elevation angle of the scan, or of each ray.
+    ray_seconds: float
+        The time between rays. Like the lidar's, the decimal time goes back
+        to 0 at midnight.
+    wind: 2- or 3-tuple
+        The (u, v) or (u, v, w) wind components of the synthetic wind field.
+    """
+    rng = np.random.default_rng(0)
+    decimal_time = np.mod(hour + np.arange(n_rays) * ray_seconds / 3600., 24.)
+    azimuth = np.mod(np.arange(n_rays) * 60., 360.)
+    elevation = np.broadcast_to(elevation, (n_rays,))
+    el = np.radians(elevation)
+    az = np.radians(azimuth)
+    vr = (wind[0] * np.sin(az) + wind[1] * np.cos(az)) * np.cos(el)
+    if len(wind) > 2:
+        vr = vr + wind[2] * np.sin(el)
+    gates = np.arange(n_gates)
+    with open(file_path, 'w', newline='') as out:
+        out.write(HPL_HEADER.format(name=os.path.basename(file_path),
+                                    n_gates=n_gates, hour=hour).replace('\n', '\r\n'))
+        for i in range(n_rays):
+            out.write('%9.6f %6.2f %6.2f %6.2f %6.2f\r\n' % (
+                decimal_time[i], azimuth[i], elevation[i], 0.1, -0.1))
+            doppler = vr[i] + rng.normal(0, 0.1, n_gates)
+            intensity = 1.02 + rng.normal(0, 0.002, n_gates)
+            beta = 1e-6 * (1 + rng.random(n_gates))
+            block = np.column_stack([gates, doppler, intensity, beta, np.full(n_gates, 1.5)])
+            if n_cols == 5:
+                fmt = '%3d %.4f %.6f %.6e %.4f'
+            else:
+                block = block[:, :4]
+                fmt = '%3d %.4f %.6f %.6e'
+            np.savetxt(out, block, fmt=fmt, newline='\r\n')
+
+
+def _time_call(func, *args, repeats=3):
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _compare_parsers(file_path, label):
+    fast = utils.hpl2dict(file_path)
+    slow = utils.hpl2dict_loop(file_path)
+    for key in ['radial_velocity', 'intensity', 'beta', 'spectral_width',
+                'azimuth', 'elevation', 'pitch', 'roll', 'decimal_time']:
+        np.testing.assert_array_equal(fast[key], slow[key])
+    t_fast = _time_call(utils.hpl2dict, file_path)
+    t_slow = _time_call(utils.hpl2dict_loop, file_path, repeats=1)
+    print("%s: loop %.3f s, bulk %.3f s (%.1fx)" % (label, t_slow, t_fast, t_slow / t_fast))
+
+
+def bench_parse(files=None, sizes=(100, 1000, 5000), n_gates=200):
+    """
+    Compares the bulk .hpl parser against the per-gate loop, on the given
+    files or on synthetic files of increasing size.
+    """
+    if files:
+        for file_path in files:
+            _compare_parsers(file_path, os.path.basename(file_path))
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_cols in (4, 5):
+            for n_rays in sizes:
+                file_path = os.path.join(tmp_dir, 'User2_%d_%d.hpl' % (n_rays, n_cols))
+                write_synthetic_hpl(file_path, n_rays, n_gates, n_cols=n_cols)
+                _compare_parsers(file_path, "%d columns, %6d rays x %d gates" %
+                                 (n_cols, n_rays, n_gates))
+
+
+def bench_vad(files=None, n_gates=200, repeats=20):
+    """
+    Compares the batched VAD retrieval against ACT's compute_winds_from_ppi.
+
+    Runs on the given User2 .hpl files, or on synthetic 60 degree PPIs if
+    no files are given, and reports the largest difference in wind speed
+    and direction along with the run time of both retrievals.
+    """
+    import act
+    import vad
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not files:
+            files = []
+            for n_rays in (6, 60, 600):
+                file_path = os.path.join(tmp_dir, 'User2_ppi_%d.hpl' % n_rays)
+                write_synthetic_hpl(file_path, n_rays, n_gates)
+                files.append(file_path)
+        for file_path in files:
+            ds = utils.read_as_netcdf(file_path, 0., 0., 0.)
+            ds = ds.where(ds.elevation < 89., drop=True).drop_dims('sweep')
+            act_ds = ds.copy()
+            act_ds['signal_to_noise_ratio'] = act_ds['intensity'] - 1
+            reference = act.retrievals.compute_winds_from_ppi(act_ds, intensity_name='intensity')
+            winds = vad.compute_winds_from_ppi(ds)
+            speed_diff = np.nanmax(np.abs(winds['wind_speed'].values - reference['wind_speed'].values))
+            dir_diff = np.abs(winds['wind_direction'].values - reference['wind_direction'].values)
+            dir_diff = np.nanmax(np.minimum(dir_diff, 360. - dir_diff))
+            t_act = _time_call(act.retrievals.compute_winds_from_ppi, act_ds, 'elevation', 'azimuth',
+                               'radial_velocity', 'signal_to_noise_ratio', 'intensity', repeats=3)
+            t_vad = _time_call(vad.compute_winds_from_ppi, ds, repeats=repeats)
+            print("%s (%d rays): max |dspeed| %.2e m/s, max |ddir| %.2e deg, ACT %.3f s, batched %.4f s (%.1fx)" %
+                  (os.path.basename(file_path), ds.sizes['time'], speed_diff, dir_diff,
+                   t_act, t_vad, t_act / t_vad))
+
+
+def bench_sweeps(n_repeats=(1, 10, 100)):
+    """Times sweep segmentation of a mixed PPI, RHI and stare scan."""
+    import sweeps
+
+    ppi_az, ppi_el = np.arange(0., 360., 1.), np.full(360, 5.)
+    rhi_el = np.concatenate([np.arange(2., 178., 2.), np.arange(178., 2., -2.)])
+    rhi_az = np.full(rhi_el.size, 90.)
+    stare_az, stare_el = np.full(30, 90.), np.full(30, 90.)
+    for n in n_repeats:
+        azimuth = np.tile(np.concatenate([ppi_az, rhi_az, stare_az]), n)
+        elevation = np.tile(np.concatenate([ppi_el, rhi_el, stare_el]), n)
+        result = sweeps.segment_sweeps(azimuth, elevation)
+        t = _time_call(sweeps.segment_sweeps, azimuth, elevation)
+        print("%7d rays: %d sweeps in %.4f s" % (azimuth.size, result['sweep_number'].size, t))
+
+
+def read_as_netcdf_float64(file_path):
+    """
+    Builds the Dataset of an .hpl file the way read_as_netcdf did before it
+    used float32 copies: float64 moments from :func:`utils.hpl2dict_loop`
+    and a materialized PyDDA reflectivity field. Kept for bench_memory.
+    """
+    import xarray as xr
+
+    field_dict = utils.hpl2dict_loop(file_path)
+    time = utils.decimal_time_to_datetime64(field_dict['decimal_time'], field_dict['start_time'])
+    ds = xr.Dataset(coords={'range': field_dict['center_of_gates'], 'time': time,
+                            'azimuth': ('time', field_dict['azimuth']),
+                            'elevation': ('time', field_dict['elevation'])},
+                    data_vars={name: (('time', 'range'), field_dict[name].T)
+                               for name in ['radial_velocity', 'beta', 'intensity',
+                                            'spectral_width']})
+    ds['reflectivity'] = -99 * xr.ones_like(ds['beta'])
+    sweeps = segment_sweeps(np.mod(ds['azimuth'].values, 360.), ds['elevation'].values)
+    transitions = sweeps['ray_sweep'] < 0
+    if np.any(transitions):
+        for name in ['radial_velocity', 'beta', 'intensity', 'spectral_width']:
+            ds[name].values[transitions] = np.nan
+    return ds
+
+
+_RSS_SCRIPT = """
+import resource, sys, warnings
+warnings.simplefilter('ignore')
+import benchmarks, utils
+read = {'float32': utils.read_as_netcdf,
+        'float64': lambda f, *loc: benchmarks.read_as_netcdf_float64(f)}[sys.argv[2]]
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+ds = read(sys.argv[1], 0., 0., 0.)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(before, peak, ds.nbytes)
+"""
+
+
+def _peak_rss(file_path, construction):
+    # The peak RSS of a process never goes back down, so every construction
+    # is measured in a fresh process
+    out = subprocess.run([sys.executable, '-c', _RSS_SCRIPT, file_path, construction],
+                         check=True, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    before, peak, nbytes = [float(x) for x in out.stdout.split()[-3:]]
+    return (peak - before) / 1024., nbytes / 1e6
+
+
+def bench_memory(files=None, n_rays=3600, n_gates=1000):
+    """
+    Compares the peak RSS of read_as_netcdf with that of the float64
+    construction it replaced (see :func:`read_as_netcdf_float64`).
+
+    Uses an hour of synthetic 1 Hz PPI data at three elevations with 1000
+    gates (about 150 MB of text) if no files are given, so that the file
+    rather than the interpreter dominates the peak.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not files:
+            file_path = os.path.join(tmp_dir, 'User2_hour.hpl')
+            elevation = np.repeat(np.tile([45., 60., 75.], n_rays // 90 + 1), 30)[:n_rays]
+            write_synthetic_hpl(file_path, n_rays, n_gates, elevation=elevation)
+            files = [file_path]
+        for file_path in files:
+            old_peak, old_bytes = _peak_rss(file_path, 'float64')
+            new_peak, new_bytes = _peak_rss(file_path, 'float32')
+            print("%s (%.1f MB):" % (os.path.basename(file_path),
+                                     os.path.getsize(file_path) / 1e6))
+            print("  float64: peak RSS +%.1f MB, dataset %.1f MB" % (old_peak, old_bytes))
+            print("  float32: peak RSS +%.1f MB, dataset %.1f MB" % (new_peak, new_bytes))
+            print("  peak RSS %.2fx, dataset %.2fx smaller" %
+                  (old_peak / new_peak, old_bytes / new_bytes))
+
+
+def bench_sidecar(files=None, n_rays=3600, n_gates=400, repeats=5):
+    """
+    Compares building a Dataset from the .hpl text against building it from
+    a memory-mapped sidecar, for the whole file and for the last 100 rays.
+    """
+    import hpl_sidecar
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not files:
+            files = [os.path.join(tmp_dir, 'User2_hour.hpl')]
+            write_synthetic_hpl(files[0], n_rays, n_gates)
+        store = hpl_sidecar.SidecarStore(tmp_dir)
+        for file_path in files:
+            t_write = _time_call(hpl_sidecar.write_sidecar, file_path,
+                                 hpl_sidecar.sidecar_path(file_path, tmp_dir), repeats=1)
+            for last_n_rays in (None, 100):
+                t_text = _time_call(lambda: utils.read_as_netcdf(file_path, 0., 0., 0.,
+                                                                 last_n_rays=last_n_rays),
+                                    repeats=1)
+                t_side = _time_call(lambda: utils.read_as_netcdf(file_path, 0., 0., 0.,
+                                                                 last_n_rays=last_n_rays,
+                                                                 cache=store),
+                                    repeats=repeats)
+                print("%s, %s rays: text %.3f s, sidecar %.4f s (%.1fx), writing sidecar %.3f s" %
+                      (os.path.basename(file_path), last_n_rays or 'all', t_text, t_side,
+                       t_text / t_side, t_write))
+
+
+def bench_decision(n_days=30, n_rule_sets=100):
+    """
+    Replays a month of one-minute wind observations through a grid of
+    candidate trigger rule sets.
+    """
+    import decision
+
+    rng = np.random.default_rng(0)
+    n_obs = n_days * 24 * 60
+    speed = np.abs(rng.normal(6., 3., n_obs))
+    direction = np.mod(rng.normal(220., 60., n_obs), 360.)
+    thresholds = np.linspace(2., 12., n_rule_sets)
+    rule_sets = [decision.make_rules(threshold=t, upwind_min=300., upwind_max=60.)
+                 for t in thresholds]
+    trigger = decision.evaluate_rule_sets(speed, direction, rule_sets)
+    t = _time_call(decision.evaluate_rule_sets, speed, direction, rule_sets)
+    print("%d observations x %d rule sets in %.3f s (%.1f M decisions/s)" %
+          (n_obs, n_rule_sets, t, n_obs * n_rule_sets / t / 1e6))
+    for i in range(0, n_rule_sets, n_rule_sets // 5):
+        print("  threshold %5.2f: triggered %.1f%% of the time" %
+              (thresholds[i], 100. * trigger[i].mean()))
+
+
+def bench_time(files=None, n_rays=100000, n_gates=10):
+    """
+    Compares the vectorized decimal time conversion of read_as_netcdf with
+    the per-ray convert_to_hours_minutes_seconds, on a 23 UTC stare file
+    that runs past midnight.
+    """
+    import pandas as pd
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not files:
+            files = [os.path.join(tmp_dir, 'Stare_%d.hpl' % n_rays)]
+            write_synthetic_hpl(files[0], n_rays, n_gates, hour=23, elevation=90.,
+                                ray_seconds=0.5)
+        for file_path in files:
+            fields = utils.hpl2dict(file_path)
+            decimal_time, start_time = fields['decimal_time'], fields['start_time']
+
+            def per_ray():
+                initial_time = pd.to_datetime(start_time)
+                return pd.to_datetime([utils.convert_to_hours_minutes_seconds(x, initial_time)
+                                       for x in decimal_time])
+            old = per_ray()
+            new = utils.decimal_time_to_datetime64(decimal_time, start_time)
+            hours = utils.unwrap_hours(decimal_time, utils._start_hour(start_time))
+            same_day = hours < 24.
+            np.testing.assert_array_equal(new[same_day], old.values[same_day])
+            t_old = _time_call(per_ray, repeats=1)
+            t_new = _time_call(utils.decimal_time_to_datetime64, decimal_time, start_time)
+            print("%s: %d rays, per ray %.3f s, vectorized %.4f s (%.0fx)" %
+                  (os.path.basename(file_path), decimal_time.size, t_old, t_new, t_old / t_new))
+            print("  %d rays after midnight; per ray times monotonic: %s, vectorized: %s" %
+                  (np.sum(~same_day), bool(np.all(np.diff(old.values) >= np.timedelta64(0))),
+                   bool(np.all(np.diff(new) >= np.timedelta64(0)))))
+            t_read = _time_call(utils.read_as_netcdf, file_path, 0., 0., 0.)
+            print("  read_as_netcdf %.3f s" % t_read)
+
+
+_STARTUP_SCRIPT = """
+import sys, time, warnings
+warnings.simplefilter('ignore')
+start = time.perf_counter()
+import send_scan_to_lidar_csm as controller
+imported = time.perf_counter()
+for name in sys.argv[1:]:
+    module, attr = name.split('.')
+    getattr(getattr(controller, module), attr)
+print(imported - start, time.perf_counter() - imported)
+"""
+
+# The lazily imported names each trigger mode uses in a cycle
+STARTUP_MODES = {
+    'vad': ['utils.read_as_netcdf', 'vad.compute_winds_from_ppi', 'xr.concat',
+            'waggle_plugin.Plugin'],
+    'vad_act': ['utils.read_as_netcdf', 'act.retrievals', 'xr.concat', 'waggle_plugin.Plugin'],
+    'sonic': ['doe_dap_dl.DAP', 'xr.open_dataset', 'waggle_plugin.Plugin'],
+    'node': ['sage_data_client.query', 'waggle_plugin.Plugin'],
+}
+
+
+def bench_startup(repeats=3):
+    """
+    Measures the time to import the controller and load the dependencies of
+    each trigger mode in a fresh process.
+    """
+    modes = dict(STARTUP_MODES)
+    modes['all'] = sorted(set(sum(STARTUP_MODES.values(), [])))
+    for mode, names in modes.items():
+        times = []
+        for i in range(repeats):
+            out = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT] + names,
+                                 capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+            if out.returncode != 0:
+                print("%-8s failed: %s" % (mode, out.stderr.strip().splitlines()[-1]))
+                break
+            times.append([float(x) for x in out.stdout.split()[-2:]])
+        else:
+            import_time, load_time = np.min(times, axis=0)
+            print("%-8s import %.3f s + first use %.3f s = %.3f s" %
+                  (mode, import_time, load_time, import_time + load_time))
+
+
+BENCHMARKS = {'parse': bench_parse, 'vad': bench_vad, 'sweeps': bench_sweeps,
+              'memory': bench_memory, 'sidecar': bench_sidecar,
+              'decision': bench_decision, 'startup': bench_startup, 'time': bench_time}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+            help='Benchmark to run')
+    parser.add_argument('files', nargs='*',
+            help='Recorded .hpl files to use instead of synthetic ones, where supported')
+    args = parser.parse_args()
+    benchmark = BENCHMARKS[args.benchmark]
+    if args.files:
+        if 'files' not in inspect.signature(benchmark).parameters:
+            parser.error("the %s benchmark only uses synthetic data" % args.benchmark)
+        benchmark(files=args.files)
+    else:
+        benchmark()
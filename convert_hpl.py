@@ -0,0 +1,191 @@
+"""
+Batch conversion of Halo Photonics .hpl archives to CF netCDF, Zarr or
+memory-mapped sidecars.
+
+Run with ``python convert_hpl.py <input_dir> <output_dir>``. Every .hpl file
+under input_dir is converted with :func:`utils.read_as_netcdf` in a pool of
+worker processes and written to the same relative path under output_dir.
+Outputs newer than their .hpl file are skipped.
+"""
+import argparse
+import concurrent.futures
+import importlib.util
+import os
+import shutil
+import sys
+import time
+import traceback
+
+import hpl_sidecar
+import utils
+
+EXTENSIONS = {'netcdf': '.nc', 'zarr': '.zarr', 'sidecar': hpl_sidecar.EXTENSION}
+
+
+def find_hpl_files(input_dir):
+    """Returns the sorted paths of all .hpl files under input_dir."""
+    hpl_files = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        hpl_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.hpl'))
+    return hpl_files
+
+
+def output_path(hpl_path, input_dir, output_dir, fmt='netcdf'):
+    """Returns the output path mirroring hpl_path's place under input_dir."""
+    relative = os.path.relpath(hpl_path, input_dir)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + EXTENSIONS[fmt])
+
+
+def is_up_to_date(hpl_path, out_path):
+    """Returns True if out_path exists and is newer than hpl_path."""
+    return (os.path.exists(out_path) and
+            os.path.getmtime(out_path) >= os.path.getmtime(hpl_path))
+
+
+def convert_file(hpl_path, out_path, lat, lon, alt, fmt='netcdf', complevel=4,
+                 chunk_rays=1000):
+    """
+    Converts one .hpl file.
+
+    The output is written under a temporary name and moved into place, so an
+    interrupted conversion never leaves a partial file that looks up to date.
+
+    Parameters
+    ----------
+    hpl_path: str
+        The .hpl file.
+    out_path: str
+        The netCDF file, Zarr store or sidecar to write.
+    lat, lon, alt: float
+        The location of the lidar.
+    fmt: str
+        'netcdf', 'zarr' or 'sidecar'.
+    complevel: int
+        The zlib compression level of netCDF output.
+    chunk_rays: int
+        The number of rays in each (time, range) chunk.
+
+    Returns
+    -------
+    n_rays: int
+        The number of rays converted.
+    """
+    if fmt == 'sidecar':
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        return hpl_sidecar.write_sidecar(hpl_path, out_path)
+    ds = utils.read_as_netcdf(hpl_path, lat, lon, alt)
+    n_rays = ds.sizes['time']
+    chunks = (max(min(chunk_rays, n_rays), 1), ds.sizes['range'])
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.dims != ('time', 'range'):
+            continue
+        if fmt == 'zarr':
+            encoding[name] = {'chunks': chunks}
+        else:
+            encoding[name] = {'zlib': True, 'complevel': complevel, 'chunksizes': chunks}
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = out_path + '.tmp'
+    if fmt == 'zarr':
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        ds.to_zarr(tmp_path, mode='w', encoding=encoding)
+        shutil.rmtree(out_path, ignore_errors=True)
+    else:
+        ds.to_netcdf(tmp_path, format='NETCDF4', encoding=encoding)
+    os.replace(tmp_path, out_path)
+    return n_rays
+
+
+def convert_directory(input_dir, output_dir, lat, lon, alt, fmt='netcdf',
+                      workers=None, complevel=4, chunk_rays=1000, force=False):
+    """
+    Converts every .hpl file under input_dir in parallel.
+
+    Parameters
+    ----------
+    input_dir, output_dir: str
+        The directory tree to search and the directory to write to.
+    lat, lon, alt: float
+        The location of the lidar.
+    fmt: str
+        'netcdf', 'zarr' or 'sidecar'.
+    workers: int or None
+        The number of worker processes. None uses all cores.
+    complevel: int
+        The zlib compression level of netCDF output.
+    chunk_rays: int
+        The number of rays in each (time, range) chunk.
+    force: bool
+        Set to True to convert files whose output is already up to date.
+
+    Returns
+    -------
+    failed: list
+        The .hpl files that could not be converted.
+    """
+    jobs = []
+    n_skipped = 0
+    for hpl_path in find_hpl_files(input_dir):
+        out_path = output_path(hpl_path, input_dir, output_dir, fmt)
+        if not force and is_up_to_date(hpl_path, out_path):
+            n_skipped += 1
+        else:
+            jobs.append((hpl_path, out_path))
+    print("Converting %d files, %d already up to date" % (len(jobs), n_skipped))
+
+    start = time.perf_counter()
+    total_rays = 0
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_file, hpl_path, out_path, lat, lon, alt, fmt,
+                               complevel, chunk_rays): hpl_path
+                   for hpl_path, out_path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            hpl_path = futures[future]
+            try:
+                n_rays = future.result()
+            except Exception:
+                print("Could not convert %s" % hpl_path)
+                traceback.print_exc()
+                failed.append(hpl_path)
+                continue
+            total_rays += n_rays
+            print("Converted %s (%d rays)" % (hpl_path, n_rays))
+    elapsed = time.perf_counter() - start
+    print("Converted %d files, %d rays in %.1f s (%.0f rays/s), %d failed" %
+          (len(jobs) - len(failed), total_rays, elapsed,
+           total_rays / elapsed if elapsed > 0 else 0., len(failed)))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Convert a directory tree of .hpl files to CF netCDF, Zarr or sidecars.")
+    parser.add_argument('input_dir', help='Directory to search for .hpl files')
+    parser.add_argument('output_dir', help='Directory to write the converted files to')
+    parser.add_argument('--format', default='netcdf', choices=sorted(EXTENSIONS.keys()),
+            help='Output format')
+    parser.add_argument('--workers', default=None, type=int,
+            help='Number of worker processes (default: all cores)')
+    parser.add_argument('--complevel', default=4, type=int,
+            help='zlib compression level for netCDF output')
+    parser.add_argument('--chunk_rays', default=1000, type=int,
+            help='Number of rays per (time, range) chunk')
+    parser.add_argument('--lat', default=41.28079475342454, type=float,
+            help='Latitude of the lidar')
+    parser.add_argument('--lon', default=-70.16484695039435, type=float,
+            help='Longitude of the lidar')
+    parser.add_argument('--alt', default=0., type=float,
+            help='Altitude of the lidar [m]')
+    parser.add_argument('--force', action='store_true',
+            help='Convert files even if their output is up to date')
+    args = parser.parse_args()
+    if args.format == 'zarr' and importlib.util.find_spec('zarr') is None:
+        parser.error("--format zarr needs the zarr package")
+    failed = convert_directory(args.input_dir, args.output_dir, args.lat, args.lon, args.alt,
+                               fmt=args.format, workers=args.workers,
+                               complevel=args.complevel, chunk_rays=args.chunk_rays,
+                               force=args.force)
+    sys.exit(1 if failed else 0)
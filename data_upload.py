@@ -0,0 +1,221 @@
+"""
+Resumable upload of the lidar's User data files to Beehive.
+
+Every completed hourly User file is sent once, whenever the controller first
+gets to it, instead of only during the first 15 minutes of the next hour.
+The names and sizes of the files sent are kept in a state file, so files are
+not sent twice across restarts and a file that grew after it was sent, e.g.
+because its last download was cut short, is sent again. Files that fail are
+retried on later cycles.
+
+The .hpl text compresses several times over, so files are gzipped before
+they are handed to the Plugin, and several files are compressed and uploaded
+at once through the cycle's Plugin.
+"""
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import time
+import traceback
+
+from perf import count, stage
+
+HPL_TIME = re.compile(r'(\d{8})_(\d{2})')
+
+
+def file_hour(name):
+    """Returns the start hour of a file named ..._YYYYMMDD_HH..., or None."""
+    match = HPL_TIME.search(os.path.basename(name))
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1) + match.group(2), '%Y%m%d%H')
+
+
+class UploadQueue(object):
+    """
+    Uploads the completed User files in a directory that were not sent yet.
+
+    Parameters
+    ----------
+    state_file: str or None
+        JSON file recording the files sent and the failed attempts, so that
+        the record survives restarts. Set to None to only keep the record in
+        memory.
+    staging_dir: str
+        The directory the compressed files are written to before upload.
+    workers: int
+        The number of files compressed and uploaded at the same time.
+    compress: bool
+        Set to False to upload the files as they are.
+    max_age: float
+        Files that started more than this long ago are not uploaded [hours].
+    keep_local: bool
+        Set to False to remove the local copies of sent files once the
+        controller no longer downloads them. By default they are kept, e.g.
+        for conversion and replay.
+    pattern: str
+        The glob pattern of the files to upload.
+    """
+    def __init__(self, state_file=None, staging_dir='upload_staging', workers=4, compress=True,
+                 max_age=24., keep_local=True, pattern='*User*.hpl'):
+        self.state_file = state_file
+        self.staging_dir = staging_dir
+        self.workers = workers
+        self.compress = compress
+        self.max_age = max_age
+        self.keep_local = keep_local
+        self.pattern = pattern
+        self.sent = {}
+        self.failed = {}
+        if state_file is not None and os.path.exists(state_file):
+            try:
+                with open(state_file, 'r') as f:
+                    state = json.load(f)
+                self.sent = state.get('sent', {})
+                self.failed = state.get('failed', {})
+            except ValueError:
+                print("Ignoring unreadable upload state in %s" % state_file)
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump({'sent': self.sent, 'failed': self.failed}, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def is_sent(self, path):
+        """Returns True if the file was sent at its current size."""
+        entry = self.sent.get(os.path.basename(path))
+        return entry is not None and entry['size'] == os.path.getsize(path)
+
+    def pending(self, local_dir='.', cur_time=None):
+        """
+        Returns the completed files in local_dir that are still to be sent,
+        oldest first.
+
+        A file is completed once the hour it started in is over.
+        """
+        if cur_time is None:
+            cur_time = datetime.datetime.now()
+        this_hour = cur_time.replace(minute=0, second=0, microsecond=0)
+        oldest = cur_time - datetime.timedelta(hours=self.max_age)
+        files = []
+        for path in glob.glob(os.path.join(local_dir, self.pattern)):
+            hour = file_hour(path)
+            if hour is None or hour >= this_hour or hour < oldest:
+                continue
+            if not self.is_sent(path):
+                files.append((hour, path))
+        return [path for hour, path in sorted(files)]
+
+    def _send(self, plugin, path):
+        # Compresses and uploads one file, returning the size of the file
+        # and the bytes uploaded
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        if not self.compress:
+            plugin.upload_file(path, keep=True)
+            return size, size
+        os.makedirs(self.staging_dir, exist_ok=True)
+        staged = os.path.join(self.staging_dir, name + '.gz')
+        try:
+            with open(path, 'rb') as in_file, gzip.open(staged, 'wb', compresslevel=6) as out_file:
+                shutil.copyfileobj(in_file, out_file, 1 << 20)
+            n_bytes = os.path.getsize(staged)
+            plugin.upload_file(staged)
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+        return size, n_bytes
+
+    def run(self, plugin, local_dir='.', cur_time=None, meta=None):
+        """
+        Uploads the pending files and publishes the upload statistics.
+
+        The backlog left after the upload is published as lidar.upload_backlog,
+        along with the number of files sent (lidar.upload_files) and the
+        upload throughput (lidar.upload_bytes_per_second).
+
+        Parameters
+        ----------
+        plugin: waggle.plugin.Plugin
+            The open Plugin used to upload and publish.
+        local_dir: str
+            The directory holding the files.
+        cur_time: datetime or None
+            The current time. Defaults to now.
+        meta: dict or None
+            Metadata attached to the published values, e.g. the lidar's name.
+
+        Returns
+        -------
+        sent: list of str
+            The files that were sent.
+        """
+        if cur_time is None:
+            cur_time = datetime.datetime.now()
+        files = self.pending(local_dir, cur_time)
+        sent = []
+        n_bytes = 0
+        start = time.perf_counter()
+        if files:
+            print("Uploading %d User files..." % len(files))
+        with stage('data_upload'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._send, plugin, path): path for path in files}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                name = os.path.basename(path)
+                try:
+                    size, uploaded = future.result()
+                except Exception:
+                    self.failed[name] = self.failed.get(name, 0) + 1
+                    print("Failed to upload %s (attempt %d), retrying next cycle:" %
+                          (name, self.failed[name]))
+                    traceback.print_exc()
+                    continue
+                print("Uploaded %s" % name)
+                n_bytes += uploaded
+                self.sent[name] = {'size': size,
+                                   'time': datetime.datetime.now().isoformat()}
+                self.failed.pop(name, None)
+                sent.append(path)
+        elapsed = time.perf_counter() - start
+        count('data_bytes_uploaded', n_bytes)
+        self._forget(cur_time)
+        self._save()
+        if not self.keep_local:
+            self._prune(local_dir, cur_time)
+
+        meta = {} if meta is None else meta
+        plugin.publish("lidar.upload_backlog", len(files) - len(sent), meta=meta,
+                       timestamp=time.time_ns())
+        plugin.publish("lidar.upload_files", len(sent), meta=meta, timestamp=time.time_ns())
+        if sent:
+            plugin.publish("lidar.upload_bytes_per_second", n_bytes / elapsed, meta=meta,
+                           timestamp=time.time_ns())
+        return sent
+
+    def _forget(self, cur_time):
+        # Files past max_age are never considered again
+        oldest = cur_time - datetime.timedelta(hours=self.max_age + 1)
+        for record in (self.sent, self.failed):
+            for name in list(record):
+                hour = file_hour(name)
+                if hour is not None and hour < oldest:
+                    del record[name]
+
+    def _prune(self, local_dir, cur_time):
+        # The controller downloads the files of this and the previous hour
+        # on every cycle, so only older sent files are removed
+        previous_hour = (cur_time.replace(minute=0, second=0, microsecond=0) -
+                         datetime.timedelta(hours=1))
+        for path in glob.glob(os.path.join(local_dir, self.pattern)):
+            hour = file_hour(path)
+            if hour is not None and hour < previous_hour and self.is_sent(path):
+                os.remove(path)
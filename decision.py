@@ -0,0 +1,296 @@
+"""
+Trigger decisions for the lidar scan strategy.
+
+The decision only depends on a wind observation (a speed or TKE and a
+direction, from the VAD, a sonic anemometer or a node) and a rule set:
+
+* the direction is flipped by 180 degrees when it falls in the upwind
+  window, so that the lidar points into the wind,
+* the scan is triggered when the speed exceeds the threshold and the
+  direction is inside the (dir_min, dir_max) window,
+* a triggered scan is an HSRHI, an RHI, stacked PPIs or a stepped RHI
+  along the wind; otherwise the default VAD or stare is sent.
+
+Rule sets are plain dictionaries, so they can be stored as JSON, and the
+threshold tests are vectorized over both observations and rule sets to
+replay archived observations through many candidate rule sets at once.
+"""
+import json
+
+import numpy as np
+
+from scan_strategy import compile_scan
+
+DEFAULT_RULES = {
+    'threshold': 2.,
+    'dir_min': 90.,
+    'dir_max': 270.,
+    'upwind_min': None,
+    'upwind_max': None,
+    'trigger_scan': 'stepped_rhi',
+    'default_scan': 'vad',
+    'az_offset': 0.,
+    'min_angle': 5.,
+    'max_angle': 5.,
+    'step': 5.,
+    'cone_width': 60.,
+    'speed': 2.,
+    'repeat': 2,
+    'direction_step': 1.,
+}
+TRIGGER_SCANS = ['hsrhi', 'rhi', 'ppis', 'stepped_rhi']
+DEFAULT_SCANS = ['vad', 'stare']
+
+
+def rules_from_args(args):
+    """
+    Builds a rule set from the command line arguments of the controller.
+
+    When triggering from the lidar's own VAD the triggered scan is always
+    the stepped RHI; the scan options choose the scan for sonic and node
+    triggers.
+    """
+    trigger_scan = 'stepped_rhi'
+    vad_mode = (args.trigger_node_hub_height == "" and args.trigger_sonic == "" and
+                args.trigger_node_llj_height == "")
+    if not vad_mode and args.trigger_hsrhi:
+        trigger_scan = 'hsrhi'
+    elif not vad_mode and args.trigger_rhi:
+        trigger_scan = 'rhi'
+    elif not vad_mode and args.trigger_ppis:
+        trigger_scan = 'ppis'
+    return make_rules(threshold=args.wmag, dir_min=args.dir_min, dir_max=args.dir_max,
+                      upwind_min=args.upwind_min, upwind_max=args.upwind_max,
+                      trigger_scan=trigger_scan,
+                      default_scan='stare' if args.default_stare else 'vad',
+                      az_offset=args.az_offset, min_angle=args.min_angle,
+                      max_angle=args.max_angle, step=args.step,
+                      cone_width=float(args.cone_width), speed=args.speed,
+                      repeat=args.repeat, direction_step=args.direction_step)
+
+
+def make_rules(**rules):
+    """
+    Returns a complete rule set, filling in unset rules from DEFAULT_RULES.
+
+    Raises ValueError for unknown rules or scan names.
+    """
+    unknown = set(rules) - set(DEFAULT_RULES)
+    if unknown:
+        raise ValueError("Unknown rules: %s" % ', '.join(sorted(unknown)))
+    full = dict(DEFAULT_RULES)
+    full.update(rules)
+    if full['trigger_scan'] not in TRIGGER_SCANS:
+        raise ValueError("trigger_scan must be one of %s" % ', '.join(TRIGGER_SCANS))
+    if full['default_scan'] not in DEFAULT_SCANS:
+        raise ValueError("default_scan must be one of %s" % ', '.join(DEFAULT_SCANS))
+    return full
+
+
+def load_rules(file_path):
+    """Loads a rule set, or a list of rule sets, from a JSON file."""
+    with open(file_path, 'r') as rules_file:
+        rules = json.load(rules_file)
+    if isinstance(rules, list):
+        return [make_rules(**r) for r in rules]
+    return make_rules(**rules)
+
+
+def flip_upwind(direction, upwind_min=None, upwind_max=None):
+    """
+    Turns directions inside the (upwind_min, upwind_max) window around by
+    180 degrees. The window wraps through north if upwind_min > upwind_max.
+
+    Works on scalars and on arrays, with the window bounds broadcast against
+    the directions. NaN bounds disable the window.
+    """
+    direction = np.asarray(direction, dtype=float)
+    if upwind_min is None or upwind_max is None:
+        return direction
+    upwind_min = np.asarray(upwind_min, dtype=float)
+    upwind_max = np.asarray(upwind_max, dtype=float)
+    with np.errstate(invalid='ignore'):
+        inside = np.where(upwind_min > upwind_max,
+                          (direction > upwind_min) | (direction < upwind_max),
+                          (direction > upwind_min) & (direction < upwind_max))
+    flipped = np.where(inside, direction + 180., direction)
+    return np.where(flipped >= 360., flipped - 360., flipped)
+
+
+def should_trigger(speed, direction, threshold, dir_min, dir_max,
+                   upwind_min=None, upwind_max=None):
+    """
+    Applies the trigger test.
+
+    Every argument may be a scalar or an array; they are broadcast together,
+    so e.g. [rule sets, 1] thresholds against [observations] speeds give a
+    [rule sets, observations] result.
+
+    Returns
+    -------
+    trigger: bool array
+        True where the scan should be triggered.
+    direction: float array
+        The direction after the upwind flip.
+    """
+    direction = flip_upwind(direction, upwind_min, upwind_max)
+    with np.errstate(invalid='ignore'):
+        trigger = ((np.abs(speed) > threshold) &
+                   (direction > dir_min) & (direction < dir_max))
+    return trigger, direction
+
+
+def evaluate_rule_sets(speed, direction, rule_sets):
+    """
+    Evaluates many rule sets against many observations at once.
+
+    Parameters
+    ----------
+    speed, direction: float 1D array
+        The [observations] wind speeds (or TKE) and directions.
+    rule_sets: list of dict
+        The rule sets to evaluate.
+
+    Returns
+    -------
+    trigger: bool 2D array
+        The [rule sets, observations] trigger decisions.
+    """
+    def column(name):
+        # Unset upwind bounds become NaN, which never matches a direction
+        return np.array([np.nan if r[name] is None else r[name] for r in rule_sets],
+                        dtype=float)[:, np.newaxis]
+
+    trigger, _ = should_trigger(
+        np.asarray(speed, dtype=float), np.asarray(direction, dtype=float),
+        column('threshold'), column('dir_min'), column('dir_max'),
+        column('upwind_min'), column('upwind_max'))
+    return trigger
+
+
+def _wrap_azimuths(azimuths):
+    return np.mod(np.asarray(azimuths, dtype=float), 360.)
+
+
+def quantize_direction(direction, step=1.):
+    """Rounds a direction to a multiple of step [degrees]; a step of 0 keeps it."""
+    if not step:
+        return float(direction)
+    return float(np.mod(np.round(direction / step) * step, 360.))
+
+
+def _cone_azimuths(center, width):
+    # The start of a sector is wrapped into [0, 360) and its end kept at
+    # start + width, so a sector through north is not swept the long way.
+    # Its end can then lie past 360 (by less than width), which
+    # compile_scan encodes as a position past one rotation of the
+    # continuously rotating azimuth motor; wrapping it back below 360 would
+    # sweep the 360 - width degrees outside the sector instead.
+    start = float(_wrap_azimuths(center - width / 2.))
+    return np.array([start, start + width])
+
+
+class ScanPlan(object):
+    """
+    A scan chosen by :func:`plan_scan`.
+
+    Attributes
+    ----------
+    trigger: bool
+        True if the triggered scan was chosen over the default scan.
+    name: str
+        The name of the scan, e.g. 'hsrhi' or 'vad'.
+    speed, direction: float
+        The observation the plan was made from, after the upwind flip.
+    elevations, azimuths: float 1D array
+        The waypoints of the scan.
+    azi_speed, el_speed: float
+        The rotation speeds [degrees per second].
+    wait: int
+        The wait after each waypoint [ms].
+    repeat: int
+        The number of times to repeat the scan.
+    """
+    def __init__(self, trigger, name, speed, direction, elevations, azimuths,
+                 azi_speed, el_speed, wait, repeat):
+        self.trigger = trigger
+        self.name = name
+        self.speed = speed
+        self.direction = direction
+        self.elevations = np.asarray(elevations, dtype=float)
+        self.azimuths = np.asarray(azimuths, dtype=float)
+        self.azi_speed = azi_speed
+        self.el_speed = el_speed
+        self.wait = wait
+        self.repeat = repeat
+
+    def compile(self, dyn_csm=False):
+        """Compiles the plan into the bytes of a CSM file."""
+        return compile_scan(self.elevations, self.azimuths, azi_speed=self.azi_speed,
+                            el_speed=self.el_speed, wait=self.wait, repeat=self.repeat,
+                            dyn_csm=dyn_csm)
+
+
+def default_plan(speed, direction, rules):
+    """Returns the default scan of a rule set as a ScanPlan."""
+    repeat = rules['repeat']
+    if rules['default_scan'] == 'stare':
+        return ScanPlan(False, 'stare', speed, direction, [90.], [0., 1.],
+                        60., 1., 1000, repeat)
+    azimuths = _wrap_azimuths(np.array([0., 60., 120., 180., 270., 360.]) + rules['az_offset'])
+    return ScanPlan(False, 'vad', speed, direction, [60.], azimuths, 60., 1., 1000, repeat)
+
+
+def trigger_plan(speed, direction, rules):
+    """
+    Returns the triggered scan of a rule set as a ScanPlan, pointed along
+    direction, without applying the trigger test.
+
+    The scan is pointed along the direction rounded to the rule set's
+    direction_step, so that small changes of the wind direction give the
+    same CSM file and do not restart the scan.
+    """
+    scan = rules['trigger_scan']
+    offset = rules['az_offset']
+    repeat = rules['repeat']
+    pointing = quantize_direction(direction, rules['direction_step'])
+    along_wind = _wrap_azimuths([pointing + offset])
+    if scan == 'hsrhi':
+        return ScanPlan(True, scan, speed, direction, [0., 180.], along_wind,
+                        3., rules['speed'], 0, repeat)
+    if scan == 'rhi':
+        return ScanPlan(True, scan, speed, direction, [rules['min_angle'], rules['max_angle']],
+                        along_wind, 3., rules['speed'], 0, repeat)
+    if scan == 'ppis':
+        azimuths = _cone_azimuths(pointing + offset, rules['cone_width'])
+        elevations = np.arange(rules['min_angle'], rules['max_angle'], rules['step'])
+        return ScanPlan(True, scan, speed, direction, elevations, azimuths,
+                        rules['speed'], 3., 0, repeat)
+    return ScanPlan(True, scan, speed, direction, np.arange(0, 180., 2.), along_wind,
+                    2., 1., 0, repeat)
+
+
+def plan_scan(speed, direction, rules):
+    """
+    Chooses the scan for one wind observation.
+
+    Parameters
+    ----------
+    speed: float
+        The wind speed or TKE compared with the threshold.
+    direction: float
+        The wind direction [degrees].
+    rules: dict
+        The rule set, see :func:`make_rules`.
+
+    Returns
+    -------
+    plan: ScanPlan
+        The scan to send.
+    """
+    trigger, direction = should_trigger(speed, direction, rules['threshold'],
+                                        rules['dir_min'], rules['dir_max'],
+                                        rules['upwind_min'], rules['upwind_max'])
+    if bool(trigger):
+        return trigger_plan(speed, float(direction), rules)
+    return default_plan(speed, float(direction), rules)
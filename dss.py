@@ -0,0 +1,382 @@
+"""
+Daily scan schedules (DSS) for Halo Photonics lidars.
+
+A DSS file has one line per scheduled scan start,
+``HHMMSS<tab>scan<tab>repeat<tab>kind<tab>focus``, and the lidar runs each
+scan until the next line's start time, every day.
+
+Schedules are built from rules, plain dictionaries like the trigger rules
+of decision.py, so they can be stored as JSON::
+
+    {"scan": "profile", "start": "00:00:00", "end": "00:10:00",
+     "period": "01:00:00", "step": 5, "priority": 0}
+
+starts the profile scan every 5 s during the first 10 minutes of every
+hour. A rule can be limited to first_date through last_date and to some
+weekdays (0 is Monday). Where rule windows overlap, the rule with the higher
+priority owns the time, ties going to the earlier rule, and a rule whose
+window resumes after being overridden is restarted right away.
+
+Every second of every requested day is resolved at once with numpy, so a
+month of schedules takes a fraction of a second per site. Schedules can
+be written in bulk and compared with the file on each lidar, so that only
+changed schedules are uploaded.
+
+Run ``python dss.py rules.json --start 2024-06-01 --days 30 --out_dir dss``
+to write schedules, or add ``--fleet fleet.json`` to upload the first day's
+schedule of each site to the fleet lidar of the same name (see fleet.py).
+"""
+import argparse
+import datetime
+import difflib
+import io
+import json
+import os
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+DEFAULT_DSS_RULE = {
+    'scan': None,
+    'start': 0,
+    'end': SECONDS_PER_DAY,
+    'period': SECONDS_PER_DAY,
+    'step': 5,
+    'priority': 0,
+    'repeat': 1,
+    'kind': 'S',
+    'focus': 0,
+    'first_date': None,
+    'last_date': None,
+    'weekdays': None,
+}
+REMOTE_PATH = "/C:/Lidar/System/Scan parameters/scan.dss"
+
+
+def to_seconds(value):
+    """
+    Converts a time of day, 'HH:MM[:SS]' or a number of seconds, to seconds.
+    """
+    if isinstance(value, str):
+        fields = [int(field) for field in value.split(':')]
+        if not 2 <= len(fields) <= 3:
+            raise ValueError("Times must be HH:MM[:SS], not %s" % value)
+        fields = fields + [0] * (3 - len(fields))
+        return fields[0] * 3600 + fields[1] * 60 + fields[2]
+    return int(value)
+
+
+def make_dss_rule(**rule):
+    """
+    Returns a complete DSS rule, filling in unset fields from
+    DEFAULT_DSS_RULE and converting the times to seconds.
+
+    Raises ValueError for unknown fields, a missing scan or bad times.
+    """
+    unknown = set(rule) - set(DEFAULT_DSS_RULE)
+    if unknown:
+        raise ValueError("Unknown DSS rule fields: %s" % ', '.join(sorted(unknown)))
+    full = dict(DEFAULT_DSS_RULE)
+    full.update(rule)
+    if not full['scan']:
+        raise ValueError("DSS rules need a scan.")
+    for key in ['start', 'end', 'period', 'step']:
+        full[key] = to_seconds(full[key])
+    if full['period'] <= 0 or full['step'] <= 0:
+        raise ValueError("The period and step of %s must be positive." % full['scan'])
+    if not 0 <= full['start'] <= full['period'] or not 0 <= full['end'] <= full['period']:
+        raise ValueError("The window of %s must lie within its period." % full['scan'])
+    return full
+
+
+def load_dss_rules(file_path):
+    """
+    Loads DSS rules from a JSON file holding either a list of rules or a
+    dict mapping site names to lists of rules.
+    """
+    with open(file_path, 'r') as rules_file:
+        rules = json.load(rules_file)
+    if isinstance(rules, dict):
+        return {site: [make_dss_rule(**r) for r in site_rules]
+                for site, site_rules in rules.items()}
+    return [make_dss_rule(**r) for r in rules]
+
+
+class Schedule(object):
+    """
+    The scan starts of one day.
+
+    Attributes
+    ----------
+    seconds: int array
+        The start of each entry [seconds after midnight].
+    scans, kinds: str arrays
+        The scan and scan kind of each entry.
+    repeats, focus: int arrays
+        The repeat count and focus of each entry.
+    """
+    def __init__(self, seconds, scans, repeats, kinds, focus):
+        self.seconds = np.asarray(seconds, dtype=int)
+        self.scans = np.asarray(scans, dtype=str)
+        self.repeats = np.asarray(repeats, dtype=int)
+        self.kinds = np.asarray(kinds, dtype=str)
+        self.focus = np.asarray(focus, dtype=int)
+
+    def __len__(self):
+        return self.seconds.size
+
+    def __eq__(self, other):
+        return isinstance(other, Schedule) and self.lines() == other.lines()
+
+    def lines(self):
+        """Returns the lines of the DSS file, without line endings."""
+        hms = np.stack([self.seconds // 3600, self.seconds // 60 % 60, self.seconds % 60], axis=1)
+        return ["%02d%02d%02d\t%s\t%d\t%s\t%d" % (h, m, s, scan, repeat, kind, focus)
+                for (h, m, s), scan, repeat, kind, focus in
+                zip(hms, self.scans, self.repeats, self.kinds, self.focus)]
+
+    def to_text(self):
+        """Returns the contents of the DSS file."""
+        return "".join(line + "\r\n" for line in self.lines()).encode('ascii')
+
+
+def parse_dss(text):
+    """Reads a :class:`Schedule` from the contents of a DSS file."""
+    if isinstance(text, bytes):
+        text = text.decode('ascii')
+    fields = [line.split('\t') for line in text.splitlines() if line.strip()]
+    if not fields:
+        return Schedule([], [], [], [], [])
+    stamps, scans, repeats, kinds, focus = zip(*fields)
+    seconds = [int(s[:2]) * 3600 + int(s[2:4]) * 60 + int(s[4:6]) for s in stamps]
+    return Schedule(seconds, scans, repeats, kinds, focus)
+
+
+def _day_mask(rule, dates):
+    # Which of the dates (datetime64[D]) the rule applies to
+    mask = np.ones(dates.shape, dtype=bool)
+    if rule['first_date'] is not None:
+        mask &= dates >= np.datetime64(rule['first_date'], 'D')
+    if rule['last_date'] is not None:
+        mask &= dates <= np.datetime64(rule['last_date'], 'D')
+    if rule['weekdays'] is not None:
+        # 1970-01-01 was a Thursday
+        weekday = (dates.astype('int64') + 3) % 7
+        mask &= np.isin(weekday, rule['weekdays'])
+    return mask
+
+
+def build_schedules(rules, dates):
+    """
+    Builds the schedules of several days from one set of rules.
+
+    Parameters
+    ----------
+    rules: list of dict
+        The DSS rules, see :func:`make_dss_rule`.
+    dates: sequence of str, date or datetime64
+        The days to schedule.
+
+    Returns
+    -------
+    schedules: dict
+        Maps each date, as a 'YYYY-MM-DD' string, to its :class:`Schedule`.
+    """
+    rules = [make_dss_rule(**r) for r in rules]
+    dates = np.unique(np.asarray(dates, dtype='datetime64[D]'))
+    seconds = np.arange(SECONDS_PER_DAY)
+    owner = np.full((dates.size, SECONDS_PER_DAY), -1, dtype=np.int32)
+    best = np.full((dates.size, SECONDS_PER_DAY), -np.inf)
+    # The last row stands for the unowned seconds, owner -1
+    on_step = np.zeros((len(rules) + 1, SECONDS_PER_DAY), dtype=bool)
+    for i, rule in enumerate(rules):
+        phase = seconds % rule['period']
+        if rule['start'] <= rule['end']:
+            window = (phase >= rule['start']) & (phase < rule['end'])
+        else:
+            window = (phase >= rule['start']) | (phase < rule['end'])
+        on_step[i] = (phase - rule['start']) % rule['period'] % rule['step'] == 0
+        active = _day_mask(rule, dates)[:, None] & window[None, :]
+        wins = active & (rule['priority'] > best)
+        owner[wins] = i
+        best[wins] = rule['priority']
+
+    # A rule starts its scan on its steps, and whenever it takes over
+    changed = np.ones(owner.shape, dtype=bool)
+    changed[:, 1:] = owner[:, 1:] != owner[:, :-1]
+    starts = (owner >= 0) & (on_step[owner, seconds[None, :]] | changed)
+
+    fields = {key: np.array([r[key] for r in rules]) for key in ['scan', 'repeat', 'kind', 'focus']}
+    schedules = {}
+    for day, date in enumerate(dates):
+        entry_seconds = np.flatnonzero(starts[day])
+        entry_rules = owner[day, entry_seconds]
+        schedules[str(date)] = Schedule(entry_seconds, fields['scan'][entry_rules],
+                                        fields['repeat'][entry_rules],
+                                        fields['kind'][entry_rules],
+                                        fields['focus'][entry_rules])
+    return schedules
+
+
+def build_schedule(rules, date):
+    """Builds the :class:`Schedule` of one day, see :func:`build_schedules`."""
+    return build_schedules(rules, [date])[str(np.datetime64(date, 'D'))]
+
+
+def build_site_schedules(site_rules, dates):
+    """
+    Builds the schedules of several sites.
+
+    Parameters
+    ----------
+    site_rules: dict
+        Maps each site name to its list of DSS rules.
+    dates: sequence of str, date or datetime64
+        The days to schedule.
+
+    Returns
+    -------
+    schedules: dict
+        Maps each site to the dict of its schedules by date.
+    """
+    return {site: build_schedules(rules, dates) for site, rules in site_rules.items()}
+
+
+def write_schedules(schedules, out_dir='.', name_format='{site}_{date}.dss'):
+    """
+    Writes the schedules of several sites, skipping files that are unchanged.
+
+    Parameters
+    ----------
+    schedules: dict
+        Maps each site to the dict of its schedules by date, as returned by
+        :func:`build_site_schedules`.
+    out_dir: str
+        The output directory. It is created if it does not exist.
+    name_format: str
+        The file name, formatted with the site and the date (YYYYMMDD).
+
+    Returns
+    -------
+    written: list of str
+        The files that were written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for site, by_date in schedules.items():
+        for date, schedule in by_date.items():
+            path = os.path.join(out_dir, name_format.format(site=site, date=date.replace('-', '')))
+            text = schedule.to_text()
+            if os.path.exists(path):
+                with open(path, 'rb') as dss_file:
+                    if dss_file.read() == text:
+                        continue
+            with open(path, 'wb') as dss_file:
+                dss_file.write(text)
+            written.append(path)
+    return written
+
+
+def diff_schedules(new, old, name='scan.dss'):
+    """
+    Compares two schedules.
+
+    Parameters
+    ----------
+    new, old: Schedule, bytes or str
+        The schedules or the contents of their DSS files. Line endings and
+        trailing whitespace are ignored.
+    name: str
+        The file name shown in the diff.
+
+    Returns
+    -------
+    diff: list of str
+        The unified diff from old to new, empty if they are the same.
+    """
+    new, old = [s.lines() if isinstance(s, Schedule) else parse_dss(s).lines()
+                for s in (new, old)]
+    return list(difflib.unified_diff(old, new, 'lidar/' + name, 'new/' + name, lineterm=''))
+
+
+def read_remote_schedule(connection, remote_path=REMOTE_PATH):
+    """Returns the DSS file on the lidar, or b'' if there is none."""
+    def read(sftp):
+        buffer = io.BytesIO()
+        try:
+            sftp.getfo(remote_path, buffer)
+        except FileNotFoundError:
+            return b''
+        return buffer.getvalue()
+    return connection.call(read)
+
+
+def upload_changed(schedules, connections, remote_path=REMOTE_PATH):
+    """
+    Uploads each site's schedule if it differs from the one on its lidar.
+
+    Parameters
+    ----------
+    schedules: dict
+        Maps each site to its :class:`Schedule`.
+    connections: dict
+        Maps each site to its LidarConnection.
+    remote_path: str
+        The path of the DSS file on the lidars.
+
+    Returns
+    -------
+    diffs: dict
+        Maps each site whose schedule was uploaded to the diff from the
+        schedule that was on its lidar.
+    """
+    diffs = {}
+    for site, schedule in schedules.items():
+        connection = connections[site]
+        diff = diff_schedules(schedule, read_remote_schedule(connection, remote_path),
+                              os.path.basename(remote_path))
+        if not diff:
+            print("%s: the schedule is unchanged, not uploading." % site)
+            continue
+        text = schedule.to_text()
+        connection.call(lambda sftp: sftp.putfo(io.BytesIO(text), remote_path))
+        print("%s: uploaded %s (%d lines changed)" %
+              (site, remote_path, sum(line[:1] in '+-' for line in diff[2:])))
+        diffs[site] = diff
+    return diffs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Build daily scan schedules from rules.",
+            epilog="With --fleet, other arguments are those of send_scan_to_lidar_csm.py.")
+    parser.add_argument('rules',
+            help='JSON file with a list of DSS rules, or a dict of lists by site')
+    parser.add_argument('--start', default=datetime.date.today().isoformat(),
+            help='First day to schedule (YYYY-MM-DD). Defaults to today.')
+    parser.add_argument('--days', default=1, type=int, help='Number of days to schedule')
+    parser.add_argument('--out_dir', default='.', help='Directory to write the schedules to')
+    parser.add_argument('--fleet', default='',
+            help='Fleet JSON file (see fleet.py). Uploads the first day of each site to '
+                 'the lidar of the same name if it changed.')
+    parser.add_argument('--remote_path', default=REMOTE_PATH,
+            help='Path of the DSS file on the lidars')
+    dss_args, rest = parser.parse_known_args()
+
+    site_rules = load_dss_rules(dss_args.rules)
+    if isinstance(site_rules, list):
+        site_rules = {'scan': site_rules}
+    dates = np.datetime64(dss_args.start, 'D') + np.arange(dss_args.days)
+    schedules = build_site_schedules(site_rules, dates)
+    for path in write_schedules(schedules, dss_args.out_dir):
+        print("Wrote %s" % path)
+    if dss_args.fleet != "":
+        import send_scan_to_lidar_csm as controller
+        from fleet import load_fleet
+        fleet = load_fleet(dss_args.fleet, controller.parse_args(rest))
+        try:
+            upload_changed({site: by_date[str(dates[0])] for site, by_date in schedules.items()},
+                           {lidar.name: lidar.connection for lidar in fleet.lidars},
+                           dss_args.remote_path)
+        finally:
+            fleet.close()
@@ -0,0 +1,347 @@
+"""
+Drives several lidars from one process.
+
+The fleet is described by a JSON file::
+
+    {"trigger_lidar": "nant",
+     "workers": 4,
+     "lidars": [{"name": "nant", "host": "10.31.81.87", "az_offset": 0.,
+                 "lat": 41.2808, "lon": -70.1648, "alt": 0.},
+                {"name": "mvco", "host": "10.31.81.88", "az_offset": 12.5,
+                 "lat": 41.3253, "lon": -70.5667, "alt": 0., "dyn_csm": true}]}
+
+Every lidar needs a name and a host. username, password and port default to
+the --lidar_uname, --lidar_pwd and --lidar_port arguments, az_offset to
+--az_offset, the location to Nantucket and dyn_csm to --dyn_csm. When
+triggering from the VAD, only the PPIs of trigger_lidar (by default the first
+lidar) are retrieved.
+
+Each cycle downloads the latest files from every lidar concurrently, fetches
+the sonic or node trigger once, makes one wind observation, and sends every
+lidar the scan planned for its own azimuth offset in parallel, so that a
+retarget reaches the whole fleet within one cycle.
+
+Run ``python fleet.py fleet.json --daemon --trigger_hsrhi``; arguments other
+than the fleet's own are those of send_scan_to_lidar_csm.py.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import time
+import traceback
+
+import send_scan_to_lidar_csm as controller
+from decision import plan_scan
+from lazy_imports import preload
+from lidar_connection import LidarConnection
+from perf import CycleProfiler, stage
+from scan_strategy import StrategyUploader
+from sources import SourceFetcher
+from wind_history import WindHistory
+
+DEFAULT_LOCATION = (41.28079475342454, -70.16484695039435, 0.)
+
+
+class FleetLidar(object):
+    """
+    One lidar of the fleet.
+
+    Parameters
+    ----------
+    name: str
+        The name of the lidar, used in the published metadata.
+    host: str
+        The IP address of the lidar.
+    username, password: str
+        The login to the lidar.
+    port: int
+        The SSH port of the lidar.
+    az_offset: float
+        The azimuth of the lidar's zero relative to north [degrees].
+    location: 3-tuple
+        The (lat, lon, alt) of the lidar.
+    dyn_csm: bool
+        True if the lidar is in Dynamic CSM mode.
+    work_dir: str or None
+        The directory the lidar's files are downloaded to. Defaults to
+        the name of the lidar.
+    data_uploads: data_upload.UploadQueue or None
+        The lidar's User files to upload to Beehive when triggering from a
+        node.
+    """
+    def __init__(self, name, host, username='end user', password='', port=22, az_offset=0.,
+                 location=DEFAULT_LOCATION, dyn_csm=False, work_dir=None, data_uploads=None):
+        self.name = name
+        self.host = host
+        self.az_offset = az_offset
+        self.location = tuple(location)
+        self.dyn_csm = dyn_csm
+        self.work_dir = name if work_dir is None else work_dir
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.connection = LidarConnection(host, username, password, port=port)
+        self.uploader = StrategyUploader(os.path.join(self.work_dir, 'last_upload.json'))
+        self.data_uploads = data_uploads
+
+    def close(self):
+        self.connection.close()
+
+
+class Fleet(object):
+    """
+    The lidars driven by one process.
+
+    Parameters
+    ----------
+    lidars: list of FleetLidar
+        The lidars.
+    trigger_lidar: str or None
+        The name of the lidar whose VAD triggers the fleet. Defaults to the
+        first lidar.
+    workers: int or None
+        The number of lidars sent their scans at the same time. Defaults to
+        all of them.
+    """
+    def __init__(self, lidars, trigger_lidar=None, workers=None):
+        if not lidars:
+            raise ValueError("The fleet needs at least one lidar.")
+        names = [lidar.name for lidar in lidars]
+        if len(set(names)) != len(names):
+            raise ValueError("Lidar names must be unique: %s" % ', '.join(names))
+        if trigger_lidar is None:
+            trigger_lidar = names[0]
+        if trigger_lidar not in names:
+            raise ValueError("trigger_lidar %s is not in the fleet." % trigger_lidar)
+        self.lidars = lidars
+        self.trigger_lidar = trigger_lidar
+        self.workers = len(lidars) if workers is None else workers
+
+    def close(self):
+        for lidar in self.lidars:
+            lidar.close()
+
+
+def load_fleet(path, args):
+    """
+    Reads a fleet from a JSON file, see the module docstring.
+
+    Parameters
+    ----------
+    path: str
+        The JSON file.
+    args: argparse.Namespace
+        The controller's arguments, giving the defaults of each lidar.
+
+    Returns
+    -------
+    fleet: Fleet
+        The fleet, with a connection to each lidar.
+    """
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+    # Only the node trigger uploads the User files
+    node_mode = args.trigger_node_hub_height != "" or args.trigger_node_llj_height != ""
+    lidars = []
+    try:
+        for entry in config['lidars']:
+            work_dir = entry.get('work_dir', entry['name'])
+            data_uploads = controller.data_upload_queue(args, work_dir) if node_mode else None
+            lidars.append(FleetLidar(
+                entry['name'], entry['host'],
+                username=entry.get('username', args.lidar_uname),
+                password=entry.get('password', args.lidar_pwd),
+                port=entry.get('port', args.lidar_port),
+                az_offset=float(entry.get('az_offset', args.az_offset)),
+                location=(entry.get('lat', DEFAULT_LOCATION[0]),
+                          entry.get('lon', DEFAULT_LOCATION[1]),
+                          entry.get('alt', DEFAULT_LOCATION[2])),
+                dyn_csm=entry.get('dyn_csm', args.dyn_csm),
+                work_dir=work_dir, data_uploads=data_uploads))
+        return Fleet(lidars, config.get('trigger_lidar'), config.get('workers'))
+    except Exception:
+        for lidar in lidars:
+            lidar.close()
+        raise
+
+
+def _send_all(fleet, pool, send):
+    # Runs send(lidar) for every lidar in the pool, reporting the failures
+    futures = {pool.submit(send, lidar): lidar for lidar in fleet.lidars}
+    results = {}
+    for future in concurrent.futures.as_completed(futures):
+        lidar = futures[future]
+        try:
+            results[lidar.name] = future.result()
+        except Exception:
+            print("Failed to send to %s:" % lidar.name)
+            traceback.print_exc()
+            results[lidar.name] = None
+    return results
+
+
+def _upload_data(fleet, plugin, cur_time):
+    # Each queue already uploads its files in parallel
+    for lidar in fleet.lidars:
+        if lidar.data_uploads is not None:
+            lidar.data_uploads.run(plugin, lidar.work_dir, cur_time, meta={'lidar': lidar.name})
+
+
+def run_fleet_cycle(args, plugin, fleet, pool=None, cache=None, sources=None, history=None,
+                    cur_time=None, node_cache=None, profiler=None):
+    """
+    Runs one decision cycle for the whole fleet.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The controller's arguments.
+    plugin: waggle.plugin.Plugin
+        The open Plugin used to publish results.
+    fleet: Fleet
+        The lidars.
+    pool: concurrent.futures.Executor or None
+        Sends the scans. Defaults to a pool of fleet.workers threads.
+    cache: HplCache, SidecarStore or None
+        The cache of parsed .hpl files of the trigger lidar.
+    sources: SourceFetcher or None
+        Fetches the data sources and holds their last good values.
+    history: WindHistory or None
+        The recent wind profiles of the trigger lidar.
+    cur_time: datetime or None
+        The time of the cycle. Defaults to now.
+    node_cache: node_winds.NodeQueryCache or None
+        Holds the node records between cycles so only newer ones are queried.
+    profiler: perf.CycleProfiler or None
+        Profiles the source fetching threads of a profiled cycle.
+
+    Returns
+    -------
+    plans: dict or None
+        Maps each lidar's name to the plan sent to it, or None if it failed
+        or there was no wind observation.
+    """
+    if pool is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=fleet.workers) as pool:
+            return run_fleet_cycle(args, plugin, fleet, pool, cache=cache, sources=sources,
+                                   history=history, cur_time=cur_time, node_cache=node_cache,
+                                   profiler=profiler)
+    rules = controller.controller_rules(args)
+    if cur_time is None:
+        cur_time = datetime.datetime.now()
+    vad_mode = args.trigger_node_hub_height == "" and args.trigger_sonic == "" and args.trigger_node_llj_height == ""
+    if not vad_mode and args.trigger_sonic == "":
+        node_vsn, dir_key, spd_key = controller._node_keys(args)
+        node_vsns = [vsn.strip() for vsn in node_vsn.split(',')]
+    if sources is None:
+        sources = SourceFetcher()
+
+    def fetch(lidar):
+        trigger = vad_mode and lidar.name == fleet.trigger_lidar
+        return lambda: controller.fetch_lidar(
+            args, lidar.connection, cur_time, cache=cache if trigger else None,
+            local_dir=lidar.work_dir, location=lidar.location, load_vad=trigger)
+    fetchers = {'lidar.' + lidar.name: fetch(lidar) for lidar in fleet.lidars}
+    preload(controller.utils, controller.xr)
+    if args.trigger_sonic != "":
+        fetchers['sonic'] = lambda: controller.fetch_sonic(args, cur_time)
+        preload(controller.doe_dap_dl)
+    elif not vad_mode:
+        fetchers['node'] = lambda: controller.fetch_node(args, node_vsns, [spd_key, dir_key],
+                                                         cur_time, cache=node_cache)
+        preload(controller.node_winds, controller.sage_data_client)
+    if profiler is not None:
+        fetchers = {name: profiler.wrap(func) for name, func in fetchers.items()}
+    timeouts = {'lidar.' + lidar.name: args.lidar_timeout for lidar in fleet.lidars}
+    timeouts.update({'sonic': args.sonic_timeout, 'node': args.node_timeout})
+    results = sources.fetch(fetchers, timeouts)
+
+    if vad_mode:
+        ds = results['lidar.' + fleet.trigger_lidar]
+        wind = None if ds is None else controller.vad_wind(args, ds, history, cur_time)
+    elif args.trigger_sonic != "":
+        wind = results['sonic']
+    else:
+        wind = controller.node_wind(args, results['node'], spd_key, dir_key, cur_time)
+    node_mode = not vad_mode and args.trigger_sonic == ""
+    if wind is None:
+        print("No wind observation, not triggering")
+        if node_mode:
+            with open('change_false.txt', 'rb') as f:
+                change_false = f.read()
+
+            def stop(lidar):
+                if lidar.dyn_csm:
+                    lidar.uploader.upload(lidar.connection, change_false,
+                                          controller._remote_path('change.txt', True))
+            _send_all(fleet, pool, stop)
+        for lidar in fleet.lidars:
+            plugin.publish("lidar.strategy", 0, meta={'lidar': lidar.name},
+                           timestamp=time.time_ns())
+        if node_mode:
+            _upload_data(fleet, plugin, cur_time)
+        return None
+    wind_speed, wind_direction = float(wind[0]), float(wind[1])
+    print("Wind speed: %f direction: %f" % (wind_speed, wind_direction))
+
+    def send(lidar):
+        with stage('decision'):
+            plan = plan_scan(wind_speed, wind_direction, dict(rules, az_offset=lidar.az_offset))
+        return controller.send_plan(plan, plugin, lidar.connection, 'user.txt',
+                                    dyn_csm=lidar.dyn_csm, uploader=lidar.uploader,
+                                    meta={'lidar': lidar.name})
+    plans = _send_all(fleet, pool, send)
+
+    if vad_mode and args.trigger_tke is not False:
+        plugin.publish("lidar.max_tke", wind_speed, timestamp=time.time_ns())
+    else:
+        plugin.publish("lidar.max_wind_speed", wind_speed, timestamp=time.time_ns())
+    plugin.publish("lidar.max_wind_dir" if vad_mode else "lidar.max_wind_direction",
+                   wind_direction, timestamp=time.time_ns())
+    if vad_mode and history is not None and args.history_file != "":
+        history.save(args.history_file)
+    if node_mode:
+        _upload_data(fleet, plugin, cur_time)
+    return plans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Drive several lidars from one process.",
+            epilog="Other arguments are those of send_scan_to_lidar_csm.py.")
+    parser.add_argument('config', help='JSON file describing the fleet')
+    fleet_args, rest = parser.parse_known_args(argv)
+    args = controller.parse_args(rest)
+    if args.rules == "" and not args.trigger_rhi and not args.trigger_ppis and not args.trigger_hsrhi:
+        raise ValueError("User must specify scan to trigger in options (--trigger_(hsrhi/rhi/ppi).")
+    cache = None
+    if args.sidecar:
+        cache = controller.hpl_sidecar.SidecarStore(args.cache_dir if args.cache_dir != "" else None)
+    elif args.cache_dir != "":
+        cache = controller.hpl_cache.HplCache(args.cache_dir, max_bytes=args.cache_size_mb * 1e6)
+    node_cache = None
+    if args.trigger_node_hub_height != "" or args.trigger_node_llj_height != "":
+        node_cache = controller.node_winds.NodeQueryCache(controller.sage_data_client,
+                                                          window=args.node_window)
+    history = WindHistory()
+    if args.history_file != "":
+        history = WindHistory.load(args.history_file)
+    profiler = None
+    if args.profile_dir != "":
+        profiler = CycleProfiler(args.profile_dir, threshold=args.profile_threshold)
+    fleet = load_fleet(fleet_args.config, args)
+    try:
+        with controller.waggle_plugin.Plugin() as plugin, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=fleet.workers) as pool:
+            kwargs = dict(cycle=run_fleet_cycle, pool=pool, cache=cache, sources=SourceFetcher(),
+                          history=history, node_cache=node_cache)
+            if args.daemon:
+                controller.run_daemon(args, plugin, fleet, profiler=profiler, **kwargs)
+            else:
+                controller.timed_cycle(args, plugin, fleet, profiler=profiler, **kwargs)
+    finally:
+        fleet.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+On-node cache of parsed .hpl files.
+
+Parsed rays are stored as one raw float64 file per variable together with a
+small JSON index entry keyed by the file name, size and modification time.
+When a file has grown since it was cached only the appended rays are parsed,
+and they are appended to the variable files. The index records how many rays
+the variable files hold, and it is replaced only after they are written, so
+rays left over from an interrupted update are ignored and cut off by the
+next one. A file that was rewritten rather than grown, i.e. its size shrank
+or its modification time changed at the same size, is parsed again in full.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from utils import iter_hpl_chunks, read_hpl_header
+
+RAY_FIELDS = ['decimal_time', 'azimuth', 'elevation', 'pitch', 'roll']
+GATE_FIELDS = ['radial_velocity', 'intensity', 'beta', 'spectral_width']
+
+
+class HplCache(object):
+    """
+    Least recently used cache of parsed .hpl files.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The directory holding the cache. It is created if it does not exist.
+    max_bytes: int
+        The maximum size of the cache. The least recently used files are
+        evicted once the cache grows past this size.
+    chunk_size: int
+        The number of rays parsed at a time.
+    """
+    def __init__(self, cache_dir, max_bytes=200e6, chunk_size=500):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, file_path):
+        return os.path.join(self.cache_dir, os.path.basename(file_path))
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, entry_dir, meta):
+        tmp_name = os.path.join(entry_dir, 'meta.json.tmp')
+        with open(tmp_name, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_name, os.path.join(entry_dir, 'meta.json'))
+
+    def _field_path(self, entry_dir, name):
+        return os.path.join(entry_dir, name + '.f8')
+
+    def _read_fields(self, entry_dir, rays_n, gates_n):
+        fields = {}
+        for name in RAY_FIELDS:
+            fields[name] = np.fromfile(self._field_path(entry_dir, name), dtype='<f8',
+                                       count=rays_n)
+        for name in GATE_FIELDS:
+            fields[name] = np.fromfile(self._field_path(entry_dir, name), dtype='<f8',
+                                       count=rays_n * gates_n).reshape(rays_n, gates_n)
+        return fields
+
+    def _append_fields(self, entry_dir, rays_n, gates_n, chunks):
+        # Cuts off the rays of an interrupted update, then appends the new rays
+        for name in RAY_FIELDS + GATE_FIELDS:
+            per_ray = 1 if name in RAY_FIELDS else gates_n
+            with open(self._field_path(entry_dir, name), 'ab') as field_file:
+                field_file.truncate(rays_n * per_ray * 8)
+                for chunk in chunks:
+                    field_file.write(np.ascontiguousarray(chunk[name], dtype='<f8').tobytes())
+
+    def load(self, file_path):
+        """
+        Loads a parsed .hpl file, parsing only what is not already cached.
+
+        Parameters
+        ----------
+        file_path: str
+            Path to the .hpl file.
+
+        Returns
+        -------
+        data_temp: dict
+            The file contents in the same layout as :func:`utils.hpl2dict`.
+        """
+        stat = os.stat(file_path)
+        entry_dir = self._entry_dir(file_path)
+        meta = self._read_meta(entry_dir)
+        with open(file_path, 'rb') as hpl_file:
+            header = read_hpl_header(hpl_file)
+        gates_n = header['number_of_gates']
+        if meta is not None and ('rays' not in meta or
+                                 meta['start_time'] != str(header['start_time']) or
+                                 meta['number_of_gates'] != gates_n or
+                                 meta['size'] > stat.st_size or
+                                 (meta['size'] == stat.st_size and
+                                  meta['mtime_ns'] != stat.st_mtime_ns)):
+            # The file was replaced or rewritten, so nothing in the cache is reusable
+            meta = None
+        if meta is None:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.makedirs(entry_dir)
+            meta = {'start_time': str(header['start_time']),
+                    'number_of_gates': gates_n,
+                    'offset': None, 'rays': 0, 'size': -1, 'mtime_ns': None}
+
+        if meta['size'] != stat.st_size:
+            chunks = list(iter_hpl_chunks(file_path, chunk_size=self.chunk_size,
+                                          offset=meta['offset']))
+            new_rays = sum(chunk['decimal_time'].size for chunk in chunks)
+            self._append_fields(entry_dir, meta['rays'], gates_n, chunks)
+            if chunks:
+                meta['offset'] = chunks[-1]['offset']
+            meta['rays'] += new_rays
+            print("Parsed %d new rays from %s" % (new_rays, file_path))
+        meta['size'] = stat.st_size
+        meta['mtime_ns'] = stat.st_mtime_ns
+        meta['last_access'] = time.time()
+        self._write_meta(entry_dir, meta)
+        self.evict(keep=entry_dir)
+
+        fields = self._read_fields(entry_dir, meta['rays'], gates_n)
+        data_temp = dict(header)
+        for name in RAY_FIELDS:
+            data_temp[name] = fields[name]
+        for name in GATE_FIELDS:
+            data_temp[name] = fields[name].T
+        data_temp['no_of_rays_in_file'] = meta['rays']
+        return data_temp
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+
+        Parameters
+        ----------
+        keep: str or None
+            An entry directory that is never evicted.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            meta = self._read_meta(entry_dir)
+            last_access = 0. if meta is None else meta['last_access']
+            entries.append((last_access, size, entry_dir))
+            total += size
+        for last_access, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
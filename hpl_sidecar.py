@@ -0,0 +1,217 @@
+"""
+Memory-mapped binary sidecar files for parsed .hpl moments.
+
+A sidecar holds the rays of one .hpl file in a fixed binary layout:
+
+* a fixed header (magic, number of rays and gates, the length of the .hpl
+  header text and the size and modification time of the source file),
+* the original .hpl header text,
+* one float64 [rays] block each for decimal_time, azimuth, elevation,
+  pitch and roll,
+* one contiguous float32 [rays, gates] block each for radial_velocity,
+  intensity, beta and spectral_width,
+
+with every block starting on a 64 byte boundary. Sidecars are opened with
+np.memmap, so selecting rays or gates reads only the pages that are used and
+:func:`utils.read_as_netcdf` builds its Dataset on the mapped blocks without
+copying them.
+"""
+import os
+import struct
+
+import numpy as np
+
+from utils import HEADER_N, _parse_hpl_header, iter_hpl_chunks
+
+MAGIC = b'HPLBIN01'
+EXTENSION = '.hplbin'
+FIXED_HEADER = struct.Struct('<8sQQQQq')
+ALIGN = 64
+RAY_FIELDS = ['decimal_time', 'azimuth', 'elevation', 'pitch', 'roll']
+GATE_FIELDS = ['radial_velocity', 'intensity', 'beta', 'spectral_width']
+
+
+def _aligned(n_bytes):
+    return -(-n_bytes // ALIGN) * ALIGN
+
+
+def _layout(header_bytes, n_rays, n_gates):
+    # Byte offset of every block and the total file size
+    offsets = {}
+    position = _aligned(FIXED_HEADER.size + header_bytes)
+    for name in RAY_FIELDS:
+        offsets[name] = position
+        position = _aligned(position + n_rays * 8)
+    for name in GATE_FIELDS:
+        offsets[name] = position
+        position = _aligned(position + n_rays * n_gates * 4)
+    return offsets, position
+
+
+def _count_rays(file_path, n_gates):
+    # Counts the complete rays in an .hpl file without parsing it
+    n_lines = 0
+    with open(file_path, 'rb') as hpl_file:
+        for block in iter(lambda: hpl_file.read(1 << 20), b''):
+            n_lines += block.count(b'\n')
+    return max(n_lines - HEADER_N, 0) // (n_gates + 1)
+
+
+def sidecar_path(hpl_path, sidecar_dir=None):
+    """Returns the sidecar path of an .hpl file, next to it by default."""
+    name = os.path.splitext(os.path.basename(hpl_path))[0] + EXTENSION
+    return os.path.join(sidecar_dir or os.path.dirname(hpl_path), name)
+
+
+def write_sidecar(hpl_path, out_path=None, chunk_size=500):
+    """
+    Parses an .hpl file into a sidecar.
+
+    The sidecar is sized from a count of the complete rays in the file and
+    filled chunk by chunk, so only chunk_size rays are held in memory.
+
+    Parameters
+    ----------
+    hpl_path: str
+        The .hpl file.
+    out_path: str or None
+        The sidecar to write. Defaults to :func:`sidecar_path`.
+    chunk_size: int
+        The number of rays parsed at a time.
+
+    Returns
+    -------
+    n_rays: int
+        The number of rays written.
+    """
+    if out_path is None:
+        out_path = sidecar_path(hpl_path)
+    stat = os.stat(hpl_path)
+    with open(hpl_path, 'rb') as hpl_file:
+        header_text = b''.join(hpl_file.readline() for i in range(HEADER_N))
+    n_gates = _parse_hpl_header(header_text.decode('latin-1').splitlines(True))['number_of_gates']
+    n_rays = _count_rays(hpl_path, n_gates)
+    offsets, size = _layout(len(header_text), n_rays, n_gates)
+
+    tmp_path = out_path + '.tmp'
+    out = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(size,))
+    out[:FIXED_HEADER.size] = np.frombuffer(FIXED_HEADER.pack(
+        MAGIC, n_rays, n_gates, len(header_text), stat.st_size, stat.st_mtime_ns), dtype=np.uint8)
+    out[FIXED_HEADER.size:FIXED_HEADER.size + len(header_text)] = np.frombuffer(
+        header_text, dtype=np.uint8)
+    blocks = _blocks(out, offsets, n_rays, n_gates)
+    start = 0
+    for chunk in iter_hpl_chunks(hpl_path, chunk_size=chunk_size):
+        # The file may have grown since the rays were counted
+        n = min(chunk['decimal_time'].size, n_rays - start)
+        for name in RAY_FIELDS + GATE_FIELDS:
+            blocks[name][start:start + n] = chunk[name][:n]
+        start += n
+        if start == n_rays:
+            break
+    out.flush()
+    del out, blocks
+    os.replace(tmp_path, out_path)
+    return n_rays
+
+
+def _blocks(buffer, offsets, n_rays, n_gates):
+    blocks = {}
+    for name in RAY_FIELDS:
+        blocks[name] = buffer[offsets[name]:offsets[name] + n_rays * 8].view(np.float64)
+    for name in GATE_FIELDS:
+        block = buffer[offsets[name]:offsets[name] + n_rays * n_gates * 4]
+        blocks[name] = block.view(np.float32).reshape(n_rays, n_gates)
+    return blocks
+
+
+def read_sidecar_header(path):
+    """
+    Reads the fixed header of a sidecar.
+
+    Returns
+    -------
+    header: dict
+        n_rays, n_gates, header_bytes, source_size and source_mtime_ns.
+    """
+    with open(path, 'rb') as sidecar:
+        fields = FIXED_HEADER.unpack(sidecar.read(FIXED_HEADER.size))
+    if fields[0] != MAGIC:
+        raise ValueError('%s is not an .hpl sidecar' % path)
+    return dict(zip(['n_rays', 'n_gates', 'header_bytes', 'source_size', 'source_mtime_ns'],
+                    fields[1:]))
+
+
+def open_sidecar(path, mode='c'):
+    """
+    Opens a sidecar as memory-mapped arrays.
+
+    Parameters
+    ----------
+    path: str
+        The sidecar file.
+    mode: str
+        The np.memmap mode. The default copy-on-write mode lets callers mask
+        values in place without touching the file.
+
+    Returns
+    -------
+    data_temp: dict
+        The fields in the :func:`utils.hpl2dict` layout. The [gates, rays]
+        moments are transposed views of the mapped [rays, gates] blocks.
+    """
+    fixed = read_sidecar_header(path)
+    n_rays, n_gates = fixed['n_rays'], fixed['n_gates']
+    buffer = np.memmap(path, dtype=np.uint8, mode=mode)
+    header_text = bytes(buffer[FIXED_HEADER.size:FIXED_HEADER.size + fixed['header_bytes']])
+    data_temp = _parse_hpl_header(header_text.decode('latin-1').splitlines(True))
+    data_temp['no_of_rays_in_file'] = n_rays
+    offsets, size = _layout(fixed['header_bytes'], n_rays, n_gates)
+    if buffer.size < size:
+        raise ValueError('%s is truncated' % path)
+    for name, block in _blocks(buffer, offsets, n_rays, n_gates).items():
+        data_temp[name] = block.T if name in GATE_FIELDS else block
+    return data_temp
+
+
+def is_current(path, hpl_path):
+    """Returns True if the sidecar at path was written from hpl_path as it is now."""
+    try:
+        fixed = read_sidecar_header(path)
+    except (OSError, ValueError, struct.error):
+        return False
+    stat = os.stat(hpl_path)
+    return (fixed['source_size'] == stat.st_size and
+            fixed['source_mtime_ns'] == stat.st_mtime_ns)
+
+
+class SidecarStore(object):
+    """
+    Parses .hpl files into sidecars on first use and memory-maps them after.
+
+    It can be passed as the cache of :func:`utils.read_as_netcdf`.
+
+    Parameters
+    ----------
+    sidecar_dir: str or None
+        The directory holding the sidecars. None keeps each sidecar next to
+        its .hpl file.
+    chunk_size: int
+        The number of rays parsed at a time.
+    """
+    def __init__(self, sidecar_dir=None, chunk_size=500):
+        self.sidecar_dir = sidecar_dir
+        self.chunk_size = chunk_size
+        if sidecar_dir is not None:
+            os.makedirs(sidecar_dir, exist_ok=True)
+
+    def load(self, file_path):
+        """
+        Loads the rays of an .hpl file, rewriting its sidecar if the file
+        has changed since the sidecar was written.
+        """
+        path = sidecar_path(file_path, self.sidecar_dir)
+        if not is_current(path, file_path):
+            n_rays = write_sidecar(file_path, path, chunk_size=self.chunk_size)
+            print("Wrote %d rays from %s to %s" % (n_rays, file_path, path))
+        return open_sidecar(path)
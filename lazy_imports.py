@@ -0,0 +1,73 @@
+"""
+Deferred imports of the heavy dependencies.
+
+Each trigger mode only needs some of the controller's dependencies: the node
+trigger needs neither ACT nor the .hpl parser, and importing ACT alone takes
+several seconds on the arm64 nodes. Modules returned by :func:`lazy_import`
+are bound at import time, so they can be used and replaced like any other
+module global, but are only loaded when one of their attributes is first
+used. Modules used from worker threads are loaded with :func:`preload`
+before the threads start.
+"""
+import importlib.util
+import sys
+import types
+
+
+class _MissingModule(types.ModuleType):
+    # Stands in for a module that is not installed, failing on first use
+    def __init__(self, name, error):
+        super().__init__(name)
+        self.__dict__['_error'] = error
+
+    def __getattr__(self, attr):
+        raise ModuleNotFoundError("%s is needed for this mode but could not be imported: %s" %
+                                  (self.__name__, self._error), name=self.__name__)
+
+
+def lazy_import(name):
+    """
+    Returns a module that is loaded on first attribute access.
+
+    Parameters
+    ----------
+    name: str
+        The absolute name of the module, e.g. 'waggle.plugin'. Parent
+        packages are imported right away.
+
+    Returns
+    -------
+    module: module
+        The module. If it is not installed, a placeholder that raises
+        ModuleNotFoundError when used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError as err:
+        return _MissingModule(name, err)
+    if spec is None:
+        return _MissingModule(name, 'not installed')
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def preload(*modules):
+    """
+    Loads modules returned by :func:`lazy_import` right away.
+
+    LazyLoader is not thread-safe before Python 3.12, so two threads using
+    a module for the first time at once can both execute it or see it half
+    loaded. Call this from the main thread with the modules a pool of
+    threads is about to use. Modules that are not installed are skipped and
+    still fail when used.
+    """
+    for module in modules:
+        if not isinstance(module, _MissingModule):
+            # Any attribute access finishes loading the module
+            getattr(module, '__name__')
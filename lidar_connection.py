@@ -0,0 +1,127 @@
+"""
+Long-lived SSH/SFTP session to a Halo Photonics lidar.
+
+One authenticated transport is opened per lidar and its SFTP channel is
+reused for every listing, download and upload in a decision cycle. The
+channel is not thread-safe, so operations from different threads, e.g. a
+download in a fetch thread and an upload from the main thread, take turns.
+"""
+import socket
+import threading
+import time
+
+import paramiko
+
+RETRY_EXCEPTIONS = (paramiko.SSHException, EOFError, socket.error)
+
+
+class LidarConnection(object):
+    """
+    Pooled SFTP session to a lidar that reconnects when the link drops.
+
+    The connection is opened on first use.
+
+    Parameters
+    ----------
+    host: str
+        IP address or host name of the lidar.
+    username: str
+        The username of the lidar.
+    password: str
+        The lidar's password.
+    port: int
+        The SSH port of the lidar.
+    max_retries: int
+        The number of times an operation is retried after the link drops.
+    backoff: float
+        The wait before the first reconnect attempt [s]. The wait doubles
+        after every failed attempt.
+    timeout: float
+        The timeout for opening the connection [s].
+    lock_timeout: float
+        How long an operation waits for another thread's operation to
+        finish before giving up [s].
+    """
+    def __init__(self, host, username, password, port=22, max_retries=3,
+                 backoff=2., timeout=30., lock_timeout=120.):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self._lock = threading.RLock()
+        self._transport = None
+        self._sftp = None
+
+    def connect(self):
+        """Opens the SSH transport and the SFTP channel."""
+        with self._lock:
+            self.close()
+            print("Connecting to %s" % self.host)
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._transport = paramiko.Transport(sock)
+            self._transport.connect(username=self.username, password=self.password)
+            self._sftp = paramiko.SFTPClient.from_transport(self._transport)
+            print("Connected to the Lidar!")
+
+    @property
+    def is_active(self):
+        return self._transport is not None and self._transport.is_active()
+
+    @property
+    def sftp(self):
+        """The SFTP channel, (re)connecting if the link is down."""
+        if not self.is_active:
+            self.connect()
+        return self._sftp
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs func(sftp, *args, **kwargs), reconnecting with backoff if the link drops.
+
+        Parameters
+        ----------
+        func: callable
+            The operation. Its first argument is the SFTP channel.
+
+        Returns
+        -------
+        The return value of func.
+        """
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            raise TimeoutError("The connection to %s is still busy after %.0f s" %
+                               (self.host, self.lock_timeout))
+        try:
+            wait = self.backoff
+            for attempt in range(self.max_retries + 1):
+                try:
+                    return func(self.sftp, *args, **kwargs)
+                except RETRY_EXCEPTIONS as err:
+                    if attempt == self.max_retries:
+                        raise
+                    print("Connection to %s failed (%s), retrying in %.0f s" %
+                          (self.host, err, wait))
+                    self.close()
+                    time.sleep(wait)
+                    wait = wait * 2
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Closes the SFTP channel and the transport."""
+        with self._lock:
+            if self._sftp is not None:
+                self._sftp.close()
+                self._sftp = None
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
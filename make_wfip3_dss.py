@@ -1,9 +1,9 @@
-from datetime import datetime, timedelta
+from dss import build_schedule
+
+# Profile every 5 s during the first 10 minutes of each hour
+WFIP3_RULES = [{'scan': 'profile', 'start': '00:00:00', 'end': '00:10:00',
+                'period': '01:00:00', 'step': 5}]
 
-start_time = datetime(2020, 3, 14, 0, 0, 0)
 # Make the Daily Scan Schedule text file for WFIP3
-with open('scan.dss', 'w') as dss_file:
-    while start_time < datetime(2020, 3, 15, 0, 0):
-        if start_time.minute < 10:
-            dss_file.write("%s\tprofile\t1\tS\t0\r\n" % start_time.strftime('%H%M%S'))
-        start_time = start_time + timedelta(seconds=5)
+with open('scan.dss', 'wb') as dss_file:
+    dss_file.write(build_schedule(WFIP3_RULES, '2020-03-14').to_text())
@@ -0,0 +1,184 @@
+"""
+Windowed aggregation of the wind profiles published by Waggle nodes.
+
+The windprofile plugin publishes a wind speed and a wind direction record for
+each retrieval. :func:`aggregate_winds` turns the records of one or more
+nodes into the mean speed, the vector-averaged speed and the circular mean
+direction over several time windows in one groupby pass, and
+:class:`NodeQueryCache` keeps the records of the last query so that each
+cycle only fetches the records published since.
+"""
+import numpy as np
+import pandas as pd
+
+PLUGIN = ".*windprofile:2024.12.5"
+COLUMNS = ['n_speed', 'speed', 'n_direction', 'sin', 'cos', 'n_pairs', 'u', 'v']
+
+
+def _utc(now):
+    # Naive times are local, as returned by datetime.datetime.now()
+    if now is None:
+        return pd.Timestamp.now(tz='UTC')
+    now = pd.Timestamp(now)
+    if now.tzinfo is None:
+        now = pd.Timestamp(now.to_pydatetime().astimezone())
+    return now.tz_convert('UTC')
+
+
+def query_filter(vsns, names, plugin=PLUGIN):
+    """
+    Returns the sage_data_client filter selecting the named records of
+    several nodes.
+
+    Parameters
+    ----------
+    vsns: list of str
+        The node VSNs.
+    names: list of str
+        The record names, e.g. ['lidar.hub_wind_spd', 'lidar.hub_wind_dir'].
+    plugin: str
+        The pattern matching the publishing plugin.
+    """
+    return {"plugin": plugin,
+            "vsn": "|".join(vsns),
+            "name": "|".join(name.replace('.', '\\.') for name in names)}
+
+
+class NodeQueryCache(object):
+    """
+    Incremental sage_data_client queries over a sliding window.
+
+    The records of the last query are kept, so the next query only asks for
+    the records published since the newest one held, and records older than
+    the window are dropped.
+
+    Parameters
+    ----------
+    client: module
+        The sage_data_client module, or an object with the same query method.
+    window: float
+        The length of the window [minutes].
+    """
+    def __init__(self, client, window=15.):
+        self.client = client
+        self.window = window
+        self.records = None
+        self.key = None
+
+    def query(self, vsns, names, now=None, plugin=PLUGIN):
+        """
+        Returns the named records of the nodes within the window.
+
+        Parameters
+        ----------
+        vsns: list of str
+            The node VSNs.
+        names: list of str
+            The record names.
+        now: datetime or None
+            The end of the window. Defaults to now; naive times are local.
+        plugin: str
+            The pattern matching the publishing plugin.
+
+        Returns
+        -------
+        records: pandas.DataFrame
+            The records, with timezone-aware UTC timestamps.
+        """
+        now = _utc(now)
+        start = now - pd.Timedelta(minutes=self.window)
+        key = (tuple(vsns), tuple(names), plugin)
+        if self.key != key or self.records is None or self.records.empty:
+            self.records = None
+        if self.records is not None:
+            start = max(start, self.records['timestamp'].max())
+        new = self.client.query(start=start.isoformat(), end=now.isoformat(),
+                                filter=query_filter(vsns, names, plugin))
+        if not new.empty:
+            new = new.assign(timestamp=pd.to_datetime(new['timestamp'], utc=True))
+        print("Queried %d new records of %s" % (len(new), ', '.join(vsns)))
+        self.key = key
+        frames = [f for f in (self.records, new) if f is not None and not f.empty]
+        if not frames:
+            self.records = None
+            return new
+        records = pd.concat(frames).drop_duplicates(subset=['timestamp', 'name', 'meta.vsn'])
+        in_window = ((records['timestamp'] >= now - pd.Timedelta(minutes=self.window)) &
+                     (records['timestamp'] <= now))
+        self.records = records[in_window].reset_index(drop=True)
+        return self.records
+
+
+def aggregate_winds(records, speed_name, direction_name, windows=(15.,), now=None):
+    """
+    Averages the wind speed and direction records of each node over several
+    windows ending at now.
+
+    Directions are averaged as unit vectors, so that e.g. 350 and 10 degrees
+    average to 0 and not 180. The vector-averaged speed uses the speed and
+    direction records published within the same second.
+
+    Parameters
+    ----------
+    records: pandas.DataFrame
+        The records as returned by sage_data_client.query, with timestamp,
+        name, value and meta.vsn columns.
+    speed_name, direction_name: str
+        The names of the speed and direction records.
+    windows: sequence of float
+        The window lengths [minutes].
+    now: datetime or None
+        The end of the windows. Defaults to now; naive times are local.
+
+    Returns
+    -------
+    winds: pandas.DataFrame
+        Indexed by (vsn, window), with the number of records n, the mean
+        speed, the vector-averaged vector_speed and the circular mean
+        direction. The vsn 'all' aggregates every node.
+    """
+    now = _utc(now)
+    windows = np.sort(np.asarray(windows, dtype=float))
+    records = records[records['name'].isin([speed_name, direction_name])]
+    wide = records.assign(
+        timestamp=pd.to_datetime(records['timestamp'], utc=True).dt.floor('s')).pivot_table(
+        index=['meta.vsn', 'timestamp'], columns='name', values='value', aggfunc='mean')
+    wide = wide.reindex(columns=[speed_name, direction_name])
+    speed = wide[speed_name].to_numpy()
+    direction = np.radians(wide[direction_name].to_numpy())
+    has_speed = np.isfinite(speed)
+    has_direction = np.isfinite(direction)
+    paired = has_speed & has_direction
+    sin = np.where(has_direction, np.sin(direction), 0.)
+    cos = np.where(has_direction, np.cos(direction), 0.)
+    speed = np.where(has_speed, speed, 0.)
+
+    # Each record goes to the shortest window holding it; cumulative sums over
+    # the windows then give the sums of every window from one groupby
+    age = (now - wide.index.get_level_values('timestamp')) / pd.Timedelta(minutes=1)
+    window_index = np.searchsorted(windows, np.asarray(age), side='left')
+    keep = (np.asarray(age) >= 0) & (window_index < windows.size)
+    parts = pd.DataFrame({
+        'vsn': wide.index.get_level_values('meta.vsn'), 'window': window_index,
+        'n_speed': has_speed, 'speed': speed, 'n_direction': has_direction,
+        'sin': sin, 'cos': cos, 'n_pairs': paired,
+        'u': np.where(paired, speed * sin, 0.), 'v': np.where(paired, speed * cos, 0.)})[keep]
+    sums = parts.groupby(['vsn', 'window'])[COLUMNS].sum()
+    vsns = sorted(set(wide.index.get_level_values('meta.vsn')))
+    full_index = pd.MultiIndex.from_product([vsns, range(windows.size)], names=['vsn', 'window'])
+    sums = sums.reindex(full_index, fill_value=0).groupby(level='vsn').cumsum()
+    total = sums.groupby(level='window').sum().reindex(range(windows.size), fill_value=0)
+    total.index = pd.MultiIndex.from_product([['all'], total.index], names=['vsn', 'window'])
+    sums = pd.concat([sums, total]) if vsns else total
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        winds = pd.DataFrame({
+            'n': sums['n_speed'].to_numpy(),
+            'speed': sums['speed'].to_numpy() / sums['n_speed'].to_numpy(),
+            'vector_speed': np.hypot(sums['u'], sums['v']).to_numpy() / sums['n_pairs'].to_numpy(),
+            'direction': np.mod(np.degrees(np.arctan2(sums['sin'], sums['cos'])).to_numpy(), 360.),
+            }, index=pd.MultiIndex.from_arrays(
+                [sums.index.get_level_values('vsn'), windows[sums.index.get_level_values('window')]],
+                names=['vsn', 'window']))
+    winds.loc[sums['n_direction'].to_numpy() == 0, 'direction'] = np.nan
+    return winds
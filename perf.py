@@ -0,0 +1,197 @@
+"""
+Per-stage timing of the controller's decision cycle.
+
+Code wraps each stage of a cycle (download, parse, retrieval, decision, CSM
+build, upload) in ``with perf.stage(name):`` and the module-level
+:data:`TIMER` accumulates the time spent in each, along with counters such
+as the bytes transferred and rays parsed. Stages may run in the source
+fetching threads, so the timer is thread-safe.
+
+At the end of a cycle the times and counters are published as
+``lidar.perf.*`` metrics, and :class:`CycleProfiler` can keep a cProfile
+dump of cycles that ran slow.
+"""
+import contextlib
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+STAGES = ['download', 'sonic_download', 'node_query', 'parse', 'retrieval',
+          'decision', 'csm_build', 'upload', 'data_upload', 'cycle']
+
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in named stages.
+
+    Attributes
+    ----------
+    totals: dict
+        The total time spent in each stage since the last reset [s].
+    counts: dict
+        The number of times each stage was entered since the last reset.
+    counters: dict
+        The counters, e.g. bytes_transferred, since the last reset.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+        self.counters = {}
+
+    def reset(self):
+        """Forgets all recorded stage times and counters."""
+        with self.lock:
+            self.totals = {}
+            self.counts = {}
+            self.counters = {}
+
+    def count(self, name, n=1):
+        """Adds n to counter name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, name, seconds):
+        """Records seconds spent in stage name."""
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager timing the enclosed block as stage name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Returns a copy of the stage totals, in the order of STAGES."""
+        with self.lock:
+            names = [s for s in STAGES if s in self.totals] + \
+                sorted(s for s in self.totals if s not in STAGES)
+            return {name: self.totals[name] for name in names}
+
+    def report(self):
+        """Prints the time spent in each stage and the counters."""
+        for name, seconds in self.snapshot().items():
+            print("%-15s %8.3f s (%d)" % (name, seconds, self.counts[name]))
+        with self.lock:
+            counters = dict(self.counters)
+        for name in sorted(counters):
+            print("%-15s %10d" % (name, counters[name]))
+
+    def publish(self, plugin, prefix='lidar.perf.'):
+        """
+        Publishes the stage times as <prefix><stage>_seconds and the counters
+        as <prefix><counter>.
+
+        Parameters
+        ----------
+        plugin: waggle.plugin.Plugin
+            The open Plugin to publish with.
+        prefix: str
+            The prefix of the metric names.
+        """
+        timestamp = time.time_ns()
+        for name, seconds in self.snapshot().items():
+            plugin.publish("%s%s_seconds" % (prefix, name), seconds, timestamp=timestamp)
+        with self.lock:
+            counters = dict(self.counters)
+        for name in sorted(counters):
+            plugin.publish(prefix + name, counters[name], timestamp=timestamp)
+
+
+TIMER = StageTimer()
+
+
+def stage(name):
+    """Times the enclosed block as stage name on the module-level TIMER."""
+    return TIMER.stage(name)
+
+
+def count(name, n=1):
+    """Adds n to counter name on the module-level TIMER."""
+    TIMER.count(name, n)
+
+
+class CycleProfiler(object):
+    """
+    Profiles decision cycles with cProfile and keeps the dumps of slow ones.
+
+    Before Python 3.12 cProfile only follows the thread it was enabled in,
+    so functions run in other threads (the source fetchers) are profiled
+    separately through :meth:`wrap` and merged into the cycle's dump.
+
+    Parameters
+    ----------
+    out_dir: str
+        The directory to write the .prof dumps to.
+    threshold: float
+        Cycles taking longer than this are dumped [s].
+    """
+    def __init__(self, out_dir, threshold=0.):
+        self.out_dir = out_dir
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.thread_profiles = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def wrap(self, func):
+        """
+        Returns func, profiled in whatever thread it is run in.
+
+        From Python 3.12 only one profiler can be active at a time, and the
+        cycle's profiler already follows every thread, so func is then run
+        without a profiler of its own.
+        """
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.thread_profiles.append(profile)
+        return profiled
+
+    @contextlib.contextmanager
+    def profile(self):
+        """
+        Profiles the enclosed cycle and dumps the profile if it is slow.
+
+        Yields
+        ------
+        None
+        """
+        with self.lock:
+            self.thread_profiles = []
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # Another profiler is running, e.g. python -m cProfile
+            print("Not profiling the cycle: %s" % err)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            if elapsed > self.threshold:
+                stats = pstats.Stats(profile)
+                with self.lock:
+                    for thread_profile in self.thread_profiles:
+                        stats.add(thread_profile)
+                path = os.path.join(self.out_dir, time.strftime('cycle_%Y%m%d_%H%M%S.prof'))
+                stats.dump_stats(path)
+                print("Cycle took %.1f s, wrote its profile to %s" % (elapsed, path))
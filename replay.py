@@ -0,0 +1,384 @@
+"""
+Historical replay of the controller's decision cycle.
+
+Archived .hpl files, sonic netCDF files and windprofile records are fed
+through :func:`send_scan_to_lidar_csm.run_cycle` at a series of simulated
+times, with local stand-ins for the lidar's SFTP server, the A2E DAP client,
+``sage_data_client.query`` and ``Plugin.publish``. Every cycle is timed per
+stage with :mod:`perf`, which gives a reproducible baseline for the
+download, parse, retrieval, decision, CSM build and upload latencies.
+
+Run with e.g.::
+
+    python replay.py --archive /data/lidar --start 2024-06-01T12:00 \\
+        --end 2024-06-01T18:00 --interval 10 -- --trigger_hsrhi
+
+Arguments after the replay options are passed to the controller.
+"""
+import argparse
+import contextlib
+import datetime
+import glob
+import io
+import os
+import re
+import shutil
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+
+import send_scan_to_lidar_csm as controller
+from hpl_cache import HplCache
+from hpl_sidecar import SidecarStore
+from node_winds import NodeQueryCache
+from perf import STAGES, TIMER, CycleProfiler
+from scan_strategy import StrategyUploader
+from sonic_cache import file_time
+from utils import HEADER_N, read_hpl_header, unwrap_hours
+from wind_history import WindHistory
+
+HPL_TIME = re.compile(r'(\d{8})_(\d{2})')
+
+
+def _ray_ends(file_path):
+    # The decimal time and the end offset of every complete ray in an .hpl file
+    with open(file_path, 'rb') as hpl_file:
+        n_gates = read_hpl_header(hpl_file)['number_of_gates']
+        hpl_file.seek(0)
+        data = hpl_file.read()
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+    n_rays = max(newlines.size - HEADER_N, 0) // (n_gates + 1)
+    first_line = HEADER_N + np.arange(n_rays) * (n_gates + 1)
+    starts = newlines[first_line - 1] + 1
+    decimal_time = np.array([float(data[s:s + 32].split()[0]) for s in starts])
+    ends = newlines[first_line + n_gates] + 1
+    header_end = newlines[HEADER_N - 1] + 1 if newlines.size >= HEADER_N else len(data)
+    return decimal_time, ends, header_end
+
+
+class _Attributes(object):
+    # The fields of paramiko.SFTPAttributes used by the controller
+    def __init__(self, filename, st_size):
+        self.filename = filename
+        self.st_size = st_size
+
+
+class _RemoteFile(io.BytesIO):
+    def prefetch(self, file_size=None):
+        pass
+
+
+class ReplaySFTP(object):
+    """
+    Stand-in for the lidar's SFTP server, serving the .hpl files of an archive.
+
+    The file of the current hour is cut after the last ray recorded before
+    the replay clock, so the controller sees the file as it stood on the
+    lidar at that time. Uploads are recorded instead of written.
+
+    Parameters
+    ----------
+    archive_dir: str
+        The directory tree holding the archived .hpl files.
+
+    Attributes
+    ----------
+    now: datetime
+        The replay clock.
+    uploads: list
+        The (remote_path, bytes) of every upload.
+    """
+    def __init__(self, archive_dir):
+        self.files = {}
+        for path in sorted(glob.glob(os.path.join(archive_dir, '**', '*.hpl'), recursive=True)):
+            self.files[os.path.basename(path)] = path
+        self.now = datetime.datetime.now()
+        self.uploads = []
+        self._rays = {}
+
+    def _served_size(self, name):
+        path = self.files[name]
+        match = HPL_TIME.search(name)
+        if match is None or match.group(0) != self.now.strftime('%Y%m%d_%H'):
+            return os.path.getsize(path)
+        if name not in self._rays:
+            self._rays[name] = _ray_ends(path)
+        decimal_time, ends, header_end = self._rays[name]
+        now_hours = self.now.hour + self.now.minute / 60. + self.now.second / 3600.
+        n_rays = np.searchsorted(unwrap_hours(decimal_time, int(match.group(2))), now_hours,
+                                 side='right')
+        return int(ends[n_rays - 1]) if n_rays > 0 else int(header_end)
+
+    def _read(self, remote_path):
+        name = os.path.basename(remote_path)
+        with open(self.files[name], 'rb') as hpl_file:
+            return hpl_file.read(self._served_size(name))
+
+    def listdir_attr(self, path='.'):
+        return [_Attributes(name, self._served_size(name)) for name in self.files]
+
+    def stat(self, remote_path):
+        return _Attributes(os.path.basename(remote_path),
+                           self._served_size(os.path.basename(remote_path)))
+
+    def get(self, remote_path, local_path):
+        with open(local_path, 'wb') as local_file:
+            local_file.write(self._read(remote_path))
+
+    def open(self, remote_path, mode='rb'):
+        return _RemoteFile(self._read(remote_path))
+
+    def putfo(self, file_obj, remote_path):
+        self.uploads.append((remote_path, file_obj.read()))
+
+
+class ReplayConnection(object):
+    """Stand-in for :class:`lidar_connection.LidarConnection` over a ReplaySFTP."""
+    def __init__(self, sftp, host='replay'):
+        self.host = host
+        self.sftp = sftp
+        self.is_active = True
+
+    def call(self, func, *args, **kwargs):
+        return func(self.sftp, *args, **kwargs)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplayDAP(object):
+    """
+    Stand-in for the doe_dap_dl DAP client, serving the sonic netCDF files of
+    a directory.
+
+    Files are matched to the search window by the YYYYMMDD.HHMMSS time stamp
+    in their names, and search results are inventory records like the
+    portal's.
+    """
+    def __init__(self, sonic_dir):
+        self.files = sorted(glob.glob(os.path.join(sonic_dir, '**', '*.nc'), recursive=True))
+
+    def setup_basic_auth(self, username=None, password=None):
+        pass
+
+    def search(self, filter_arg, table='inventory'):
+        start, end = filter_arg['date_time']['between']
+        found = []
+        for path in self.files:
+            stamp = file_time(os.path.basename(path))
+            if stamp is not None and start <= stamp <= end:
+                found.append({'Filename': os.path.basename(path), 'path': path})
+        return found
+
+    def download_files(self, file_list, path=None):
+        for record in file_list:
+            shutil.copy(record['path'], os.path.join(path or os.getcwd(), record['Filename']))
+        return file_list
+
+
+class ReplaySage(object):
+    """
+    Stand-in for sage_data_client, answering queries from archived records.
+
+    Parameters
+    ----------
+    records: str or pandas.DataFrame
+        The records, or a CSV file of them, in the layout returned by
+        sage_data_client.query (timestamp, name, value, meta.vsn, ...).
+
+    Attributes
+    ----------
+    now: datetime
+        The replay clock that relative query starts are measured from. Naive
+        times are local, like the controller's.
+    """
+    def __init__(self, records):
+        if not isinstance(records, pd.DataFrame):
+            records = pd.read_csv(records)
+        records = records.copy()
+        records['timestamp'] = pd.to_datetime(records['timestamp'], utc=True)
+        self.records = records
+        self.now = datetime.datetime.now()
+
+    def _time(self, value):
+        if isinstance(value, str) and value.startswith('-'):
+            return self._time(None) + pd.Timedelta(value)
+        value = pd.Timestamp(self.now if value is None else value)
+        if value.tzinfo is None:
+            value = pd.Timestamp(value.to_pydatetime().astimezone())
+        return value.tz_convert('UTC')
+
+    def query(self, start, end=None, filter=None):
+        end = min(self._time(end), self._time(None))
+        selected = ((self.records['timestamp'] >= self._time(start)) &
+                    (self.records['timestamp'] <= end))
+        for key, pattern in (filter or {}).items():
+            column = key if key in self.records else 'meta.' + key
+            if column in self.records:
+                selected &= self.records[column].astype(str).str.fullmatch(pattern)
+        return self.records[selected].reset_index(drop=True)
+
+
+class ReplayPlugin(object):
+    """Stand-in for waggle.plugin.Plugin that records what is published."""
+    def __init__(self):
+        self.published = []
+        self.uploaded = []
+
+    def publish(self, name, value, timestamp=None, meta=None):
+        self.published.append((name, value, timestamp))
+
+    def upload_file(self, path, meta=None, timestamp=None, keep=False):
+        self.uploaded.append(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def _patched(module, **replacements):
+    originals = {name: getattr(module, name) for name in replacements}
+    for name, value in replacements.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+
+def replay(args, archive_dir, times, sonic_dir=None, node_records=None, quiet=False):
+    """
+    Runs the decision cycle at each simulated time.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The controller's arguments, see :func:`send_scan_to_lidar_csm.parse_args`.
+    archive_dir: str
+        The directory tree holding the archived .hpl files.
+    times: list of datetime
+        The simulated times of the cycles.
+    sonic_dir: str or None
+        The directory holding the archived sonic netCDF files.
+    node_records: str, pandas.DataFrame or None
+        The archived windprofile records.
+    quiet: bool
+        Set to True to hide the controller's output.
+
+    Returns
+    -------
+    cycles: list of dict
+        For every cycle, the time, the seconds spent in each stage, the perf
+        counters, whether the scan was triggered and whether a new strategy
+        was uploaded.
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sftp = ReplaySFTP(archive_dir)
+    connection = ReplayConnection(sftp)
+    sage = ReplaySage(node_records) if node_records is not None else None
+    plugin = ReplayPlugin()
+    uploader = StrategyUploader()
+    history = WindHistory()
+    node_cache = NodeQueryCache(sage, window=args.node_window) if sage is not None else None
+    cycles = []
+    old_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir, \
+            _patched(controller,
+                     doe_dap_dl=types.SimpleNamespace(
+                         DAP=lambda *a, **k: ReplayDAP(sonic_dir or work_dir)),
+                     sage_data_client=sage or controller.sage_data_client):
+        for name in ['change_true.txt', 'change_false.txt']:
+            shutil.copy(os.path.join(repo_dir, name), work_dir)
+        profiler = None
+        if args.profile_dir != "":
+            profiler = CycleProfiler(os.path.abspath(args.profile_dir),
+                                     threshold=args.profile_threshold)
+        cache = None
+        if args.sidecar:
+            cache = SidecarStore(os.path.join(work_dir, 'cache'))
+        elif args.cache_dir != "":
+            cache = HplCache(os.path.join(work_dir, 'cache'), max_bytes=args.cache_size_mb * 1e6)
+        os.chdir(work_dir)
+        try:
+            for cur_time in times:
+                sftp.now = cur_time
+                if sage is not None:
+                    sage.now = cur_time
+                n_published = len(plugin.published)
+                n_uploads = len(sftp.uploads)
+                output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+                with output:
+                    controller.timed_cycle(args, plugin, connection, profiler=profiler,
+                                           cache=cache, uploader=uploader, history=history,
+                                           node_cache=node_cache, cur_time=cur_time)
+                strategy = [v for n, v, t in plugin.published[n_published:]
+                            if n == 'lidar.strategy']
+                retargeted = any(not path.endswith('change.txt')
+                                 for path, data in sftp.uploads[n_uploads:])
+                cycles.append({'time': cur_time, 'stages': TIMER.snapshot(),
+                               'counters': dict(TIMER.counters),
+                               'trigger': bool(strategy and strategy[-1]),
+                               'retarget': retargeted})
+        finally:
+            os.chdir(old_dir)
+    return cycles
+
+
+def report(cycles):
+    """Prints the mean, 95th percentile and maximum time of every stage."""
+    names = [s for s in STAGES if any(s in c['stages'] for c in cycles)]
+    print("%-15s %10s %10s %10s" % ('stage', 'mean [s]', 'p95 [s]', 'max [s]'))
+    for name in names:
+        seconds = np.array([c['stages'].get(name, 0.) for c in cycles])
+        print("%-15s %10.3f %10.3f %10.3f" % (name, seconds.mean(),
+                                               np.percentile(seconds, 95), seconds.max()))
+    counters = sorted(set().union(*(c['counters'] for c in cycles)))
+    for name in counters:
+        print("%-15s %10.0f per cycle" % (name, np.mean([c['counters'].get(name, 0)
+                                                         for c in cycles])))
+    print("%d cycles, %d triggered, %d retargets" % (
+        len(cycles), sum(c['trigger'] for c in cycles), sum(c['retarget'] for c in cycles)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Replay archived data through the controller and time each stage.",
+            epilog="Remaining arguments are passed to send_scan_to_lidar_csm.py.")
+    parser.add_argument('--archive', required=True,
+            help='Directory of archived .hpl files')
+    parser.add_argument('--sonic', default=None,
+            help='Directory of archived sonic netCDF files')
+    parser.add_argument('--node_records', default=None,
+            help='CSV file of archived windprofile records')
+    parser.add_argument('--start', required=True, type=datetime.datetime.fromisoformat,
+            help='Time of the first cycle, e.g. 2024-06-01T12:00')
+    parser.add_argument('--end', required=True, type=datetime.datetime.fromisoformat,
+            help='Time of the last cycle')
+    parser.add_argument('--interval', default=10., type=float,
+            help='Time between cycles [minutes]')
+    parser.add_argument('--quiet', action='store_true',
+            help="Hide the controller's output")
+    replay_args, controller_argv = parser.parse_known_args()
+    if controller_argv[:1] == ['--']:
+        controller_argv = controller_argv[1:]
+    args = controller.parse_args(controller_argv)
+    step = datetime.timedelta(minutes=replay_args.interval)
+    times = []
+    cur_time = replay_args.start
+    while cur_time <= replay_args.end:
+        times.append(cur_time)
+        cur_time += step
+    report(replay(args, replay_args.archive, times, sonic_dir=replay_args.sonic,
+                  node_records=replay_args.node_records, quiet=replay_args.quiet))
@@ -0,0 +1,143 @@
+"""
+Compiles scan strategies into Halo Photonics CSM files in memory.
+
+Compiled strategies are memoized on their parameters, and
+:class:`StrategyUploader` remembers the hash of the last file uploaded to
+each path on each lidar so that identical strategies are not re-sent.
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+
+AZ_COUNTS_PER_ROT = 500000
+EL_COUNTS_PER_ROT = 250000
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_scan(elevations, azimuths, azi_speed, el_speed, wait,
+                  acceleration, repeat, rays_per_point, dyn_csm):
+    speed_azi_encoded = int(azi_speed * (AZ_COUNTS_PER_ROT / 360.))
+    speed_el_encoded = int(el_speed * (EL_COUNTS_PER_ROT / 360.))
+    no_points = len(azimuths) * len(elevations)
+    lines = []
+    if dyn_csm is False:
+        lines.append('%d\r\n' % repeat)
+        lines.append('%d\r\n' % no_points)
+        lines.append('%d\r\n' % rays_per_point)
+    for el in elevations:
+        el_encoded = -int(el * (EL_COUNTS_PER_ROT / 360.))
+        for az in azimuths:
+            azi_encoded = -int(az * (AZ_COUNTS_PER_ROT / 360.))
+            lines.append("A.1=%d,S.1=%d,P.1=%d*A.2=%d,S.2=%d,P.2=%d\r\n" %
+                         (acceleration, speed_azi_encoded, azi_encoded,
+                          acceleration, speed_el_encoded, el_encoded))
+            lines.append('W%d\r\n' % (wait))
+    return ''.join(lines).encode('ascii')
+
+
+def compile_scan(elevations, azimuths, azi_speed=1., el_speed=0.1,
+                 wait=0, acceleration=30, repeat=7, rays_per_point=2,
+                 dyn_csm=False):
+    """
+    Compiles a scanning strategy for a Halo Photonics Doppler Lidar into
+    the bytes of a CSM file.
+
+    Results are memoized, so compiling the same strategy again is free.
+
+    Parameters
+    ----------
+    elevations: float 1d array or tuple
+        The elevation of each sweep in the scan.
+    azimuths: float 1d array or tuple
+        The azimuths of the waypoints in each sweep. Azimuths of 360 or
+        more are encoded past one rotation, so that a sector through north
+        is swept through north, e.g. (330, 390).
+    azi_speed: float
+        The azimuthal rotation speed [degrees per second].
+    el_speed: float
+        The elevation rotation speed [degrees per second].
+    wait: int
+        The wait after each waypoint [ms].
+    acceleration: int
+        The acceleration of both motors.
+    repeat: int
+        The number of times to repeat the scan.
+    rays_per_point: int
+        The number of rays collected at each waypoint.
+    dyn_csm: bool
+        Set to True to compile for Dynamic CSM mode.
+
+    Returns
+    -------
+    strategy: bytes
+        The contents of the CSM file.
+    """
+    return _compile_scan(tuple(float(el) for el in elevations),
+                         tuple(float(az) for az in azimuths),
+                         float(azi_speed), float(el_speed), int(wait),
+                         int(acceleration), int(repeat), int(rays_per_point),
+                         bool(dyn_csm))
+
+
+def strategy_hash(strategy):
+    """Returns the SHA-256 hex digest identifying a compiled strategy."""
+    return hashlib.sha256(strategy).hexdigest()
+
+
+class StrategyUploader(object):
+    """
+    Uploads compiled strategies, skipping files the lidar already holds.
+
+    Parameters
+    ----------
+    state_file: str or None
+        JSON file recording the hash of the last file uploaded to each
+        path on each lidar, so that the record survives restarts. Set to
+        None to only keep the record in memory.
+    """
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.hashes = {}
+        if state_file is not None and os.path.exists(state_file):
+            try:
+                with open(state_file, 'r') as f:
+                    self.hashes = json.load(f)
+            except ValueError:
+                print("Ignoring unreadable upload state in %s" % state_file)
+
+    def is_current(self, host, remote_path, strategy):
+        """Returns True if the last file uploaded to remote_path on host matches strategy."""
+        return self.hashes.get('%s:%s' % (host, remote_path)) == strategy_hash(strategy)
+
+    def upload(self, connection, strategy, remote_path, force=False):
+        """
+        Uploads a compiled strategy unless the lidar already holds it.
+
+        Parameters
+        ----------
+        connection: LidarConnection
+            The connection to the lidar.
+        strategy: bytes
+            The contents of the file.
+        remote_path: str
+            The path of the file on the lidar.
+        force: bool
+            Set to True to upload even if the lidar already holds the file.
+
+        Returns
+        -------
+        uploaded: bool
+            True if the file was uploaded.
+        """
+        if not force and self.is_current(connection.host, remote_path, strategy):
+            print("%s is unchanged on the lidar, not uploading." % remote_path)
+            return False
+        connection.call(lambda sftp: sftp.putfo(io.BytesIO(strategy), remote_path))
+        self.hashes['%s:%s' % (connection.host, remote_path)] = strategy_hash(strategy)
+        if self.state_file is not None:
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(self.hashes, f)
+            os.replace(self.state_file + '.tmp', self.state_file)
+        return True
@@ -0,0 +1,280 @@
+"""
+Motion-time model of Halo Photonics CSM scan strategies.
+
+Each waypoint line of a CSM file moves the azimuth (1) and elevation (2)
+motors to an encoder position with a given acceleration and speed, and is
+followed by a wait. Both motors move at the same time with a trapezoidal
+speed profile, so a move takes as long as the slower of the two axes. The
+lidar records rays continuously, so a move and its wait give
+``(move + wait) / ray_seconds`` rays.
+
+:func:`estimate_csm` times a compiled strategy, and :func:`optimize_rules`
+searches the elevation step, cone width and scan speed of a rule set for the
+triggered scan with the widest angular coverage within a time budget.
+
+The CSM acceleration unit (ACCELERATION_SCALE) is not calibrated against
+recorded ray times yet, so the estimates are only used offline, to size
+rule sets, and not by the controller.
+
+Run ``python scan_timing.py strategy.txt`` to time CSM files, or
+``python scan_timing.py --rules rules.json --budget 120 --optimize`` to size
+a rule set's scans without a lidar.
+"""
+import argparse
+import itertools
+import re
+
+import numpy as np
+
+from decision import DEFAULT_RULES, default_plan, load_rules, make_rules, trigger_plan
+from scan_strategy import AZ_COUNTS_PER_ROT, EL_COUNTS_PER_ROT
+
+# Degrees per second squared for each unit of the CSM acceleration A. Not yet
+# calibrated against recorded ray times
+ACCELERATION_SCALE = 1.
+WAYPOINT = re.compile(r'A\.1=(-?\d+),S\.1=(-?\d+),P\.1=(-?\d+)\*'
+                      r'A\.2=(-?\d+),S\.2=(-?\d+),P\.2=(-?\d+)\s*W(\d+)')
+
+
+def parse_csm(strategy, dyn_csm=None):
+    """
+    Parses the waypoints of a CSM file.
+
+    Parameters
+    ----------
+    strategy: bytes or str
+        The contents of the CSM file.
+    dyn_csm: bool or None
+        True if the file is a Dynamic CSM scan.txt without the repeat and
+        point count header. None detects this from the first line.
+
+    Returns
+    -------
+    waypoints: dict
+        repeat and rays_per_point, and [waypoints, 2] (azimuth, elevation)
+        arrays of the acceleration, speed [degrees per second] and position
+        [degrees], with the [waypoints] wait [s].
+    """
+    if isinstance(strategy, bytes):
+        strategy = strategy.decode('ascii')
+    lines = strategy.split()
+    if dyn_csm is None:
+        dyn_csm = not lines or lines[0].startswith('A.')
+    fields = np.array(WAYPOINT.findall(strategy), dtype=float).reshape(-1, 7)
+    counts = np.array([AZ_COUNTS_PER_ROT, EL_COUNTS_PER_ROT]) / 360.
+    return {
+        'repeat': 1 if dyn_csm else int(lines[0]),
+        'rays_per_point': 1 if dyn_csm else int(lines[2]),
+        'acceleration': fields[:, [0, 3]],
+        'speed': fields[:, [1, 4]] / counts,
+        'position': -fields[:, [2, 5]] / counts,
+        'wait': fields[:, 6] / 1000.,
+    }
+
+
+def move_time(distance, speed, acceleration):
+    """
+    Returns the time to move distance with a trapezoidal speed profile.
+
+    The motor accelerates to speed, cruises and decelerates to a stop; moves
+    too short to reach speed follow a triangular profile. All arguments are
+    broadcast together.
+    """
+    distance = np.abs(np.asarray(distance, dtype=float))
+    speed = np.asarray(speed, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ramp = speed ** 2 / acceleration
+        time = np.where(distance >= ramp, distance / speed + speed / acceleration,
+                        2. * np.sqrt(distance / acceleration))
+    return np.where(distance > 0, time, 0.)
+
+
+def estimate_waypoints(position, speed, acceleration, wait, repeat=1, ray_seconds=1.,
+                       acceleration_scale=ACCELERATION_SCALE):
+    """
+    Estimates the duration and ray count of every segment of a scan.
+
+    A segment is the move to a waypoint followed by its wait. The scan is
+    assumed to start from its last waypoint, as it does when it repeats.
+
+    Parameters
+    ----------
+    position, speed, acceleration: float [waypoints, 2] array
+        The (azimuth, elevation) positions [degrees], speeds [degrees per
+        second] and CSM accelerations of the waypoints.
+    wait: float [waypoints] array
+        The wait after each waypoint [s].
+    repeat: int
+        The number of times the scan is run.
+    ray_seconds: float
+        The time to collect one ray [s].
+    acceleration_scale: float
+        Degrees per second squared for each unit of the CSM acceleration.
+
+    Returns
+    -------
+    timing: dict
+        The [waypoints] move, wait and duration [s] and rays of one pass,
+        and the total_seconds and total_rays of all repeats.
+    """
+    position = np.asarray(position, dtype=float).reshape(-1, 2)
+    distance = position - np.roll(position, 1, axis=0)
+    move = move_time(distance, speed, np.asarray(acceleration, dtype=float) *
+                     acceleration_scale).max(axis=1)
+    wait = np.broadcast_to(np.asarray(wait, dtype=float), move.shape)
+    duration = move + wait
+    rays = np.floor(duration / ray_seconds)
+    return {'move': move, 'wait': wait, 'duration': duration, 'rays': rays,
+            'total_seconds': repeat * duration.sum(), 'total_rays': repeat * rays.sum()}
+
+
+def estimate_csm(strategy, ray_seconds=1., acceleration_scale=ACCELERATION_SCALE, dyn_csm=None):
+    """
+    Estimates the duration and ray count of a compiled CSM strategy.
+
+    See :func:`estimate_waypoints` for the returned dict.
+    """
+    waypoints = parse_csm(strategy, dyn_csm=dyn_csm)
+    return estimate_waypoints(waypoints['position'], waypoints['speed'],
+                              waypoints['acceleration'], waypoints['wait'],
+                              repeat=waypoints['repeat'], ray_seconds=ray_seconds,
+                              acceleration_scale=acceleration_scale)
+
+
+def estimate_plan(plan, ray_seconds=1., acceleration_scale=ACCELERATION_SCALE):
+    """Estimates the duration and ray count of a :class:`decision.ScanPlan`."""
+    return estimate_csm(plan.compile(), ray_seconds=ray_seconds,
+                        acceleration_scale=acceleration_scale, dyn_csm=False)
+
+
+def angular_coverage(plan, rules, ray_seconds=1.):
+    """
+    Returns the angular coverage and resolution of a scan.
+
+    Stacked PPIs cover their cone width times a band one elevation step
+    high above each elevation, cut off at the rule set's max_angle [degrees
+    squared]. RHIs and HSRHIs cover the elevations they sweep [degrees].
+    The resolution is the coarsest spacing between rays: the elevation step
+    or the angle swept while one ray is collected [degrees].
+    """
+    if plan.name == 'ppis':
+        el_step = rules['step']
+        bands = np.minimum(plan.elevations + el_step, rules['max_angle']) - plan.elevations
+        cone = np.abs(np.diff(plan.azimuths)).sum()
+        return cone * np.clip(bands, 0., None).sum(), el_step * plan.azi_speed * ray_seconds
+    return np.abs(np.diff(plan.elevations)).sum(), plan.el_speed * ray_seconds
+
+
+def optimize_rules(rules, budget, steps=None, cone_widths=None, speeds=None, direction=0.,
+                   ray_seconds=1., acceleration_scale=ACCELERATION_SCALE):
+    """
+    Chooses the elevation step, cone width and speed of the triggered scan
+    with the widest angular coverage within the time budget.
+
+    Only the parameters the triggered scan uses are searched: all three for
+    stacked PPIs, the speed for RHIs and HSRHIs, none for the stepped RHI.
+    Candidates with the same coverage are ranked by the finer resolution,
+    so RHIs and HSRHIs get the slowest speed that fits, then by the shorter
+    scan. See :func:`angular_coverage`.
+
+    Parameters
+    ----------
+    rules: dict
+        The rule set, see :func:`decision.make_rules`.
+    budget: float
+        The time available for the scan, including its repeats [s].
+    steps, cone_widths, speeds: sequence of float or None
+        The candidate elevation steps [degrees], cone widths [degrees] and
+        speeds [degrees per second]. None keeps the rule set's value.
+    direction: float
+        The wind direction the scan is pointed along [degrees].
+    ray_seconds: float
+        The time to collect one ray [s].
+    acceleration_scale: float
+        Degrees per second squared for each unit of the CSM acceleration.
+
+    Returns
+    -------
+    best: dict or None
+        The rule set with the chosen step, cone_width and speed, or None if
+        no candidate fits the budget.
+    timing: dict or None
+        The :func:`estimate_waypoints` result of the chosen scan.
+    """
+    scan = rules['trigger_scan']
+    searched = {'ppis': ['step', 'cone_width', 'speed'], 'rhi': ['speed'],
+                'hsrhi': ['speed']}.get(scan, [])
+    candidates = {'step': steps, 'cone_width': cone_widths, 'speed': speeds}
+    values = [candidates[name] if name in searched and candidates[name] is not None
+              else [rules[name]] for name in ['step', 'cone_width', 'speed']]
+    best, best_timing, best_key = None, None, None
+    for step, cone_width, speed in itertools.product(*values):
+        candidate = make_rules(**dict(rules, step=float(step), cone_width=float(cone_width),
+                                      speed=float(speed)))
+        plan = trigger_plan(np.inf, direction, candidate)
+        if plan.elevations.size == 0:
+            continue
+        timing = estimate_plan(plan, ray_seconds=ray_seconds,
+                               acceleration_scale=acceleration_scale)
+        if timing['total_seconds'] > budget:
+            continue
+        coverage, resolution = angular_coverage(plan, candidate, ray_seconds)
+        key = (coverage, -resolution, -timing['total_seconds'])
+        if best is None or key > best_key:
+            best, best_timing, best_key = candidate, timing, key
+    return best, best_timing
+
+
+def _print_timing(name, timing):
+    print("%-12s %4d waypoints, %7.1f s, %6d rays per pass; %8.1f s, %7d rays in total" %
+          (name, timing['duration'].size, timing['duration'].sum(), timing['rays'].sum(),
+           timing['total_seconds'], timing['total_rays']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Estimate how long CSM scan strategies take, without a lidar.")
+    parser.add_argument('files', nargs='*',
+            help='CSM files to time. Without files, the scans of --rules are timed.')
+    parser.add_argument('--rules', default='',
+            help='JSON rule set (see decision.py). Defaults to the default rules.')
+    parser.add_argument('--direction', default=0., type=float,
+            help='Wind direction the triggered scan is pointed along [degrees]')
+    parser.add_argument('--budget', default=120., type=float,
+            help='Time available for a scan and its repeats [s]')
+    parser.add_argument('--ray_seconds', default=1., type=float,
+            help='Time to collect one ray [s]')
+    parser.add_argument('--acceleration_scale', default=ACCELERATION_SCALE, type=float,
+            help='Degrees per second squared per unit of the CSM acceleration')
+    parser.add_argument('--optimize', action='store_true',
+            help='Search the step, cone width and speed for the widest coverage within --budget')
+    args = parser.parse_args()
+
+    for file_name in args.files:
+        with open(file_name, 'rb') as csm_file:
+            _print_timing(file_name, estimate_csm(csm_file.read(), args.ray_seconds,
+                                                  args.acceleration_scale))
+    if not args.files:
+        rules = dict(DEFAULT_RULES)
+        if args.rules != '':
+            rules = load_rules(args.rules)
+            if isinstance(rules, list):
+                rules = rules[0]
+        for plan in [default_plan(0., args.direction, rules),
+                     trigger_plan(np.inf, args.direction, rules)]:
+            timing = estimate_plan(plan, args.ray_seconds, args.acceleration_scale)
+            _print_timing(plan.name, timing)
+            if timing['total_seconds'] > args.budget:
+                print("%s overruns the %.0f s budget" % (plan.name, args.budget))
+        if args.optimize:
+            best, timing = optimize_rules(
+                rules, args.budget, steps=np.arange(1., 11.), cone_widths=np.arange(20., 181., 20.),
+                speeds=[0.5, 1., 2., 3., 5., 10.], direction=args.direction,
+                ray_seconds=args.ray_seconds, acceleration_scale=args.acceleration_scale)
+            if best is None:
+                print("No %s fits in %.0f s" % (rules['trigger_scan'], args.budget))
+            else:
+                print("Best %s: step %.1f, cone_width %.0f, speed %.1f" %
+                      (best['trigger_scan'], best['step'], best['cone_width'], best['speed']))
+                _print_timing(best['trigger_scan'], timing)
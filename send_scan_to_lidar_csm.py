@@ -1,20 +1,33 @@
 import numpy as np
-import paramiko
-import act
 import argparse
 import glob
-import sys
 import datetime
 import time
 import os
-import xarray as xr
-import sage_data_client
+import traceback
+import shutil
 
-from doe_dap_dl import DAP
-from utils import read_as_netcdf
-from waggle.plugin import Plugin
-AZ_COUNTS_PER_ROT = 500000
-EL_COUNTS_PER_ROT = 250000
+from lazy_imports import lazy_import, preload
+from lidar_connection import LidarConnection
+from sources import SourceFetcher
+from data_upload import UploadQueue
+from sonic_cache import SonicCache
+from wind_history import WindHistory
+from decision import load_rules, plan_scan, rules_from_args
+from perf import TIMER, CycleProfiler, count, stage
+from scan_strategy import AZ_COUNTS_PER_ROT, EL_COUNTS_PER_ROT, StrategyUploader, compile_scan
+
+# Loaded on first use, so that each trigger mode only imports what it needs
+act = lazy_import('act')
+xr = lazy_import('xarray')
+sage_data_client = lazy_import('sage_data_client')
+doe_dap_dl = lazy_import('doe_dap_dl')
+utils = lazy_import('utils')
+vad = lazy_import('vad')
+hpl_cache = lazy_import('hpl_cache')
+hpl_sidecar = lazy_import('hpl_sidecar')
+node_winds = lazy_import('node_winds')
+waggle_plugin = lazy_import('waggle.plugin')
 
 def make_scan_file(elevations, azimuths,
                    out_file_name, azi_speed=1.,
@@ -40,32 +53,17 @@ def make_scan_file(elevations, azimuths,
     dyn_csm: bool
         Set to True to send CSM assuming Dynamic CSM mode
     """    
-    speed_azi_encoded = int(azi_speed * (AZ_COUNTS_PER_ROT / 360.))
-    speed_el_encoded = int(el_speed * (EL_COUNTS_PER_ROT / 360.))
-    clockwise = True
-    no_points = len(azimuths) * len(elevations)
-    with open(out_file_name, 'w') as output:
-        if dyn_csm is False:
-            output.write('%d\r\n' % repeat)
-            output.write('%d\r\n' % no_points)
-            output.write('%d\r\n' % rays_per_point)
-  
-        for el in elevations:
-            if clockwise:
-                az_array = azimuths
-            else:
-                az_array = azimuths.reverse()
-            for az in az_array:
-                azi_encoded = -int(az * (AZ_COUNTS_PER_ROT / 360.))
-                el_encoded = -int(el * (EL_COUNTS_PER_ROT / 360.))
-                output.write("A.1=%d,S.1=%d,P.1=%d*A.2=%d,S.2=%d,P.2=%d\r\n" %
-                             (acceleration, speed_azi_encoded, azi_encoded,
-                              acceleration, speed_el_encoded, el_encoded))
-                output.write('W%d\r\n' % (wait))
-            clockwise = ~clockwise
+    with stage('csm_build'):
+        strategy = compile_scan(elevations, azimuths, azi_speed=azi_speed, el_speed=el_speed,
+                                wait=wait, acceleration=acceleration, repeat=repeat,
+                                rays_per_point=rays_per_point, dyn_csm=dyn_csm)
+    with open(out_file_name, 'wb') as output:
+        output.write(strategy)
     return
 
-def send_scan(file_name, lidar_ip_addr, lidar_uname, lidar_pwd, out_file_name='user.txt', dyn_csm=False):
+
+def send_scan(file_name, lidar_ip_addr, lidar_uname, lidar_pwd, out_file_name='user.txt', dyn_csm=False,
+              connection=None):
     """
 
     Sends a scan to the lidar
@@ -84,61 +82,487 @@ def send_scan(file_name, lidar_ip_addr, lidar_uname, lidar_pwd, out_file_name='u
         The output file name on the lidar
     dyn_csm: bool
         Set to True to assume Dynamic CSM mode
+    connection: LidarConnection or None
+        An open connection to the lidar to reuse. If None, a new connection
+        is opened for this upload.
+    """
+    if connection is None:
+        with LidarConnection(lidar_ip_addr, lidar_uname, lidar_pwd) as connection:
+            return send_scan(file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
+                             out_file_name, dyn_csm=dyn_csm, connection=connection)
+
+    if dyn_csm is False:
+        print(f"Writing {out_file_name} on lidar.")
+    remote_path = _remote_path(out_file_name, dyn_csm)
+    with stage('upload'):
+        connection.call(lambda sftp: sftp.put(file_name, remote_path))
+    count('bytes_uploaded', os.path.getsize(file_name))
+
+
+def _remote_path(out_file_name, dyn_csm=False):
+    if dyn_csm is False:
+        return "/C:/Lidar/System/Scan parameters/%s" % out_file_name
+    else:
+        return f"/C:/Users/End User/DynScan/{out_file_name}"
+
+
+def send_strategy(strategy, connection, out_file_name='user.txt', dyn_csm=False,
+                  uploader=None, change_file='change_true.txt'):
+    """
+    Sends a compiled scan strategy to the lidar without writing it to disk.
+
+    The upload is skipped when the lidar already holds an identical file,
+    so an unchanged strategy does not restart the scan.
+
+    Parameters
+    ----------
+    strategy: bytes
+        The CSM file from :func:`scan_strategy.compile_scan`.
+    connection: LidarConnection
+        The connection to the lidar.
+    out_file_name:
+        The output file name on the lidar
+    dyn_csm: bool
+        Set to True to assume Dynamic CSM mode. The strategy is then written
+        to scan.txt and change_file is sent as change.txt.
+    uploader: StrategyUploader or None
+        Records what was last uploaded. If None, the strategy is always sent.
+    change_file: str
+        The local file sent as change.txt in Dynamic CSM mode. It is always
+        sent after a new strategy and otherwise only if the lidar's
+        change.txt differs from it.
+
+    Returns
+    -------
+    uploaded: bool
+        True if the strategy was uploaded.
+    """
+    if uploader is None:
+        uploader = StrategyUploader()
+    if dyn_csm:
+        out_file_name = "scan.txt"
+    else:
+        print(f"Writing {out_file_name} on lidar.")
+    uploaded = uploader.upload(connection, strategy, _remote_path(out_file_name, dyn_csm))
+    if dyn_csm:
+        # A new scan.txt is only picked up once change.txt is rewritten
+        with open(change_file, 'rb') as f:
+            uploader.upload(connection, f.read(), _remote_path('change.txt', dyn_csm), force=uploaded)
+    return uploaded
+
+
+def controller_rules(args):
+    """Returns the rule set from --rules, or else from the command line arguments."""
+    if args.rules == "":
+        return rules_from_args(args)
+    rules = load_rules(args.rules)
+    if isinstance(rules, list):
+        raise ValueError("%s must hold a single rule set." % args.rules)
+    return rules
+
+
+def send_plan(plan, plugin, connection, out_file_name='user.txt', dyn_csm=False,
+              uploader=None, meta=None):
+    """
+    Sends the scan chosen by :func:`decision.plan_scan` and publishes
+    whether it was triggered.
+
+    Parameters
+    ----------
+    plan: decision.ScanPlan
+        The scan to send.
+    plugin: waggle.plugin.Plugin
+        The open Plugin used to publish results.
+    connection: LidarConnection
+        The connection to the lidar.
+    out_file_name:
+        The output file name on the lidar
+    dyn_csm: bool
+        Set to True to assume Dynamic CSM mode.
+    uploader: StrategyUploader or None
+        Records what was last uploaded.
+    meta: dict or None
+        Metadata attached to the published values, e.g. the lidar's name.
+
+    Returns
+    -------
+    plan: decision.ScanPlan
+        The plan that was sent.
+    """
+    if plan.trigger:
+        print("Triggering %s" % plan.name)
+    else:
+        print("Sending %s" % plan.name)
+    print("Max wind = %f, %f" % (plan.speed, plan.direction))
+    with stage('csm_build'):
+        strategy = plan.compile(dyn_csm=dyn_csm)
+    meta = {} if meta is None else meta
+    with stage('upload'):
+        uploaded = send_strategy(strategy, connection, out_file_name, dyn_csm=dyn_csm,
+                                 uploader=uploader, change_file='change_true.txt')
+    if uploaded:
+        count('bytes_uploaded', len(strategy))
+    plugin.publish("lidar.strategy", int(plan.trigger), meta=meta, timestamp=time.time_ns())
+    return plan
+
+
+def sync_file(sftp, remote_path, local_path, remote_size=None):
+    """
+    Brings a local copy of a file on the lidar up to date.
+
+    The lidar only ever appends to its data files, so when the local copy is
+    shorter than the remote file only the missing byte range is fetched and
+    appended to the local file. If the local copy is missing or longer than
+    the remote file the whole file is downloaded.
+
+    Parameters
+    ----------
+    sftp: paramiko.SFTPClient
+        An open SFTP session to the lidar.
+    remote_path: str
+        The path to the file on the lidar.
+    local_path: str
+        The path to the local copy.
+    remote_size: int or None
+        The size of the remote file, if already known from a directory listing.
+
+    Returns
+    -------
+    n_bytes: int
+        The number of bytes transferred.
+    """
+    if remote_size is None:
+        remote_size = sftp.stat(remote_path).st_size
+    local_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+    if local_size == 0 or local_size > remote_size:
+        sftp.get(remote_path, local_path)
+        return remote_size
+    if local_size == remote_size:
+        return 0
+    with sftp.open(remote_path, 'rb') as remote_file, open(local_path, 'ab') as local_file:
+        remote_file.seek(local_size)
+        remote_file.prefetch(remote_size)
+        shutil.copyfileobj(remote_file, local_file, 32768)
+        return local_file.tell() - local_size
+
+
+def get_file(time, lidar_ip_addr, lidar_uname, lidar_pwd, sync=False, connection=None,
+             local_dir='.'):
+    """
+    Downloads the lidar's data files for the current and the previous hour.
+
+    Parameters
+    ----------
+    time: datetime
+        The current time.
+    lidar_ip_addr:
+        IP address of the lidar
+    lidar_uname:
+        The username of the lidar
+    lidar_pwd:
+        The lidar's password
+    sync: bool
+        Set to True to only fetch the bytes appended to each file since the
+        last download instead of downloading whole files.
+    connection: LidarConnection or None
+        An open connection to the lidar to reuse. If None, a new connection
+        is opened for this download.
+    local_dir: str
+        The directory to download the files to.
+
+    Returns
+    -------
+    n_bytes: int
+        The number of bytes transferred.
+    """
+    if connection is None:
+        with LidarConnection(lidar_ip_addr, lidar_uname, lidar_pwd) as connection:
+            return get_file(time, lidar_ip_addr, lidar_uname, lidar_pwd, sync=sync,
+                            connection=connection, local_dir=local_dir)
+
+    year = time.year
+    day = time.day
+    month = time.month
+    hour = time.hour
+    prev_hour = time - datetime.timedelta(hours=1)
+    file_path = "/C:/Lidar/Data/Proc/%d/%d%02d/%d%02d%02d/" % (year, year, month, year, month, day)
+    print(file_path)
+    start = datetime.datetime.now()
+    n_bytes = 0
+    file_list = connection.call(lambda sftp: sftp.listdir_attr(file_path))
+    time_string = '%d%02d%02d_%02d' % (year, month, day, hour)
+    time_string_prev = '%d%02d%02d_%02d' % (prev_hour.year, prev_hour.month, prev_hour.day, prev_hour.hour)
+    file_name = None
+
+    for f in file_list:
+        if time_string in f.filename or time_string_prev in f.filename:
+            file_name = f.filename
+            base, name = os.path.split(file_name)
+            name = os.path.join(local_dir, name)
+            print(file_name)
+            remote_path = os.path.join(file_path, file_name)
+            if sync:
+                n_bytes += connection.call(sync_file, remote_path, name, remote_size=f.st_size)
+            else:
+                connection.call(lambda sftp: sftp.get(remote_path, name))
+                n_bytes += f.st_size
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    print("Transferred %d bytes in %.2f s" % (n_bytes, elapsed))
+    if file_name is None:
+        print("%s not found!" % str(time))
+    return n_bytes
+
+
+def fetch_lidar(args, connection, cur_time, cache=None, local_dir='.', location=None,
+                load_vad=None):
     """
+    Downloads the latest files from the lidar and, when triggering from the
+    lidar's own VAD, loads the latest User2 stacked PPI.
 
-    with paramiko.SSHClient() as ssh:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(lidar_ip_addr, username=lidar_uname, password=lidar_pwd)
-        print("Connected to the Lidar!")
-        with ssh.open_sftp() as sftp:
-            if dyn_csm is False:
-                print(f"Writing {out_file_name} on lidar.")
-                sftp.put(file_name, "/C:/Lidar/System/Scan parameters/%s" % out_file_name)
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The command line arguments.
+    connection: LidarConnection
+        The connection to the lidar.
+    cur_time: datetime
+        The current time.
+    cache: HplCache, SidecarStore or None
+        The cache of parsed .hpl files.
+    local_dir: str
+        The directory to download the files to.
+    location: 3-tuple or None
+        The (lat, lon, alt) of the lidar. Defaults to Nantucket.
+    load_vad: bool or None
+        Set to True to load the PPI scan. Defaults to True when triggering
+        from the VAD.
+
+    Returns
+    -------
+    ds: xarray.Dataset or None
+        The latest PPI scan, or None if not triggering from the VAD or no
+        usable scan was found.
+    """
+    if location is None:
+        location = (41.28079475342454, -70.16484695039435, 0.)
+    if load_vad is None:
+        load_vad = (args.trigger_node_hub_height == "" and args.trigger_sonic == "" and
+                    args.trigger_node_llj_height == "")
+    with stage('download'):
+        n_bytes = get_file(cur_time, args.lidar_ip_addr, args.lidar_uname, args.lidar_pwd,
+                           sync=args.sync, connection=connection, local_dir=local_dir)
+    count('bytes_transferred', n_bytes)
+    file_list = glob.glob(os.path.join(local_dir, '*.hpl'))
+    print(file_list) 
+    ds_list = []
+    file_list = sorted(file_list)[-1:0:-1]
+    if not load_vad:
+        return None
+    for f in file_list:
+        if 'User2' in os.path.basename(f):
+            with stage('parse'):
+                dataset = utils.read_as_netcdf(f, location[0], location[1], location[2],
+                                               last_n_rays=args.vad_rays, cache=cache)
+            count('rays_parsed', dataset.sizes['time'])
+            if np.all(dataset["elevation"] < 60) or dataset.sizes["time"] < 20:
+                dataset = None
+                continue
+            dataset = dataset.where(dataset.elevation < 89., drop=True)
+            if dataset.sizes["time"] == 0:
+                # Only vertical stares in the last rays
+                dataset = None
+                continue
+            dataset = dataset.drop_dims("sweep")
+            # Last dataset is a stacked PPI, let's send a VAD
+            print("Processing VAD from %s" % f)
+            if args.trigger_tke is False:
+                ds_list = [dataset]
+                break
             else:
-                sftp.put(file_name, f"/C:/Users/End User/DynScan/{out_file_name}")
-
-
-def get_file(time, lidar_ip_addr, lidar_uname, lidar_pwd):
-    with paramiko.SSHClient() as ssh:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        print("Connecting to %s" % lidar_ip_addr)
-        ssh.connect(lidar_ip_addr, username=lidar_uname, password=lidar_pwd)
-        print("Connected to the Lidar!")
-        year = time.year
-        day = time.day
-        month = time.month
-        hour = time.hour
-        prev_hour = time - datetime.timedelta(hours=1)
-        file_path = "/C:/Lidar/Data/Proc/%d/%d%02d/%d%02d%02d/" % (year, year, month, year, month, day)
-        print(file_path)
-        with ssh.open_sftp() as sftp:
-            file_list = sftp.listdir(file_path)
-            time_string = '%d%02d%02d_%02d' % (year, month, day, hour)
-            time_string_prev = '%d%02d%02d_%02d' % (prev_hour.year, prev_hour.month, prev_hour.day, prev_hour.hour)
-            file_name = None
-           
-            for f in file_list:
-                if time_string in f or time_string_prev in f: 
-                    file_name = f
-                    base, name = os.path.split(file_name)
-                    print(print(file_name))
-                    sftp.get(os.path.join(file_path, file_name), name)
-            if file_name is None:
-                print("%s not found!" % str(time))
-                return
+                ds_list.append(dataset)
+                break
+    if len(ds_list) == 0:
+        return None
+    return xr.concat(ds_list, dim='time')
 
 
-if __name__ == "__main__":
-    out_file_name = 'user.txt'
+def fetch_sonic(args, cur_time=None, cache=None):
+    """
+    Fetches the newest b1-level sonic anemometer file from the A2E portal,
+    unless it is already cached.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The command line arguments.
+    cur_time: datetime or None
+        The current time. Defaults to now.
+    cache: SonicCache or None
+        The cache of sonic files. Defaults to one in args.sonic_cache_dir.
+
+    Returns
+    -------
+    wind_speed, wind_direction: float
+        The latest 30 minute wind speed and direction.
+    """
+    if cur_time is None:
+        cur_time = datetime.datetime.now()
+    if cache is None:
+        cache = SonicCache(args.sonic_cache_dir, max_age=args.sonic_max_age)
+    a2e = doe_dap_dl.DAP('a2e.energy.gov', confirm_downloads=False)
+    a2e.setup_basic_auth(username=args.a2e_uname, password=args.a2e_passwd)
+    with stage('sonic_download'):
+        latest = cache.update(a2e, f"{args.trigger_sonic}.b1", cur_time)
+    if latest is None:
+        raise ValueError("No %s.b1 files found in the last %.0f minutes" %
+                         (args.trigger_sonic, args.sonic_max_age))
+    with xr.open_dataset(latest) as sonic_data:
+        wind_speed = sonic_data['wind_speed'].values[-1]
+        wind_direction = sonic_data['wind_direction'].values[-1]
+    return wind_speed, wind_direction
+
+
+def _node_keys(args):
+    if args.trigger_node_llj_height == "" and not args.trigger_node_hub_height == "":
+        return args.trigger_node_hub_height, "lidar.hub_wind_dir", "lidar.hub_wind_spd"
+    elif not args.trigger_node_llj_height == "" and args.trigger_node_hub_height == "":
+        return args.trigger_node_llj_height, "lidar.llj_nose_dir", "lidar.llj_nose_spd"
+    else:
+        raise ValueError("Cannot specify both triggering from LLJ and hub height.")
+
+
+def fetch_node(args, vsns, names, cur_time=None, cache=None):
+    """
+    Queries the wind profiles published by the nodes within the last
+    args.node_window minutes.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The command line arguments.
+    vsns: list of str
+        The VSNs of the nodes.
+    names: list of str
+        The names of the speed and direction records.
+    cur_time: datetime or None
+        The current time. Defaults to now.
+    cache: node_winds.NodeQueryCache or None
+        Holds the records of the last query so only newer ones are fetched.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The records within the window.
+    """
+    print(vsns)
+    if cache is None:
+        cache = node_winds.NodeQueryCache(sage_data_client, window=args.node_window)
+    with stage('node_query'):
+        return cache.query(vsns, names, now=cur_time)
+
+
+def vad_wind(args, ds, history=None, cur_time=None):
+    """
+    Retrieves the maximum wind (or TKE) between args.shear_bottom and
+    args.shear_top, and its direction, from a stacked PPI scan.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The command line arguments.
+    ds: xarray.Dataset
+        The PPI scan from :func:`fetch_lidar`.
+    history: WindHistory or None
+        The recent wind profiles and radial velocity statistics. The scan is
+        added to it.
+    cur_time: datetime or None
+        The time of the cycle, which ends the smoothing window. Defaults to
+        the current time.
+
+    Returns
+    -------
+    max_wind, max_wind_dir: float
+        The maximum wind speed (or TKE) and the wind direction at its height,
+        or None if no winds could be retrieved from the scan.
+    """
+    shear_top = args.shear_top
+    shear_bottom = args.shear_bottom
+    with stage('retrieval'):
+        if args.vad_method == 'act':
+            dataset = ds.copy()
+            dataset["signal_to_noise_ratio"] = dataset["intensity"] - 1
+            dataset = act.retrievals.compute_winds_from_ppi(
+                    dataset, intensity_name='intensity') 
+        else:
+            dataset = vad.compute_winds_from_ppi(ds, intensity_name='intensity')
+        if dataset is None:
+            return None
+        wind_speed = dataset['wind_speed'].mean(dim='time')
+        wind_direction = dataset['wind_direction'].mean(dim='time')
+        if history is not None:
+            for i in range(dataset.sizes['time']):
+                history.append_profile(dataset['time'].values[i], dataset['height'].values,
+                                       dataset['wind_speed'].values[i],
+                                       dataset['wind_direction'].values[i])
+            profile = (history.mean_profile(args.smooth_minutes, now=cur_time)
+                       if args.smooth_minutes > 0 else None)
+            if profile is not None:
+                print("Using the mean wind profile of the last %.0f minutes" % args.smooth_minutes)
+                wind_speed = xr.DataArray(profile[1], dims='height', coords={'height': profile[0]})
+                wind_direction = xr.DataArray(profile[2], dims='height', coords={'height': profile[0]})
+        max_wind = wind_speed.sel(height=slice(shear_bottom, shear_top)).max(dim='height')
+        max_wind_dir = wind_speed.sel(height=slice(shear_bottom, shear_top)).argmax(dim='height').values
+        max_wind_dir = wind_direction.sel(height=slice(shear_bottom, shear_top)).values[max_wind_dir]
+
+        if args.trigger_tke is True:    
+            ds["radial_velocity"] = ds["radial_velocity"].where(ds["intensity"] > 1.008)
+            tke = 0.5*(ds["radial_velocity"].std(dim='time')**2)
+            if history is not None:
+                history.update_radial_velocity(ds['time'].values, ds['range'].values,
+                                               ds['radial_velocity'].values)
+                stats = (history.radial_velocity_stats(args.smooth_minutes, now=cur_time)
+                         if args.smooth_minutes > 0 else None)
+                if stats is not None:
+                    tke = xr.DataArray(0.5 * stats[3], dims='range', coords={'range': stats[0]})
+            sin60 = np.sqrt(3) / 2
+            max_wind = tke.sel(
+                range=slice(shear_bottom * sin60, shear_top * sin60)).max(dim='range') 
+            print(max_wind)
+    return float(max_wind.values), float(max_wind_dir)
+
+
+def node_wind(args, df, spd_key, dir_key, cur_time=None):
+    """
+    Averages the node wind records over the last args.node_window minutes.
+
+    Returns
+    -------
+    wind: 2-tuple or None
+        The (speed, direction) of all nodes, or None if there are no records.
+    """
+    if df is None or df.empty:
+        return None
+    with stage('retrieval'):
+        winds = node_winds.aggregate_winds(df, spd_key, dir_key,
+                                           windows=[args.node_window], now=cur_time)
+    if winds.loc[('all', args.node_window), 'n'] == 0:
+        return None
+    print(winds)
+    wind = winds.loc[('all', args.node_window)]
+    wind_speed = wind['vector_speed'] if args.node_vector_speed else wind['speed']
+    return float(wind_speed), float(wind['direction'])
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--wmag', type=float, default=2, 
             help='Max wind [TKE] threshold for triggering [m/s]')
     parser.add_argument('--trigger_tke', action="store_true",
             help="Trigger based off of TKE instead of winds")
     parser.add_argument('--trigger_node_hub_height', type=str, default="",
-            help="Trigger based off of latest hub height winds from node")
+            help="Trigger based off of latest hub height winds from node (comma-separated VSNs to average several nodes)")
     parser.add_argument('--trigger_node_llj_height', type=str, default="",
-            help="Trigger based off of latest LLJ winds from node")
+            help="Trigger based off of latest LLJ winds from node (comma-separated VSNs to average several nodes)")
     parser.add_argument('--shear_top', type=float, default=1000, 
             help='Top vertical level for wind max calculation [m]')
     parser.add_argument('--shear_bottom', type=float, default=200,
@@ -155,6 +579,8 @@ if __name__ == "__main__":
             help="Point upwind if in this interval [max].")
     parser.add_argument('--lidar_ip_addr', type=str, default='10.31.81.87',
             help='Lidar IP address')
+    parser.add_argument('--lidar_port', type=int, default=22,
+            help='Lidar SSH port')
     parser.add_argument('--lidar_uname', type=str, default='end user',
             help='Lidar username')
     parser.add_argument('--lidar_pwd', type=str, default='',
@@ -183,361 +609,282 @@ if __name__ == "__main__":
     parser.add_argument('--width', default=60, type=float, help="Width of PPI cone.")
     parser.add_argument('--speed', default=2, type=float, help="Rotation speed in degrees per second.")
     parser.add_argument('--az_offset', default=0., type=float, help="Azimuthal offset for lidar.")
-    args = parser.parse_args()
-    if not args.trigger_rhi and not args.trigger_ppis and not args.trigger_hsrhi:
-        raise(ValueError, "User must specify scan to trigger in options (--trigger_(hsrhi/rhi/ppi).")
-    rays_per_point = 1.
-    wind_threshold = args.wmag
-    shear_top = args.shear_top
-    shear_bottom = args.shear_bottom
-    lidar_ip_addr = args.lidar_ip_addr
-    lidar_uname = args.lidar_uname
-    lidar_pwd = args.lidar_pwd
-    repeat = args.repeat
-    dir_min = args.dir_min
-    dir_max = args.dir_max
-    # Get the latest VAD
-    nant_lat_lon = (41.28079475342454, -70.16484695039435)
-    cur_time = datetime.datetime.now()
-    get_file(cur_time, lidar_ip_addr, lidar_uname, lidar_pwd)
-    file_list = glob.glob('*.hpl')
-    print(file_list) 
-    dataset = None
-    ds_list = []
-    file_list = sorted(file_list)[-1:0:-1]
-    need_update = False
-    if args.trigger_node_hub_height == "" and args.trigger_sonic == "" and args.trigger_node_llj_height == "":
-        for f in file_list:
-            if 'User2' in f:
-                dataset = read_as_netcdf(f, nant_lat_lon[0], nant_lat_lon[1], 0)
-                if np.all(dataset["elevation"] < 60) or dataset.sizes["time"] < 20:
-                    dataset = None
-                    continue
-                dataset = dataset.where(dataset.elevation < 89., drop=True)
-                dataset = dataset.drop_dims("sweep")
-                # Last dataset is a stacked PPI, let's send a VAD
-                print("Processing VAD from %s" % f)
-                if args.trigger_tke is False:
-                    ds_list = [dataset]
-                    break
-                else:
-                    ds_list.append(dataset)
-                    break
-        ds = xr.concat(ds_list, dim='time')
+    parser.add_argument('--direction_step', default=1., type=float,
+            help="Triggered scans point along the wind direction rounded to this step [degrees]. 0 disables rounding.")
+    parser.add_argument('--rules', default='', type=str,
+            help="JSON file with the trigger rule set, replacing the trigger options above.")
+    parser.add_argument('--vad_rays', default=None, type=int,
+            help="Only read the last N rays of each User2 file for the VAD.")
+    parser.add_argument('--vad_method', default='fast', choices=['fast', 'act'],
+            help="Wind retrieval for the VAD: batched least squares (fast) or ACT.")
+    parser.add_argument('--cache_dir', default='', type=str,
+            help="Directory for caching parsed .hpl files between runs.")
+    parser.add_argument('--cache_size_mb', default=200., type=float,
+            help="Maximum size of the parsed .hpl cache [MB].")
+    parser.add_argument('--sidecar', action="store_true",
+            help="Keep parsed .hpl files as memory-mapped sidecars (in --cache_dir if set).")
+    parser.add_argument('--sync', action="store_true",
+            help="Only download the data appended to the lidar's files since the last run.")
+    parser.add_argument('--lidar_timeout', default=90., type=float,
+            help="Time allowed for downloading and loading the lidar's data [s].")
+    parser.add_argument('--sonic_timeout', default=60., type=float,
+            help="Time allowed for fetching the sonic anemometer data [s].")
+    parser.add_argument('--sonic_cache_dir', default='sonic_cache', type=str,
+            help="Directory for caching the sonic anemometer files between runs.")
+    parser.add_argument('--sonic_max_age', default=180., type=float,
+            help="Age after which cached sonic anemometer files are removed [minutes].")
+    parser.add_argument('--node_window', default=15., type=float,
+            help="Window over which the node wind profiles are averaged [minutes].")
+    parser.add_argument('--node_vector_speed', action="store_true",
+            help="Trigger on the vector-averaged node wind speed instead of the mean speed.")
+    parser.add_argument('--node_timeout', default=30., type=float,
+            help="Time allowed for querying the node's wind profiles [s].")
+    parser.add_argument('--upload_state', default='last_upload.json', type=str,
+            help="File recording the strategies already on the lidar. Set to '' to always upload.")
+    parser.add_argument('--data_upload_state', default='uploaded_files.json', type=str,
+            help="File recording the User files already uploaded to Beehive. Set to '' to only keep the record in memory.")
+    parser.add_argument('--upload_workers', default=4, type=int,
+            help="Number of User files compressed and uploaded at the same time.")
+    parser.add_argument('--upload_max_age', default=24., type=float,
+            help="User files older than this are not uploaded [hours].")
+    parser.add_argument('--upload_uncompressed', action="store_true",
+            help="Upload the User files without gzipping them.")
+    parser.add_argument('--upload_prune_local', action="store_true",
+            help="Remove the local copies of User files once they are uploaded and no longer downloaded.")
+    parser.add_argument('--history_file', default='', type=str,
+            help="File for keeping the recent wind profiles between runs.")
+    parser.add_argument('--smooth_minutes', default=0., type=float,
+            help="Trigger on the mean VAD profile (or TKE) of the last N minutes instead of the latest scan.")
+    parser.add_argument('--profile_dir', default='', type=str,
+            help="Directory for cProfile dumps of slow cycles. Set to '' to disable profiling.")
+    parser.add_argument('--profile_threshold', default=120., type=float,
+            help="Cycles taking longer than this are dumped to --profile_dir [s].")
+    parser.add_argument('--daemon', action="store_true",
+            help="Stay resident and re-run the decision loop every --repeat minutes.")
+    return parser.parse_args(argv)
+
+
+def data_upload_queue(args, local_dir='.'):
+    """Returns the :class:`data_upload.UploadQueue` set up by the command line arguments."""
+    state_file = args.data_upload_state
+    if state_file != "" and not os.path.isabs(state_file):
+        state_file = os.path.join(local_dir, state_file)
+    return UploadQueue(state_file if state_file != "" else None,
+                       staging_dir=os.path.join(local_dir, 'upload_staging'),
+                       workers=args.upload_workers, compress=not args.upload_uncompressed,
+                       max_age=args.upload_max_age, keep_local=not args.upload_prune_local)
+
+
+def run_cycle(args, plugin, connection, cache=None, sources=None, uploader=None,
+              history=None, cur_time=None, node_cache=None, profiler=None, data_uploads=None):
+    """
+    Runs one decision cycle: fetches the latest data, decides on a scan
+    strategy and sends it to the lidar.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The command line arguments.
+    plugin: waggle.plugin.Plugin
+        The open Plugin used to publish results.
+    connection: LidarConnection
+        The connection to the lidar.
+    cache: HplCache, SidecarStore or None
+        The cache of parsed .hpl files.
+    sources: SourceFetcher or None
+        Fetches the data sources and holds their last good values.
+    uploader: StrategyUploader or None
+        Records the strategies already on the lidar.
+    history: WindHistory or None
+        The recent wind profiles and radial velocity statistics.
+    cur_time: datetime or None
+        The time of the cycle. Defaults to now.
+    node_cache: node_winds.NodeQueryCache or None
+        Holds the node records between cycles so only newer ones are queried.
+    profiler: perf.CycleProfiler or None
+        Profiles the source fetching threads of a profiled cycle.
+    data_uploads: data_upload.UploadQueue or None
+        The User files to upload to Beehive when triggering from a node.
+    """
+    out_file_name = 'user.txt'
+    if uploader is None:
+        uploader = StrategyUploader()
+    rules = controller_rules(args)
+    if cur_time is None:
+        cur_time = datetime.datetime.now()
+    vad_mode = args.trigger_node_hub_height == "" and args.trigger_sonic == "" and args.trigger_node_llj_height == ""
+    if not vad_mode and args.trigger_sonic == "":
+        node_vsn, dir_key, spd_key = _node_keys(args)
+        node_vsns = [vsn.strip() for vsn in node_vsn.split(',')]
+    if sources is None:
+        sources = SourceFetcher()
+    fetchers = {'lidar': lambda: fetch_lidar(args, connection, cur_time, cache=cache)}
+    preload(utils, xr)
+    if args.trigger_sonic != "":
+        fetchers['sonic'] = lambda: fetch_sonic(args, cur_time)
+        preload(doe_dap_dl)
+    elif not vad_mode:
+        fetchers['node'] = lambda: fetch_node(args, node_vsns, [spd_key, dir_key], cur_time,
+                                              cache=node_cache)
+        preload(node_winds, sage_data_client)
+    if profiler is not None:
+        fetchers = {name: profiler.wrap(func) for name, func in fetchers.items()}
+    results = sources.fetch(fetchers, {'lidar': args.lidar_timeout, 'sonic': args.sonic_timeout,
+                                       'node': args.node_timeout})
+    if vad_mode:
+        ds = results['lidar']
+        if ds is None:
+            print("Not triggering PPI")
+            plugin.publish("lidar.strategy", 0,
+                             timestamp=time.time_ns())
+            return
         print("Loaded dataset")
-        if ds is not None:
-            ds.to_netcdf('test.nc')
-            dataset = xr.open_dataset('test.nc')
-        with Plugin() as plugin:    
-            if ds is None:
-                print("Not triggering PPI")
-                plugin.publish("lidar.strategy", 0,
-                                 timestamp=time.time_ns())
-                azimuths = [max_wind_dir-25, max_wind_dir+25]
-                sys.exit(0)
-        
-            dataset["signal_to_noise_ratio"] = dataset["intensity"] - 1
-            print("Processing VAD")
-            dataset = act.retrievals.compute_winds_from_ppi(
-                    dataset, intensity_name='intensity') 
-            max_wind = dataset['wind_speed'].mean(dim='time').sel(height=slice(shear_bottom, shear_top)).max(dim='height')
-            max_wind_dir = dataset['wind_speed'].mean(dim='time').sel(height=slice(shear_bottom, shear_top)).argmax(dim='height').values
-            max_wind_dir = dataset['wind_direction'].mean(dim='time').sel(height=slice(shear_bottom, shear_top)).values[max_wind_dir]
-            if args.upwind_min is not None and args.upwind_max is not None:
-                if args.upwind_min > args.upwind_max:
-                    if max_wind_dir > args.upwind_min or max_wind_dir < args.upwind_max:
-                        max_wind_dir = max_wind_dir + 180
-                        if max_wind_dir >= 360.:
-                            max_wind_dir = max_wind_dir - 360.
-                else:
-                    if max_wind_dir > args.upwind_min and max_wind_dir < args.upwind_max:
-                        max_wind_dir = max_wind_dir + 180
-                        if max_wind_dir >= 360.:
-                            max_wind_dir = max_wind_dir - 360.
-
-            if args.trigger_tke is True:    
-                ds["radial_velocity"] = ds["radial_velocity"].where(ds["intensity"] > 1.008)
-                tke = 0.5*(ds["radial_velocity"].std(dim='time')**2)
-                sin60 = np.sqrt(3) / 2
-                max_wind = tke.sel(
-                    range=slice(shear_bottom * sin60, shear_top * sin60)).max(dim='range') 
-                print(max_wind)
-            
-            if np.abs(max_wind) > wind_threshold and max_wind_dir > dir_min and max_wind_dir < dir_max:
-                azimuths = np.array([max_wind_dir]) + args.az_offset
-                azimuths[azimuths >= 360] -= 360
-                elevations = np.arange(0, 180., 2.)
-                deg_per_sec = 2.
-                make_scan_file(elevations, azimuths, out_file_name,
-                    azi_speed=deg_per_sec, el_speed=1, repeat=repeat, dyn_csm=args.dyn_csm)
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('change_true.txt',  lidar_ip_addr, lidar_uname,
-                           lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-
-                print("Triggering RHI")
-                print("Max wind = %f, %f" % (max_wind, max_wind_dir))
-                plugin.publish("lidar.strategy",
-                                    1,
-                                    timestamp=time.time_ns())
-            else:
-                if args.default_stare:
-                    elevations = [90.]
-                    azimuths = [0, 1.]
-                    print("Stare sent")
-                else:
-                    elevations = [60.]
-                    azimuths = [0., 60., 120., 180., 270., 360.]
-                    azimuths = np.array(azimuths) + args.az_offset
-                    azimuths[azimuths >= 360.] -= 360
-                    print("VAD sent")
-
-                deg_per_sec = 60
-                make_scan_file(elevations, azimuths, out_file_name, wait=1000,
-                    azi_speed=deg_per_sec, el_speed=1, repeat=repeat, dyn_csm=args.dyn_csm)
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('change_true.txt',  lidar_ip_addr, lidar_uname,
-
-                           lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-
-                print("Max wind = %f, %f" % (max_wind, max_wind_dir))
-                print("Sending VAD profile")
-                plugin.publish("lidar.strategy",
-                                0,
-                                timestamp=time.time_ns())
-            if args.trigger_tke is False:
-                plugin.publish("lidar.max_wind_speed", float(max_wind.values), timestamp=time.time_ns())
-            else:
-                plugin.publish("lidar.max_tke", float(max_wind.values), timestamp=time.time_ns())
-            plugin.publish("lidar.max_wind_dir", max_wind_dir, timestamp=time.time_ns())
+        print("Processing VAD")
+        wind = vad_wind(args, ds, history, cur_time)
+        if wind is None:
+            print("Not triggering PPI")
+            plugin.publish("lidar.strategy", 0,
+                             timestamp=time.time_ns())
+            return
+        max_wind, max_wind_dir = wind
+        with stage('decision'):
+            plan = plan_scan(max_wind, max_wind_dir, rules)
+        send_plan(plan, plugin, connection, out_file_name, dyn_csm=args.dyn_csm, uploader=uploader)
+        if args.trigger_tke is False:
+            plugin.publish("lidar.max_wind_speed", plan.speed, timestamp=time.time_ns())
+        else:
+            plugin.publish("lidar.max_tke", plan.speed, timestamp=time.time_ns())
+        plugin.publish("lidar.max_wind_dir", plan.direction, timestamp=time.time_ns())
+        if history is not None and args.history_file != "":
+            history.save(args.history_file)
     elif args.trigger_sonic != "":
-        with Plugin() as plugin:
-            a2e = DAP('a2e.energy.gov', confirm_downloads=False)
-            a2e.setup_basic_auth(username=args.a2e_uname, password=args.a2e_passwd)
-            hour_ago = (datetime.datetime.now() - datetime.timedelta(minutes=180)).strftime("%Y%m%d%H%M%S")
-            now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            filter_arg = {
-                "Dataset": f"{args.trigger_sonic}.b1",
-                "date_time": {"between": [hour_ago, now]},
-                }
-            file_list = a2e.search(filter_arg, table='inventory')
-            a2e.download_files(file_list, path=os.getcwd())
-            nc_list = sorted(glob.glob('*.nc'))
-            sonic_data = xr.open_dataset(nc_list[-1])
-            wind_speed = sonic_data['wind_speed'].values[0]
-            wind_direction = sonic_data['wind_direction'].values[0]
-            sonic_data.close()
-            print(f"30 min wind speed: {wind_speed} direction: {wind_direction}")
-            if args.upwind_min is not None and args.upwind_max is not None:
-                if args.upwind_min > args.upwind_max:
-                    if wind_direction > args.upwind_min or wind_direction < args.upwind_max:
-                        wind_direction = wind_direction + 180
-                        if wind_direction >= 360.:
-                            wind_direction = wind_direction - 360.
-                else:
-                    if wind_direction > args.upwind_min and wind_direction < args.upwind_max:
-                        wind_direction = wind_direction + 180
-                        if wind_direction >= 360.:
-                            wind_direction = wind_direction - 360.
-
-            if wind_direction > dir_min and wind_direction < dir_max and wind_speed > wind_threshold:
-                if args.trigger_hsrhi:
-                    elevations = [0., 180.]
-                    azimuths = [wind_direction + args.az_offset]
-                    if azimuths[0] >= 360:
-                        azimuths[0] -= 360.
-                    el_speed = args.speed
-                    az_speed = 3
-                elif args.trigger_rhi:
-                    elevations = [args.min_angle, args.max_angle]
-                    azimuths = [wind_direction + args.az_offset]
-                    if azimuths[0] >= 360:
-                        azimuths[0] -= 360.
-                    el_speed = args.speed
-                    az_speed = 3
-                elif args.trigger_ppis:
-                    el_speed = 3
-                    az_speed = args.speed
-                    elevations = np.arange(args.min_angle, args.max_angle, args.step)
-                    azimuths = [wind_direction - args.cone_width/2,
-                            wind_direction + args.cone_width/2]
-                    azimuths = np.array(azimuths)
-                    azimuths[azimuths >= 360] -= 360
-
-                deg_per_sec = 2
-                make_scan_file(elevations, azimuths, out_file_name,
-                    azi_speed=deg_per_sec, el_speed=1, repeat=repeat, dyn_csm=args.dyn_csm)
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('change_true.txt',  lidar_ip_addr, lidar_uname,
-                        lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-
-                deg_per_sec = 2.
-                plugin.publish("lidar.strategy",
-                                1,
-                                timestamp=time.time_ns())
-                print("Triggering scan")
-            else:
-                elevations = [60.]
-                azimuths = [0, 359.]
-                deg_per_sec = 60
-                plugin.publish("lidar.strategy",
-                              0,
+        if results['sonic'] is None:
+            print("No sonic data available.")
+            plugin.publish("lidar.strategy",
+                            0,
                             timestamp=time.time_ns())
-                make_scan_file(elevations, azimuths, out_file_name, wait=0,
-                    azi_speed=deg_per_sec, el_speed=1, repeat=repeat, dyn_csm=args.dyn_csm)
-                print("Sending Stare...")
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('change_true.txt',  lidar_ip_addr, lidar_uname,
-                         lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-            plugin.publish("lidar.max_wind_speed", float(wind_speed), timestamp=time.time_ns())
-            plugin.publish("lidar.max_wind_direction", float(wind_direction), timestamp=time.time_ns())
+            return
+        wind_speed, wind_direction = results['sonic']
+        print(f"30 min wind speed: {wind_speed} direction: {wind_direction}")
+        with stage('decision'):
+            plan = plan_scan(float(wind_speed), float(wind_direction), rules)
+        send_plan(plan, plugin, connection, out_file_name, dyn_csm=args.dyn_csm, uploader=uploader)
+        plugin.publish("lidar.max_wind_speed", plan.speed, timestamp=time.time_ns())
+        plugin.publish("lidar.max_wind_direction", plan.direction, timestamp=time.time_ns())
 
     else:
-        with Plugin() as plugin:
-            if args.trigger_node_llj_height == "" and not args.trigger_node_hub_height == "":
-                df = sage_data_client.query(
-                    start="-15m",
-                    filter={
-                        "plugin": ".*windprofile:2024.12.5",
-                        "vsn": args.trigger_node_hub_height
-                 })
-                dir_key = "lidar.hub_wind_dir"
-                spd_key = "lidar.hub_wind_spd"
-                print(args.trigger_node_hub_height) 
-            elif not args.trigger_node_llj_height == "" and args.trigger_node_hub_height == "":
-                df = sage_data_client.query(
-                    start="-15m",
-                    filter={
-                        "plugin": ".*windprofile:2024.12.5",
-                        "vsn": args.trigger_node_llj_height
-                 })
-                dir_key = "lidar.llj_nose_dir"
-                spd_key = "lidar.llj_nose_spd"
+        wind = node_wind(args, results['node'], spd_key, dir_key, cur_time)
+        if wind is None:
+            if args.dyn_csm:
+                with open('change_false.txt', 'rb') as f:
+                    uploader.upload(connection, f.read(), _remote_path('change.txt', args.dyn_csm))
+            print("No wind profile data available within last %.0f minutes." % args.node_window)
+            plugin.publish("lidar.strategy",
+                            0,
+                            timestamp=time.time_ns())
+        else:
+            wind_speed, wind_direction = wind
+            with stage('decision'):
+                plan = plan_scan(float(wind_speed), float(wind_direction), rules)
+            send_plan(plan, plugin, connection, out_file_name, dyn_csm=args.dyn_csm,
+                      uploader=uploader)
+            plugin.publish("lidar.max_wind_speed", plan.speed, timestamp=time.time_ns())
+            plugin.publish("lidar.max_wind_direction", plan.direction, timestamp=time.time_ns())
+
+        if data_uploads is None:
+            data_uploads = data_upload_queue(args)
+        data_uploads.run(plugin, '.', cur_time)
+
+
+def timed_cycle(args, plugin, connection, profiler=None, cycle=None, **kwargs):
+    """
+    Runs :func:`run_cycle` with the stage timer reset, then reports and
+    publishes the stage times and counters as lidar.perf.* metrics.
+
+    Parameters
+    ----------
+    profiler: perf.CycleProfiler or None
+        Profiles the cycle, keeping the dump if it is slow.
+    cycle: callable or None
+        The cycle to run instead of :func:`run_cycle`, with the same
+        leading arguments, e.g. :func:`fleet.run_fleet_cycle`.
+    **kwargs
+        Passed to :func:`run_cycle`.
+    """
+    if cycle is None:
+        cycle = run_cycle
+    TIMER.reset()
+    try:
+        with stage('cycle'):
+            if profiler is None:
+                cycle(args, plugin, connection, **kwargs)
             else:
-                raise ValueError("Cannot specify both triggering from LLJ and hub height.")
-            if df.empty:
-                if args.dyn_csm:
-                    send_scan('change_false.txt',  lidar_ip_addr, lidar_uname,
-                           lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                print("No wind profile data available within last 15 minutes.")
-                plugin.publish("lidar.strategy",
-                                0,
-                                timestamp=time.time_ns())
-                sys.exit(0)
-            print(df["name"])
-            df_dir = df.where(df["name"] == dir_key)
-            df_spd = df.where(df["name"] == spd_key)
-            print(df_dir["value"].mean(), df_spd["value"].mean())
-            wind_speed = df_spd["value"].mean()
-            wind_direction = df_dir["value"].mean()
-            if args.upwind_min is not None and args.upwind_max is not None:
-                if args.upwind_min > args.upwind_max:
-                    if wind_direction > args.upwind_min or wind_direction < args.upwind_max:
-                        wind_direction = wind_direction + 180
-                        if wind_direction >= 360.:
-                            wind_direction = wind_direction - 360.
-                else:
-                    if wind_direction > args.upwind_min and wind_direction < args.upwind_max:
-                        wind_direction = wind_direction + 180
-                        if wind_direction >= 360.:
-                            wind_direction = wind_direction - 360.
-
-            if wind_direction > dir_min and wind_direction < dir_max and wind_speed > wind_threshold:
-                if args.trigger_hsrhi:
-                    elevations = [0., 180.]
-                    azimuths = [wind_direction + args.az_offset]
-                    if azimuths[0] >= 360:
-                        azimuths[0] -= 360.
-                    el_speed = args.speed
-                    az_speed = 3
-                elif args.trigger_rhi:
-                    elevations = [args.min_angle, args.max_angle]
-                    azimuths = [wind_direction + args.az_offset]
-                    if azimuths[0] >= 360:
-                        azimuths[0] -= 360.
-                    el_speed = args.speed
-                    az_speed = 3
-                elif args.trigger_ppis:
-                    el_speed = 3
-                    az_speed = args.speed
-                    elevations = np.arange(args.min_angle, args.max_angle, args.step)
-                    azimuths = [wind_direction - args.cone_width/2,
-                            wind_direction + args.cone_width/2]
-                    azimuths = np.array(azimuths)
-                    azimuths[azimuths >= 360] -= 360
-
-                deg_per_sec = 2
-                make_scan_file(elevations, azimuths, out_file_name,
-                    azi_speed=az_speed, el_speed=el_speed, repeat=repeat, dyn_csm=args.dyn_csm)
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('true.txt',  lidar_ip_addr, lidar_uname,
-                           lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-
-                deg_per_sec = 2.
-                plugin.publish("lidar.strategy",
-                                1,
-                                timestamp=time.time_ns())
-                print("Triggering scan")
+                with profiler.profile():
+                    cycle(args, plugin, connection, profiler=profiler, **kwargs)
+    finally:
+        TIMER.report()
+        TIMER.publish(plugin)
+
+
+def run_daemon(args, plugin, connection, profiler=None, cycle=None, **kwargs):
+    """
+    Runs :func:`run_cycle` every args.repeat minutes in this process, keeping
+    the Plugin, the lidar connection and the cache open between cycles.
+
+    The keyword arguments are passed to :func:`timed_cycle`.
+    """
+    interval = args.repeat * 60.
+    next_run = time.time()
+    while True:
+        try:
+            timed_cycle(args, plugin, connection, profiler=profiler, cycle=cycle, **kwargs)
+        except Exception:
+            traceback.print_exc()
+        next_run += interval
+        now = time.time()
+        if next_run < now:
+            print("Cycle overran the %.1f minute interval" % args.repeat)
+            next_run = now + interval - (now - next_run) % interval
+        time.sleep(next_run - now)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.rules == "" and not args.trigger_rhi and not args.trigger_ppis and not args.trigger_hsrhi:
+        raise ValueError("User must specify scan to trigger in options (--trigger_(hsrhi/rhi/ppi).")
+    cache = None
+    if args.sidecar:
+        cache = hpl_sidecar.SidecarStore(args.cache_dir if args.cache_dir != "" else None)
+    elif args.cache_dir != "":
+        cache = hpl_cache.HplCache(args.cache_dir, max_bytes=args.cache_size_mb * 1e6)
+    connection = LidarConnection(args.lidar_ip_addr, args.lidar_uname, args.lidar_pwd,
+                                 port=args.lidar_port)
+    sources = SourceFetcher()
+    uploader = StrategyUploader(args.upload_state if args.upload_state != "" else None)
+    node_cache = None
+    data_uploads = None
+    if args.trigger_node_hub_height != "" or args.trigger_node_llj_height != "":
+        node_cache = node_winds.NodeQueryCache(sage_data_client, window=args.node_window)
+        data_uploads = data_upload_queue(args)
+    history = WindHistory()
+    if args.history_file != "":
+        history = WindHistory.load(args.history_file)
+    profiler = None
+    if args.profile_dir != "":
+        profiler = CycleProfiler(args.profile_dir, threshold=args.profile_threshold)
+    try:
+        with waggle_plugin.Plugin() as plugin:
+            if args.daemon:
+                run_daemon(args, plugin, connection, cache=cache, sources=sources, uploader=uploader,
+                           history=history, node_cache=node_cache, profiler=profiler,
+                           data_uploads=data_uploads)
             else:
-                if args.default_stare:
-                    elevations = [90.]
-                    azimuths = [0, 1.]
-                    print("Stare sent")
-                else:
-                    elevations = [60.]
-                    azimuths = [0., 60., 120., 180., 270., 360.]
-                    azimuths = np.array(azimuths) + args.az_offset
-                    azimuths[azimuths >= 360.] -= 360
-                    print("VAD sent")
-                deg_per_sec = 60
-                plugin.publish("lidar.strategy",
-                                0,
-                                timestamp=time.time_ns())
-                make_scan_file(elevations, azimuths, out_file_name, wait=1000,
-                    azi_speed=deg_per_sec, el_speed=1, repeat=repeat, dyn_csm=args.dyn_csm)
-                if args.dyn_csm:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        "scan.txt", dyn_csm=args.dyn_csm)
-                    send_scan('change_true.txt',  lidar_ip_addr, lidar_uname,
-                           lidar_pwd, out_file_name='change.txt', dyn_csm=args.dyn_csm)
-                else:
-                    send_scan(out_file_name, lidar_ip_addr, lidar_uname, lidar_pwd,
-                        out_file_name, dyn_csm=args.dyn_csm)
-            plugin.publish("lidar.max_wind_speed", float(wind_speed), timestamp=time.time_ns())
-            plugin.publish("lidar.max_wind_direction", float(wind_direction), timestamp=time.time_ns())
-
-        print("Uploading User files...")
-        if cur_time.minute < 15:
-            cur_time = cur_time - datetime.timedelta(hours=1)
-            for f in file_list:
-                if 'User' in f:            
-                    time_string = '%d%02d%02d_%02d' % (cur_time.year, cur_time.month, cur_time.day, 
-                            cur_time.hour)
-                    if time_string in f:
-                        print(f)
-                        with Plugin() as plugin:
-                            plugin.upload_file(f)          
+                timed_cycle(args, plugin, connection, profiler=profiler, cache=cache,
+                            sources=sources, uploader=uploader, history=history,
+                            node_cache=node_cache, data_uploads=data_uploads)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
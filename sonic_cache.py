@@ -0,0 +1,148 @@
+"""
+On-node cache of sonic anemometer files from the A2E DAP portal.
+
+Only the newest file is needed to trigger, so instead of downloading the last
+3 hours of files on every run the cache keeps an inventory of the files it
+has seen, only searches the portal for files newer than the newest one seen
+and only downloads the newest new file. Files older than the cache's maximum
+age are removed.
+"""
+import datetime
+import glob
+import json
+import os
+import re
+
+FILE_TIME = re.compile(r'(\d{8})\.(\d{6})')
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+
+def file_name(record):
+    """Returns the file name of a DAP search result or a file path."""
+    if isinstance(record, dict):
+        return os.path.basename(record.get('Filename') or record.get('name'))
+    return os.path.basename(record)
+
+
+def file_time(name):
+    """
+    Returns the time stamp of a file named <dataset>.YYYYMMDD.HHMMSS.<ext>
+    as a YYYYmmddHHMMSS string, or None if it has no time stamp.
+    """
+    match = FILE_TIME.search(name)
+    return None if match is None else match.group(1) + match.group(2)
+
+
+class SonicCache(object):
+    """
+    Cache of the newest sonic anemometer files of one or more DAP datasets.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The directory holding the files and the inventory. It is created if
+        it does not exist.
+    max_age: float
+        Files older than this, relative to the time of the latest update,
+        are removed and not used [minutes]. The newest file of a dataset is
+        kept on disk so that it is not downloaded again.
+    """
+    def __init__(self, cache_dir, max_age=180.):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+        self.inventory = self._read_inventory()
+
+    def _inventory_path(self):
+        return os.path.join(self.cache_dir, 'inventory.json')
+
+    def _read_inventory(self):
+        try:
+            with open(self._inventory_path(), 'r') as inventory_file:
+                return json.load(inventory_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_inventory(self):
+        tmp_name = self._inventory_path() + '.tmp'
+        with open(tmp_name, 'w') as inventory_file:
+            json.dump(self.inventory, inventory_file)
+        os.replace(tmp_name, self._inventory_path())
+
+    def _find(self, name):
+        # DAP clients may write into subdirectories of the download path
+        found = glob.glob(os.path.join(self.cache_dir, '**', name), recursive=True)
+        return found[0] if found else None
+
+    def update(self, dap, dataset, cur_time=None, window=180.):
+        """
+        Downloads the newest file of a dataset if it is not cached yet.
+
+        Parameters
+        ----------
+        dap: doe_dap_dl.DAP
+            An authenticated DAP client.
+        dataset: str
+            The dataset, e.g. 'nant.sonic.z01.b1'.
+        cur_time: datetime or None
+            The current time. Defaults to now.
+        window: float
+            How far back to search when nothing has been seen yet [minutes].
+
+        Returns
+        -------
+        path: str or None
+            The newest cached file of the dataset, or None if there is none
+            younger than max_age.
+        """
+        if cur_time is None:
+            cur_time = datetime.datetime.now()
+        entry = self.inventory.setdefault(dataset, {'last_seen': None, 'files': {}})
+        start = (cur_time - datetime.timedelta(minutes=window)).strftime(TIME_FORMAT)
+        if entry['last_seen'] is not None and entry['last_seen'] > start:
+            start = entry['last_seen']
+        filter_arg = {
+            "Dataset": dataset,
+            "date_time": {"between": [start, cur_time.strftime(TIME_FORMAT)]},
+            }
+        records = [r for r in dap.search(filter_arg, table='inventory')
+                   if file_time(file_name(r)) is not None]
+        if records:
+            newest = max(records, key=lambda r: file_time(file_name(r)))
+            name = file_name(newest)
+            entry['last_seen'] = max(entry['last_seen'] or '', file_time(name))
+            if name not in entry['files'] or self._find(name) is None:
+                dap.download_files([newest], path=self.cache_dir)
+                if self._find(name) is not None:
+                    entry['files'][name] = file_time(name)
+                    print("Downloaded %s" % name)
+        self.evict(dataset, cur_time)
+        self._write_inventory()
+        oldest = (cur_time - datetime.timedelta(minutes=self.max_age)).strftime(TIME_FORMAT)
+        if max(entry['files'].values(), default='') < oldest:
+            print("No %s files newer than %.0f minutes" % (dataset, self.max_age))
+            return None
+        return self.latest(dataset)
+
+    def latest(self, dataset):
+        """Returns the newest cached file of a dataset, or None."""
+        files = self.inventory.get(dataset, {}).get('files', {})
+        for name in sorted(files, key=files.get, reverse=True):
+            path = self._find(name)
+            if path is not None:
+                return path
+        return None
+
+    def evict(self, dataset, cur_time):
+        """
+        Removes the files of a dataset older than max_age, keeping the newest.
+        """
+        files = self.inventory.get(dataset, {}).get('files', {})
+        oldest = (cur_time - datetime.timedelta(minutes=self.max_age)).strftime(TIME_FORMAT)
+        newest = max(files.values(), default=None)
+        for name, stamp in list(files.items()):
+            if stamp < oldest and stamp != newest:
+                path = self._find(name)
+                if path is not None:
+                    os.remove(path)
+                del files[name]
@@ -0,0 +1,122 @@
+"""
+Concurrent acquisition of the trigger data sources.
+
+Every configured source (lidar files over SFTP, sonic data from the A2E
+portal, wind profiles from sage_data_client) is fetched in its own thread
+with its own deadline. A source that misses its deadline or fails falls back
+to the last value it returned successfully, so the decision logic can run on
+whatever arrived in time.
+
+A source whose thread is still running from an earlier call, e.g. a hung
+download, is not fetched again until that thread finishes, so at most one
+thread at a time uses a source's connection. Threads that finish after
+their call gave up on them record neither their result nor their latency.
+"""
+import threading
+import time
+import traceback
+
+
+class SourceFetcher(object):
+    """
+    Fetches several data sources concurrently with per-source timeouts.
+
+    The last good value of every source is remembered between calls to
+    :meth:`fetch`, so a long-running process can fall back on it.
+
+    Attributes
+    ----------
+    last_good: dict
+        The last value each source returned successfully.
+    latency: dict
+        The time each source took in the last call to :meth:`fetch` [s].
+        Sources that timed out report the time that was waited for them.
+    timed_out: set
+        The sources that missed their deadline or failed in the last call.
+    """
+    def __init__(self):
+        self.last_good = {}
+        self.latency = {}
+        self.timed_out = set()
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._cycle = 0
+
+    def fetch(self, fetchers, timeouts, default_timeout=60.):
+        """
+        Runs every fetcher concurrently and collects the results.
+
+        Parameters
+        ----------
+        fetchers: dict
+            Maps each source name to a callable taking no arguments.
+        timeouts: dict
+            Maps source names to their deadline in seconds, measured from
+            the start of the call.
+        default_timeout: float
+            The deadline for sources not listed in timeouts [s].
+
+        Returns
+        -------
+        results: dict
+            Maps each source name to its value, the last good value if it
+            missed its deadline, or None if it never returned successfully.
+        """
+        start = time.perf_counter()
+        done = {name: threading.Event() for name in fetchers}
+        outcome = {}
+        abandoned = set()
+        with self._lock:
+            self._cycle += 1
+            cycle = self._cycle
+
+        def run(name, func):
+            try:
+                result = (True, func())
+            except Exception:
+                traceback.print_exc()
+                result = (False, None)
+            # A thread given up on, or left over from an earlier call, must
+            # not overwrite what the current call reports
+            with self._lock:
+                if cycle != self._cycle or name in abandoned:
+                    return
+                outcome[name] = result
+                self.latency[name] = time.perf_counter() - start
+                done[name].set()
+
+        for name, func in fetchers.items():
+            previous = self._threads.get(name)
+            if previous is not None and previous.is_alive():
+                print("%s is still running from an earlier cycle, not fetching it again" % name)
+                outcome[name] = (False, None)
+                self.latency[name] = 0.
+                done[name].set()
+                continue
+            # Daemon threads so that a hung source cannot keep the process alive
+            thread = threading.Thread(target=run, args=(name, func), daemon=True,
+                                      name="fetch-%s" % name)
+            self._threads[name] = thread
+            thread.start()
+
+        results = {}
+        self.timed_out = set()
+        for name in fetchers:
+            deadline = timeouts.get(name, default_timeout)
+            remaining = max(deadline - (time.perf_counter() - start), 0.)
+            done[name].wait(remaining)
+            with self._lock:
+                finished = done[name].is_set()
+                if not finished:
+                    abandoned.add(name)
+                    self.latency[name] = time.perf_counter() - start
+            if finished and outcome[name][0]:
+                results[name] = outcome[name][1]
+                self.last_good[name] = results[name]
+            else:
+                if not finished:
+                    print("%s did not respond within %.1f s" % (name, deadline))
+                self.timed_out.add(name)
+                results[name] = self.last_good.get(name)
+            print("Fetched %s in %.2f s" % (name, self.latency[name]))
+        return results
@@ -0,0 +1,138 @@
+"""
+Sweep segmentation for Halo Photonics Doppler lidar scans.
+
+A User file can mix PPIs, RHIs and stares. The rays are grouped into dwells
+(consecutive rays at the same azimuth and elevation), and the steps between
+dwells are classified in one vectorized pass as azimuth-only (PPI),
+elevation-only (RHI) or both (a transition between sweeps). Chains of dwells
+joined by the same kind of step form a sweep, split again whenever the scan
+reverses direction or, for PPIs, completes a full revolution. Dwells that are
+long enough to be stares form sweeps of their own.
+"""
+import numpy as np
+
+PPI = 1
+RHI = 2
+TRANSITION = 3
+
+
+def _wrap(angle):
+    # Wraps angle differences into [-180, 180)
+    return np.mod(angle + 180., 360.) - 180.
+
+
+def _no_sweeps(n_rays):
+    return {'sweep_number': np.zeros(0, dtype=np.int32),
+            'sweep_mode': np.zeros(0, dtype='U32'),
+            'fixed_angle': np.zeros(0),
+            'sweep_start_ray_index': np.zeros(0, dtype=np.int32),
+            'sweep_end_ray_index': np.zeros(0, dtype=np.int32),
+            'ray_sweep': np.full(n_rays, -1, dtype=np.int32)}
+
+
+def segment_sweeps(azimuth, elevation, azimuth_tolerance=0.02,
+                   elevation_tolerance=0.01, stare_rays=10):
+    """
+    Splits the rays of a scan into sweeps.
+
+    Parameters
+    ----------
+    azimuth, elevation: float 1D array
+        The [rays] azimuth and elevation of each ray [degrees].
+    azimuth_tolerance, elevation_tolerance: float
+        Angle changes smaller than these are not counted as motion [degrees].
+    stare_rays: int
+        Dwells with at least this many rays are stares.
+
+    Returns
+    -------
+    sweeps: dict
+        The [sweep] sweep_number, sweep_mode, fixed_angle,
+        sweep_start_ray_index and sweep_end_ray_index (inclusive), and the
+        [rays] ray_sweep index of the sweep each ray belongs to, -1 for rays
+        in transitions between sweeps.
+    """
+    azimuth = np.asarray(azimuth, dtype=float)
+    elevation = np.asarray(elevation, dtype=float)
+    n_rays = azimuth.size
+    if n_rays == 0:
+        return _no_sweeps(0)
+
+    d_az = _wrap(np.diff(azimuth))
+    d_el = np.diff(elevation)
+    az_moves = np.abs(d_az) > azimuth_tolerance
+    el_moves = np.abs(d_el) > elevation_tolerance
+    step_kind = az_moves * PPI + el_moves * RHI
+
+    # Dwells, and the step that enters each one
+    dwell_start = np.concatenate([[0], np.flatnonzero(step_kind) + 1])
+    dwell_len = np.diff(np.append(dwell_start, n_rays))
+    n_dwells = dwell_start.size
+    kind_in = np.zeros(n_dwells, dtype=int)
+    kind_in[1:] = step_kind[dwell_start[1:] - 1]
+    kind_out = np.append(kind_in[1:], 0)
+    step_in = np.zeros(n_dwells)
+    step_in[1:] = np.where(kind_in[1:] == PPI, d_az[dwell_start[1:] - 1],
+                           d_el[dwell_start[1:] - 1])
+
+    stare = (dwell_len >= stare_rays) | (n_dwells == 1)
+    prev_stare = np.concatenate([[True], stare[:-1]])
+    next_stare = np.append(stare[1:], True)
+    chained_in = ((kind_in == PPI) | (kind_in == RHI)) & ~prev_stare
+    chained_out = ((kind_out == PPI) | (kind_out == RHI)) & ~next_stare
+    # A dwell joins the chain it was entered from; the first dwell of a
+    # chain joins the chain it leaves into.
+    mode = np.where(stare, 0, np.where(chained_in, kind_in,
+                                       np.where(chained_out, kind_out, TRANSITION)))
+
+    # Sweep breaks between dwells: a change of mode, a stare, a reversal of
+    # the scan direction, or a completed PPI revolution.
+    new_sweep = np.ones(n_dwells, dtype=bool)
+    same_chain = (mode[1:] == mode[:-1]) & chained_in[1:] & (mode[1:] != TRANSITION)
+    reversed_dir = np.zeros(n_dwells, dtype=bool)
+    reversed_dir[2:] = chained_in[1:-1] & (np.sign(step_in[2:]) != np.sign(step_in[1:-1]))
+    chain_id = np.cumsum(~np.concatenate([[False], same_chain]))
+    travel = np.cumsum(np.where(chained_in & (mode == PPI), np.abs(step_in), 0.))
+    travel = travel - travel[np.searchsorted(chain_id, chain_id)]
+    revolution = np.floor((travel + azimuth_tolerance) / 360.)
+    new_revolution = np.zeros(n_dwells, dtype=bool)
+    new_revolution[1:] = revolution[1:] != revolution[:-1]
+    new_sweep[1:] = ~same_chain | reversed_dir[1:] | new_revolution[1:]
+    in_sweep = mode != TRANSITION
+
+    dwell_sweep = np.where(in_sweep, np.cumsum(new_sweep & in_sweep) - 1, -1)
+    ray_sweep = np.repeat(dwell_sweep, dwell_len).astype(np.int32)
+    first_dwell = np.flatnonzero(new_sweep & in_sweep)
+    last_dwell = np.flatnonzero(in_sweep & np.append(dwell_sweep[1:] != dwell_sweep[:-1], True))
+    n_sweeps = first_dwell.size
+    if n_sweeps == 0:
+        return _no_sweeps(n_rays)
+    sweep_mode_code = mode[first_dwell]
+    start = dwell_start[first_dwell]
+    end = dwell_start[last_dwell] + dwell_len[last_dwell] - 1
+    counts = end - start + 1
+    in_ray = ray_sweep >= 0
+
+    # Fixed angles are the mean elevation of PPIs and stares and the
+    # (wrap-safe) mean azimuth of RHIs.
+    el_mean = np.add.reduceat(np.where(in_ray, elevation, 0.), start) / counts
+    az_offset = np.where(in_ray, _wrap(azimuth - azimuth[start[np.maximum(ray_sweep, 0)]]), 0.)
+    az_mean = np.mod(azimuth[start] + np.add.reduceat(az_offset, start) / counts, 360.)
+    fixed_angle = np.where(sweep_mode_code == RHI, az_mean, el_mean)
+
+    ray_step = np.where(in_ray, np.append(0., d_az), 0.)
+    ray_step[start] = 0.
+    sweep_travel = np.abs(np.add.reduceat(ray_step, start))
+    median_step = np.median(np.abs(d_az[az_moves])) if np.any(az_moves) else 0.
+    sweep_mode = np.where(
+        sweep_mode_code == RHI, 'rhi',
+        np.where(sweep_mode_code == PPI,
+                 np.where(sweep_travel + median_step >= 360. - azimuth_tolerance,
+                          'azimuth_surveillance', 'sector'),
+                 np.where(fixed_angle >= 89., 'vertical_pointing', 'pointing'))).astype('U32')
+    return {'sweep_number': np.arange(n_sweeps, dtype=np.int32),
+            'sweep_mode': sweep_mode,
+            'fixed_angle': fixed_angle,
+            'sweep_start_ray_index': start.astype(np.int32),
+            'sweep_end_ray_index': end.astype(np.int32),
+            'ray_sweep': ray_sweep}
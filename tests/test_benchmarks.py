@@ -0,0 +1,17 @@
+import numpy as np
+
+import utils
+from benchmarks import read_as_netcdf_float64, write_synthetic_hpl
+
+
+def test_float64_construction_matches_read_as_netcdf(tmp_path):
+    file_path = str(tmp_path / 'User2_test.hpl')
+    elevation = np.repeat([45., 60., 75.], 20)
+    write_synthetic_hpl(file_path, 60, 30, elevation=elevation)
+    old = read_as_netcdf_float64(file_path)
+    new = utils.read_as_netcdf(file_path, 0., 0., 0.)
+    for name in ['radial_velocity', 'beta', 'intensity', 'spectral_width']:
+        assert old[name].dtype == np.float64
+        np.testing.assert_allclose(old[name].values, new[name].values, rtol=1e-6)
+    np.testing.assert_array_equal(old['time'].values, new['time'].values)
+    assert np.all(old['reflectivity'].values == -99.)
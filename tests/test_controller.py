@@ -0,0 +1,46 @@
+import datetime
+
+import pytest
+
+import send_scan_to_lidar_csm as controller
+import utils
+from benchmarks import write_synthetic_hpl
+
+CUR_TIME = datetime.datetime(2024, 6, 1, 12, 30)
+
+
+@pytest.fixture
+def args():
+    return controller.parse_args([])
+
+
+@pytest.fixture
+def no_download(monkeypatch):
+    monkeypatch.setattr(controller, 'get_file', lambda *a, **k: 0)
+
+
+def _write(tmp_path, name, elevation, hour=12):
+    write_synthetic_hpl(str(tmp_path / name), 40, 20, hour=hour, elevation=elevation)
+
+
+def test_vertical_stares_are_not_a_ppi(tmp_path, args, no_download):
+    # The oldest file is never read
+    _write(tmp_path, 'User2_1_20240601_100000.hpl', 60., hour=10)
+    _write(tmp_path, 'User2_1_20240601_120000.hpl', 90.)
+    assert controller.fetch_lidar(args, None, CUR_TIME, local_dir=str(tmp_path)) is None
+
+
+def test_older_ppi_is_used_after_vertical_stares(tmp_path, args, no_download):
+    _write(tmp_path, 'User2_1_20240601_100000.hpl', 60., hour=10)
+    _write(tmp_path, 'User2_1_20240601_110000.hpl', 60., hour=11)
+    _write(tmp_path, 'User2_1_20240601_120000.hpl', 90.)
+    ds = controller.fetch_lidar(args, None, CUR_TIME, local_dir=str(tmp_path))
+    assert ds.sizes['time'] == 40
+    assert float(ds['elevation'].max()) == pytest.approx(60.)
+
+
+def test_vad_wind_without_rays(tmp_path, args):
+    _write(tmp_path, 'User2_1_20240601_120000.hpl', 90.)
+    ds = utils.read_as_netcdf(str(tmp_path / 'User2_1_20240601_120000.hpl'), 0., 0., 0.)
+    ds = ds.where(ds.elevation < 89., drop=True).drop_dims('sweep')
+    assert controller.vad_wind(args, ds) is None
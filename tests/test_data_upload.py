@@ -0,0 +1,82 @@
+import datetime
+import gzip
+import os
+
+import pytest
+
+from data_upload import UploadQueue
+
+NOW = datetime.datetime(2024, 6, 1, 13, 5)
+NAMES = ['User2_1_20240601_110000.hpl', 'User2_1_20240601_120000.hpl',
+         'User2_1_20240601_130000.hpl', 'Stare_1_20240601_120000.hpl']
+
+
+class FakePlugin(object):
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.uploaded = []
+        self.published = []
+
+    def upload_file(self, path, meta=None, timestamp=None, keep=False):
+        if any(name in path for name in self.fail):
+            raise IOError("upload failed")
+        with gzip.open(path, 'rb') as f:
+            self.uploaded.append((os.path.basename(path), f.read()))
+
+    def publish(self, name, value, meta=None, timestamp=None):
+        self.published.append((name, value))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    for name in NAMES:
+        (tmp_path / name).write_bytes(name.encode() * 100)
+    return tmp_path
+
+
+def test_sends_completed_user_files_once(data_dir):
+    state = str(data_dir / 'state.json')
+    plugin = FakePlugin()
+    sent = UploadQueue(state, staging_dir=str(data_dir / 'staging')).run(plugin, str(data_dir), NOW)
+    assert sorted(os.path.basename(p) for p in sent) == NAMES[:2]
+    assert plugin.uploaded[0][1] == (data_dir / plugin.uploaded[0][0][:-3]).read_bytes()
+    assert ('lidar.upload_backlog', 0) in plugin.published
+
+    # A new queue resumes from the state file
+    again = FakePlugin()
+    assert UploadQueue(state).run(again, str(data_dir), NOW) == []
+    assert again.uploaded == []
+
+
+def test_failed_uploads_are_retried(data_dir):
+    state = str(data_dir / 'state.json')
+    plugin = FakePlugin(fail=['110000'])
+    UploadQueue(state, staging_dir=str(data_dir / 'staging')).run(plugin, str(data_dir), NOW)
+    assert ('lidar.upload_backlog', 1) in plugin.published
+    assert not os.listdir(str(data_dir / 'staging'))
+
+    queue = UploadQueue(state, staging_dir=str(data_dir / 'staging'))
+    assert queue.failed == {NAMES[0]: 1}
+    assert [os.path.basename(p) for p in queue.pending(str(data_dir), NOW)] == [NAMES[0]]
+    retry = FakePlugin()
+    queue.run(retry, str(data_dir), NOW)
+    assert [name for name, data in retry.uploaded] == [NAMES[0] + '.gz']
+    assert queue.failed == {}
+
+
+def test_grown_file_is_sent_again(data_dir):
+    queue = UploadQueue(staging_dir=str(data_dir / 'staging'))
+    queue.run(FakePlugin(), str(data_dir), NOW)
+    with open(str(data_dir / NAMES[1]), 'ab') as f:
+        f.write(b'more rays')
+    assert [os.path.basename(p) for p in queue.pending(str(data_dir), NOW)] == [NAMES[1]]
+
+
+def test_local_files_are_kept_unless_pruning(data_dir):
+    UploadQueue(staging_dir=str(data_dir / 'staging')).run(FakePlugin(), str(data_dir), NOW)
+    assert all((data_dir / name).exists() for name in NAMES)
+    UploadQueue(staging_dir=str(data_dir / 'staging'), keep_local=False).run(
+        FakePlugin(), str(data_dir), NOW)
+    # The previous hour is still downloaded every cycle, so it is kept
+    assert not (data_dir / NAMES[0]).exists()
+    assert (data_dir / NAMES[1]).exists()
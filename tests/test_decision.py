@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from decision import make_rules, plan_scan, trigger_plan
+from scan_strategy import AZ_COUNTS_PER_ROT
+from scan_timing import estimate_plan, parse_csm
+
+
+@pytest.mark.parametrize('direction,offset,expected', [
+    (180., 0., [150., 210.]),
+    (250., 100., [320., 380.]),
+    (10., 0., [340., 400.]),
+    (0., 0., [330., 390.]),
+])
+def test_ppi_cone_through_north(direction, offset, expected):
+    rules = make_rules(trigger_scan='ppis', cone_width=60., az_offset=offset)
+    plan = trigger_plan(10., direction, rules)
+    np.testing.assert_allclose(plan.azimuths, expected)
+    assert plan.azimuths[1] - plan.azimuths[0] == pytest.approx(60.)
+    assert 0. <= plan.azimuths[0] < 360.
+
+
+@pytest.mark.parametrize('scan', ['hsrhi', 'rhi', 'stepped_rhi'])
+def test_along_wind_azimuth_offset(scan):
+    rules = make_rules(trigger_scan=scan, az_offset=30.)
+    np.testing.assert_allclose(trigger_plan(10., 350., rules).azimuths, [20.])
+
+
+def test_plan_scan_default_below_threshold():
+    rules = make_rules(threshold=5.)
+    plan = plan_scan(1., 180., rules)
+    assert not plan.trigger and plan.name == 'vad'
+    assert plan_scan(10., 180., rules).trigger
+
+
+def test_cone_through_north_compiles_to_a_short_sweep():
+    rules = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=2.,
+                       cone_width=60.)
+    north = trigger_plan(10., 0., rules)
+    south = trigger_plan(10., 180., rules)
+    waypoints = parse_csm(north.compile(), dyn_csm=False)
+    # The end is encoded past one rotation, at 390 degrees rather than 30
+    assert b'P.1=%d*' % -int(390. * AZ_COUNTS_PER_ROT / 360.) in north.compile()
+    np.testing.assert_allclose(np.unique(np.round(waypoints['position'][:, 0], 3)), [330., 390.])
+    # The sector is swept through north, as fast as the same sector facing south
+    assert estimate_plan(north)['total_seconds'] == \
+        pytest.approx(estimate_plan(south)['total_seconds'])
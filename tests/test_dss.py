@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from dss import build_schedule, build_schedules, diff_schedules, make_dss_rule, parse_dss
+
+WFIP3_RULES = [{'scan': 'profile', 'start': '00:00:00', 'end': '00:10:00',
+                'period': '01:00:00', 'step': 5}]
+
+
+def _entries(schedule):
+    return list(zip(schedule.seconds.tolist(), schedule.scans.tolist()))
+
+
+def test_wfip3_schedule_is_byte_identical():
+    # The loop make_wfip3_dss.py used before it was moved to rules
+    expected = ""
+    start_time = datetime(2020, 3, 14)
+    while start_time < datetime(2020, 3, 15):
+        if start_time.minute < 10:
+            expected += "%s\tprofile\t1\tS\t0\r\n" % start_time.strftime('%H%M%S')
+        start_time = start_time + timedelta(seconds=5)
+    text = build_schedule(WFIP3_RULES, '2020-03-14').to_text()
+    assert text == expected.encode('ascii')
+    assert len(text.splitlines()) == 2880
+
+
+def test_priority_overlap_and_restart():
+    rules = [{'scan': 'vad', 'step': 600},
+             {'scan': 'rhi', 'start': '01:00:00', 'end': '01:02:30', 'step': 60,
+              'priority': 1}]
+    entries = _entries(build_schedule(rules, '2024-06-01'))
+    window = [entry for entry in entries if 3000 <= entry[0] < 4300]
+    # The VAD restarts as soon as the RHI window ends, off its own steps
+    assert window == [(3000, 'vad'), (3600, 'rhi'), (3660, 'rhi'), (3720, 'rhi'),
+                      (3750, 'vad'), (4200, 'vad')]
+
+
+def test_ties_go_to_the_earlier_rule():
+    rules = [{'scan': 'first', 'step': 3600}, {'scan': 'second', 'step': 3600}]
+    assert set(build_schedule(rules, '2024-06-01').scans.tolist()) == {'first'}
+
+
+def test_weekdays_and_date_range():
+    rules = [{'scan': 'vad', 'step': 3600},
+             {'scan': 'weekend', 'step': 3600, 'priority': 1, 'weekdays': [5, 6]},
+             {'scan': 'campaign', 'start': '12:00', 'end': '13:00', 'step': 3600,
+              'priority': 2, 'first_date': '2024-06-02', 'last_date': '2024-06-02'}]
+    schedules = build_schedules(rules, ['2024-06-01', '2024-06-02', '2024-06-03'])
+    # 2024-06-01 is a Saturday
+    assert set(schedules['2024-06-01'].scans.tolist()) == {'weekend'}
+    assert set(schedules['2024-06-02'].scans.tolist()) == {'weekend', 'campaign'}
+    assert (12 * 3600, 'campaign') in _entries(schedules['2024-06-02'])
+    assert set(schedules['2024-06-03'].scans.tolist()) == {'vad'}
+
+
+def test_parse_and_diff_round_trip():
+    schedule = build_schedule(WFIP3_RULES, '2020-03-14')
+    assert parse_dss(schedule.to_text()) == schedule
+    assert diff_schedules(schedule, schedule.to_text().replace(b'\r\n', b'\n')) == []
+    changed = build_schedule([dict(WFIP3_RULES[0], end='00:09:55')], '2020-03-14')
+    diff = diff_schedules(changed, schedule)
+    removed = [line for line in diff if line.startswith('-') and not line.startswith('---')]
+    assert removed == ['-%02d0955\tprofile\t1\tS\t0' % hour for hour in range(24)]
+    assert not [line for line in diff if line.startswith('+') and not line.startswith('+++')]
+
+
+@pytest.mark.parametrize('rule', [{'scan': 'vad', 'speed': 1},
+                                  {'step': 5},
+                                  {'scan': 'vad', 'end': '02:00', 'period': '01:00'},
+                                  {'scan': 'vad', 'step': 0}])
+def test_bad_rules(rule):
+    with pytest.raises(ValueError):
+        make_dss_rule(**rule)
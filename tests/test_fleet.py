@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+import fleet
+import send_scan_to_lidar_csm as controller
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = str(tmp_path / 'fleet.json')
+    with open(path, 'w') as f:
+        json.dump({'lidars': [{'name': name, 'host': '10.0.0.%d' % i,
+                               'work_dir': str(tmp_path / name)}
+                              for i, name in enumerate(['nant', 'mvco'])]}, f)
+    return path
+
+
+@pytest.mark.parametrize('argv,queues', [
+    ([], False),
+    (['--trigger_sonic', 'sonic'], False),
+    (['--trigger_node_hub_height', 'W0A1'], True),
+])
+def test_upload_queues_only_for_the_node_trigger(config, argv, queues):
+    lidars = fleet.load_fleet(config, controller.parse_args(argv))
+    try:
+        assert [lidar.data_uploads is not None for lidar in lidars.lidars] == [queues, queues]
+    finally:
+        lidars.close()
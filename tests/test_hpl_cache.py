@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import write_synthetic_hpl
+from hpl_cache import GATE_FIELDS, RAY_FIELDS, HplCache
+
+N_RAYS = 40
+N_GATES = 20
+
+
+def _ray_offsets(file_path):
+    return [chunk['offset'] for chunk in utils.iter_hpl_chunks(file_path, chunk_size=1)]
+
+
+def _assert_same(cached, parsed):
+    assert cached['no_of_rays_in_file'] == parsed['decimal_time'].size
+    for name in RAY_FIELDS + GATE_FIELDS:
+        np.testing.assert_array_equal(cached[name], parsed[name])
+
+
+@pytest.fixture
+def hpl(tmp_path):
+    full = str(tmp_path / 'full.hpl')
+    write_synthetic_hpl(full, N_RAYS, N_GATES)
+    with open(full, 'rb') as f:
+        contents = f.read()
+    return str(tmp_path / 'User1_20240101_12.hpl'), full, contents, _ray_offsets(full)
+
+
+def _write(file_path, contents, mtime_ns=None):
+    with open(file_path, 'wb') as f:
+        f.write(contents)
+    if mtime_ns is not None:
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+
+def test_grown_file_parses_only_new_rays(tmp_path, hpl, capsys):
+    file_path, full, contents, offsets = hpl
+    cache = HplCache(str(tmp_path / 'cache'), chunk_size=7)
+    _write(file_path, contents[:offsets[24]])
+    _assert_same(cache.load(file_path), utils.hpl2dict(file_path))
+    _write(file_path, contents, mtime_ns=os.stat(file_path).st_mtime_ns + 10 ** 9)
+    capsys.readouterr()
+    _assert_same(cache.load(file_path), utils.hpl2dict(full))
+    assert "Parsed 15 new rays" in capsys.readouterr().out
+    _assert_same(cache.load(file_path), utils.hpl2dict(full))
+    assert "Parsed" not in capsys.readouterr().out
+
+
+def test_rewrite_at_same_size_invalidates(tmp_path, hpl):
+    file_path, full, contents, offsets = hpl
+    cache = HplCache(str(tmp_path / 'cache'))
+    _write(file_path, contents)
+    cache.load(file_path)
+    # Same size, different pitch
+    rewritten = contents.replace(b'  0.10 ', b'  0.20 ')
+    assert len(rewritten) == len(contents) and rewritten != contents
+    _write(file_path, rewritten, mtime_ns=os.stat(file_path).st_mtime_ns + 10 ** 9)
+    data = cache.load(file_path)
+    np.testing.assert_allclose(data['pitch'], 0.2)
+    _assert_same(data, utils.hpl2dict(file_path))
+
+
+def test_shrunk_file_invalidates(tmp_path, hpl):
+    file_path, full, contents, offsets = hpl
+    cache = HplCache(str(tmp_path / 'cache'))
+    _write(file_path, contents)
+    cache.load(file_path)
+    _write(file_path, contents[:offsets[9]])
+    data = cache.load(file_path)
+    assert data['no_of_rays_in_file'] == 10
+    _assert_same(data, utils.hpl2dict(file_path))
+
+
+def test_interrupted_update_is_ignored(tmp_path, hpl):
+    file_path, full, contents, offsets = hpl
+    cache = HplCache(str(tmp_path / 'cache'))
+    _write(file_path, contents[:offsets[19]])
+    cache.load(file_path)
+    # Rays appended to the variable files before an update was cut short,
+    # without a matching index entry
+    entry_dir = os.path.join(cache.cache_dir, os.path.basename(file_path))
+    for name in os.listdir(entry_dir):
+        if name != 'meta.json':
+            with open(os.path.join(entry_dir, name), 'ab') as f:
+                f.write(np.arange(3 * N_GATES, dtype='<f8').tobytes())
+    _assert_same(cache.load(file_path), utils.hpl2dict(file_path))
+    _write(file_path, contents)
+    _assert_same(cache.load(file_path), utils.hpl2dict(full))
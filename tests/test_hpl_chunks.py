@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import write_synthetic_hpl
+
+N_GATES = 10
+
+
+@pytest.fixture
+def hpl(tmp_path):
+    full = str(tmp_path / 'full.hpl')
+    write_synthetic_hpl(full, 12, N_GATES)
+    with open(full, 'rb') as f:
+        contents = f.read()
+    offsets = [chunk['offset'] for chunk in utils.iter_hpl_chunks(full, chunk_size=1)]
+    return str(tmp_path / 'partial.hpl'), full, contents, offsets
+
+
+@pytest.mark.parametrize('cut', [1, 5, 8])
+def test_unterminated_last_line_is_left_for_later(hpl, cut):
+    partial, full, contents, offsets = hpl
+    # Cut the last gate line of the 8th ray short, keeping its values parseable
+    with open(partial, 'wb') as f:
+        f.write(contents[:offsets[7] - cut])
+    chunks = list(utils.iter_hpl_chunks(partial, chunk_size=3))
+    assert sum(chunk['decimal_time'].size for chunk in chunks) == 7
+    assert chunks[-1]['offset'] == offsets[6]
+
+    with open(partial, 'wb') as f:
+        f.write(contents)
+    rest = list(utils.iter_hpl_chunks(partial, chunk_size=3, offset=chunks[-1]['offset']))
+    parsed = utils.hpl2dict(full)
+    for name in ['decimal_time', 'azimuth', 'elevation']:
+        np.testing.assert_array_equal(
+            np.concatenate([chunk[name] for chunk in chunks + rest]), parsed[name])
+    for name in ['radial_velocity', 'beta']:
+        np.testing.assert_array_equal(
+            np.concatenate([chunk[name] for chunk in chunks + rest]), parsed[name].T)
@@ -0,0 +1,19 @@
+import sys
+import types
+
+from lazy_imports import lazy_import, preload
+
+
+def test_preload_loads_lazy_modules(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'wave', raising=False)
+    module = lazy_import('wave')
+    assert type(module) is not types.ModuleType
+    preload(module)
+    assert type(module) is types.ModuleType
+    assert hasattr(module, 'open')
+
+
+def test_preload_skips_missing_modules():
+    missing = lazy_import('not_a_real_module_xyz')
+    preload(missing)
+    assert missing.__name__ == 'not_a_real_module_xyz'
@@ -0,0 +1,134 @@
+import threading
+import time
+
+import paramiko
+import pytest
+
+import lidar_connection
+from lidar_connection import LidarConnection
+
+
+class FakeTransport(object):
+    def __init__(self, sock):
+        self.active = True
+        self.closed = False
+
+    def connect(self, username=None, password=None):
+        pass
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+        self.closed = True
+
+
+class FakeSFTP(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_link(monkeypatch):
+    opened = []
+    sleeps = []
+
+    def from_transport(transport):
+        sftp = FakeSFTP(transport)
+        opened.append(sftp)
+        return sftp
+
+    monkeypatch.setattr(lidar_connection.socket, 'create_connection', lambda *a, **k: object())
+    monkeypatch.setattr(lidar_connection.paramiko, 'Transport', FakeTransport)
+    monkeypatch.setattr(lidar_connection.paramiko.SFTPClient, 'from_transport',
+                        staticmethod(from_transport))
+    monkeypatch.setattr(lidar_connection.time, 'sleep', sleeps.append)
+    return opened, sleeps
+
+
+def test_connects_on_first_use_and_reuses_the_session(fake_link):
+    opened, sleeps = fake_link
+    connection = LidarConnection('lidar', 'user', 'pwd')
+    assert opened == []
+    first = connection.call(lambda sftp: sftp)
+    assert connection.call(lambda sftp: sftp) is first
+    assert len(opened) == 1
+
+
+def test_reconnects_after_the_link_drops(fake_link):
+    opened, sleeps = fake_link
+    connection = LidarConnection('lidar', 'user', 'pwd')
+    first = connection.call(lambda sftp: sftp)
+    first.transport.active = False
+    second = connection.call(lambda sftp: sftp)
+    assert second is not first and len(opened) == 2
+    assert sleeps == []
+
+
+def test_retries_with_backoff(fake_link):
+    opened, sleeps = fake_link
+    connection = LidarConnection('lidar', 'user', 'pwd', max_retries=3, backoff=2.)
+    failures = [paramiko.SSHException('reset'), EOFError()]
+
+    def flaky(sftp):
+        if failures:
+            raise failures.pop(0)
+        return 'ok'
+
+    assert connection.call(flaky) == 'ok'
+    assert sleeps == [2., 4.]
+    assert len(opened) == 3
+    assert all(sftp.transport.closed for sftp in opened[:2])
+
+
+def test_gives_up_after_max_retries(fake_link):
+    opened, sleeps = fake_link
+    connection = LidarConnection('lidar', 'user', 'pwd', max_retries=2, backoff=1.)
+
+    def broken(sftp):
+        raise paramiko.SSHException('down')
+
+    with pytest.raises(paramiko.SSHException):
+        connection.call(broken)
+    assert sleeps == [1., 2.]
+
+
+def test_operations_from_threads_take_turns(fake_link):
+    connection = LidarConnection('lidar', 'user', 'pwd')
+    active = []
+    overlaps = []
+
+    def operation(sftp):
+        active.append(1)
+        overlaps.append(len(active))
+        threading.Event().wait(0.01)
+        active.pop()
+
+    threads = [threading.Thread(target=connection.call, args=(operation,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1, 1, 1, 1]
+
+
+def test_busy_connection_times_out(fake_link):
+    connection = LidarConnection('lidar', 'user', 'pwd', lock_timeout=0.05)
+    release = threading.Event()
+    started = threading.Event()
+
+    def hung(sftp):
+        started.set()
+        release.wait(5.)
+
+    thread = threading.Thread(target=connection.call, args=(hung,))
+    thread.start()
+    started.wait(5.)
+    with pytest.raises(TimeoutError):
+        connection.call(lambda sftp: None)
+    release.set()
+    thread.join()
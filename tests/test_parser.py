@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import write_synthetic_hpl
+
+KEYS = ['radial_velocity', 'intensity', 'beta', 'spectral_width',
+        'azimuth', 'elevation', 'pitch', 'roll', 'decimal_time']
+
+
+@pytest.mark.parametrize('n_cols', [4, 5])
+@pytest.mark.parametrize('n_rays', [1, 37])
+def test_bulk_parser_matches_loop(tmp_path, n_cols, n_rays):
+    file_path = str(tmp_path / 'User2_test.hpl')
+    write_synthetic_hpl(file_path, n_rays, 25, n_cols=n_cols,
+                        elevation=np.linspace(10., 80., n_rays))
+    fast = utils.hpl2dict(file_path)
+    slow = utils.hpl2dict_loop(file_path)
+    for key in KEYS:
+        np.testing.assert_array_equal(fast[key], slow[key])
+    assert fast['radial_velocity'].shape == (25, n_rays)
+    assert fast['no_of_rays_in_file'] == slow['no_of_rays_in_file'] == n_rays
+    if n_cols == 4:
+        assert np.all(np.isnan(fast['spectral_width']))
+    for key in ['number_of_gates', 'range_gate_length_m', 'start_time']:
+        assert fast[key] == slow[key]
+
+
+def test_streamed_reader_matches_bulk_parser(tmp_path):
+    file_path = str(tmp_path / 'User2_test.hpl')
+    write_synthetic_hpl(file_path, 40, 25)
+    parsed = utils.hpl2dict(file_path)
+    chunks = list(utils.iter_hpl_chunks(file_path, chunk_size=7))
+    np.testing.assert_array_equal(np.concatenate([c['azimuth'] for c in chunks]),
+                                  parsed['azimuth'])
+    np.testing.assert_array_equal(np.concatenate([c['beta'] for c in chunks]).T,
+                                  parsed['beta'])
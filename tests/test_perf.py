@@ -0,0 +1,49 @@
+import cProfile
+import os
+import threading
+
+import pytest
+
+from perf import CycleProfiler
+
+
+def _busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_wrapped_threads_are_merged_into_the_dump(tmp_path):
+    profiler = CycleProfiler(str(tmp_path))
+    results = []
+    with profiler.profile():
+        wrapped = profiler.wrap(lambda: results.append(_busy(10000)))
+        thread = threading.Thread(target=wrapped)
+        thread.start()
+        thread.join()
+    assert results == [_busy(10000)]
+    assert len(profiler.thread_profiles) == 1
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_runs_unprofiled_when_a_profiler_is_active(tmp_path, monkeypatch):
+    # What cProfile does from Python 3.12 when another profiler is enabled
+    def enable(self, *args, **kwargs):
+        raise ValueError("Another profiling tool is already active")
+    monkeypatch.setattr(cProfile.Profile, 'enable', enable)
+    profiler = CycleProfiler(str(tmp_path))
+    ran = []
+    with profiler.profile():
+        assert profiler.wrap(_busy)(100) == _busy(100)
+        ran.append(True)
+    assert ran == [True]
+    assert profiler.thread_profiles == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_wrapped_errors_propagate(tmp_path):
+    profiler = CycleProfiler(str(tmp_path))
+
+    def fail():
+        raise RuntimeError('boom')
+    with pytest.raises(RuntimeError):
+        profiler.wrap(fail)()
+    assert len(profiler.thread_profiles) == 1
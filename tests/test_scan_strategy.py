@@ -0,0 +1,57 @@
+import numpy as np
+
+from decision import make_rules, trigger_plan
+from scan_strategy import StrategyUploader, _compile_scan, compile_scan, strategy_hash
+
+
+def test_compile_scan_is_stable():
+    first = compile_scan(np.arange(0., 180., 2.), [180.], azi_speed=2., el_speed=1.)
+    again = compile_scan(list(np.arange(0., 180., 2.)), (180.,), azi_speed=2, el_speed=1)
+    assert first == again
+    assert strategy_hash(first) == strategy_hash(again)
+    header = first.split(b'\r\n')[:3]
+    assert header == [b'7', b'90', b'2']
+
+
+def test_compile_scan_dyn_csm_has_no_header():
+    strategy = compile_scan([10.], [0., 90.], dyn_csm=True)
+    assert strategy.startswith(b'A.1=')
+    assert strategy.count(b'\r\n') == 4
+
+
+def test_small_direction_changes_give_the_same_strategy():
+    rules = make_rules(trigger_scan='hsrhi')
+    _compile_scan.cache_clear()
+    strategies = {trigger_plan(10., direction, rules).compile()
+                  for direction in [179.83, 180.04, 180.4]}
+    assert len(strategies) == 1
+    assert _compile_scan.cache_info().hits == 2
+    assert trigger_plan(10., 181., rules).compile() not in strategies
+
+
+def test_direction_step_zero_keeps_the_direction():
+    rules = make_rules(trigger_scan='hsrhi', direction_step=0.)
+    assert trigger_plan(10., 180.04, rules).compile() != trigger_plan(10., 179.83, rules).compile()
+
+
+class _FakeConnection(object):
+    host = 'lidar'
+
+    def __init__(self):
+        self.puts = []
+
+    def call(self, func):
+        class SFTP(object):
+            def putfo(sftp, file_obj, path):
+                self.puts.append((path, file_obj.read()))
+        return func(SFTP())
+
+
+def test_uploader_skips_unchanged(tmp_path):
+    connection = _FakeConnection()
+    state = str(tmp_path / 'state.json')
+    strategy = compile_scan([5.], [0., 90.])
+    assert StrategyUploader(state).upload(connection, strategy, '/user.txt')
+    assert not StrategyUploader(state).upload(connection, strategy, '/user.txt')
+    assert StrategyUploader(state).upload(connection, strategy + b'W0\r\n', '/user.txt')
+    assert len(connection.puts) == 2
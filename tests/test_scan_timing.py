@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from decision import make_rules, trigger_plan
+from scan_timing import angular_coverage, estimate_plan, optimize_rules
+
+SPEEDS = [0.5, 1., 2., 3., 5., 10.]
+
+
+@pytest.mark.parametrize('direction', [0., 90., 180., 350.])
+def test_ppis_fit_whatever_the_direction(direction):
+    rules = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=2.)
+    best, timing = optimize_rules(rules, 120., steps=np.arange(1., 11.),
+                                  cone_widths=np.arange(20., 181., 20.), speeds=SPEEDS,
+                                  direction=direction)
+    assert best is not None
+    assert timing['total_seconds'] <= 120.
+    reference, _ = optimize_rules(rules, 120., steps=np.arange(1., 11.),
+                                  cone_widths=np.arange(20., 181., 20.), speeds=SPEEDS)
+    assert (best['step'], best['cone_width'], best['speed']) == \
+        (reference['step'], reference['cone_width'], reference['speed'])
+
+
+def test_rhi_gets_the_slowest_speed_that_fits():
+    rules = make_rules(trigger_scan='rhi', min_angle=2., max_angle=90.)
+    best, timing = optimize_rules(rules, 120., speeds=SPEEDS)
+    fits = [speed for speed in SPEEDS if estimate_plan(trigger_plan(
+        np.inf, 0., make_rules(**dict(rules, speed=speed))))['total_seconds'] <= 120.]
+    assert best['speed'] == min(fits)
+
+
+def test_coverage_grows_with_the_cone():
+    narrow = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=2., cone_width=40.)
+    wide = make_rules(**dict(narrow, cone_width=80.))
+    assert angular_coverage(trigger_plan(np.inf, 0., wide), wide)[0] == \
+        pytest.approx(2 * angular_coverage(trigger_plan(np.inf, 0., narrow), narrow)[0])
+
+
+def test_coverage_stops_at_max_angle():
+    # Elevations 2, 10 and 18: the top band is cut off at 20 degrees
+    rules = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=8., cone_width=60.)
+    coverage, resolution = angular_coverage(trigger_plan(np.inf, 0., rules), rules)
+    assert coverage == pytest.approx(60. * 18.)
+    assert resolution == pytest.approx(8. * rules['speed'])
+
+
+def test_coarse_step_past_max_angle_loses():
+    rules = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=2.)
+    # Both steps cover 2 to 20 degrees within the budget, step 8 only at a
+    # slower speed, but step 2 resolves it more finely
+    best, timing = optimize_rules(rules, 300., steps=[2., 8.], cone_widths=[60.], speeds=SPEEDS)
+    assert best['step'] == 2.
+    assert timing['total_seconds'] <= 300.
+
+
+def test_nothing_fits_a_tiny_budget():
+    rules = make_rules(trigger_scan='ppis', min_angle=2., max_angle=20., step=2.)
+    assert optimize_rules(rules, 1., speeds=SPEEDS) == (None, None)
@@ -0,0 +1,65 @@
+import threading
+
+from sources import SourceFetcher
+
+
+def test_timed_out_source_is_not_fetched_again_while_running():
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(5.)
+        return 'late'
+
+    fetcher = SourceFetcher()
+    results = fetcher.fetch({'lidar': slow, 'node': lambda: 'ok'}, {'lidar': 0.05})
+    assert results == {'lidar': None, 'node': 'ok'}
+    assert fetcher.timed_out == {'lidar'}
+
+    results = fetcher.fetch({'lidar': slow}, {'lidar': 0.05})
+    assert results == {'lidar': None}
+    assert len(calls) == 1
+
+    release.set()
+    fetcher._threads['lidar'].join(5.)
+    results = fetcher.fetch({'lidar': lambda: 'fresh'}, {'lidar': 1.})
+    assert results == {'lidar': 'fresh'}
+    assert fetcher.last_good['lidar'] == 'fresh'
+
+
+def test_late_thread_does_not_overwrite_latency():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5.)
+        return 'late'
+
+    fetcher = SourceFetcher()
+    fetcher.fetch({'lidar': slow}, {'lidar': 0.05})
+    assert fetcher.latency['lidar'] < 0.5
+    # The next cycle runs while the abandoned thread is still hung
+    results = fetcher.fetch({'lidar': slow, 'node': lambda: 'ok'}, {'lidar': 0.05})
+    assert results == {'lidar': None, 'node': 'ok'}
+    threading.Event().wait(0.6)
+    release.set()
+    fetcher._threads['lidar'].join(5.)
+    assert fetcher.latency['lidar'] == 0.
+    assert 'lidar' not in fetcher.last_good
+
+
+def test_abandoned_thread_finishing_before_the_next_cycle():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5.)
+        return 'late'
+
+    fetcher = SourceFetcher()
+    fetcher.fetch({'lidar': slow}, {'lidar': 0.05})
+    waited = fetcher.latency['lidar']
+    threading.Event().wait(0.3)
+    release.set()
+    fetcher._threads['lidar'].join(5.)
+    assert fetcher.latency['lidar'] == waited
+    assert 'lidar' not in fetcher.last_good
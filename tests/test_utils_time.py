@@ -0,0 +1,45 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import write_synthetic_hpl
+
+
+def test_unwrap_hours_across_midnight():
+    hours = utils.unwrap_hours([23.5, 23.9, 0.1, 0.5, 23.99], 23.4)
+    np.testing.assert_allclose(hours, [23.5, 23.9, 24.1, 24.5, 23.99 + 24.])
+
+
+def test_unwrap_hours_first_ray_after_midnight():
+    # A file started just before midnight whose first ray is after it
+    np.testing.assert_allclose(utils.unwrap_hours([0.01, 0.02], 23.99), [24.01, 24.02])
+
+
+def test_unwrap_hours_empty():
+    assert utils.unwrap_hours([], 12.).size == 0
+    assert utils.decimal_time_to_datetime64([], datetime.datetime(2024, 6, 1, 12)).size == 0
+
+
+def test_datetime64_matches_per_ray_conversion():
+    start = datetime.datetime(2024, 6, 1, 23, 0)
+    rng = np.random.default_rng(0)
+    decimal_time = np.mod(23. + np.sort(rng.uniform(0., 2., 500)), 24.)
+    times = utils.decimal_time_to_datetime64(decimal_time, start)
+    hours = utils.unwrap_hours(decimal_time, 23.)
+    expected = np.array([utils.convert_to_hours_minutes_seconds(h, start) for h in hours],
+                        dtype='datetime64[ns]')
+    assert np.abs(times - expected).max() <= np.timedelta64(1, 'us')
+    assert np.all(np.diff(times) >= np.timedelta64(0, 'ns'))
+
+
+def test_dataset_times_are_monotonic_across_midnight(tmp_path):
+    file_path = str(tmp_path / 'User2_midnight.hpl')
+    write_synthetic_hpl(file_path, 120, 10, hour=23, ray_seconds=60.)
+    ds = utils.read_as_netcdf(file_path, 0., 0., 0.)
+    times = ds['time'].values
+    assert np.all(np.diff(times) > np.timedelta64(0, 'ns'))
+    # The decimal time is written to 1e-6 hours
+    span = times[-1] - times[0] - np.timedelta64(119, 'm')
+    assert abs(span) < np.timedelta64(4, 'ms')
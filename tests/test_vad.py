@@ -0,0 +1,55 @@
+import warnings
+
+import numpy as np
+import pytest
+
+import utils
+import vad
+from benchmarks import write_synthetic_hpl
+
+act = pytest.importorskip('act')
+
+WIND = (5., 3., 0.5)
+
+
+def _uv(speed, direction):
+    # Meteorological convention: the direction the wind blows from
+    direction = np.radians(direction)
+    return -speed * np.sin(direction), -speed * np.cos(direction)
+
+
+@pytest.fixture(scope='module')
+def ppi(tmp_path_factory):
+    file_path = str(tmp_path_factory.mktemp('vad') / 'User2_ppi.hpl')
+    # The synthetic writer draws its noise from a fixed seed
+    write_synthetic_hpl(file_path, 60, 50, wind=WIND)
+    ds = utils.read_as_netcdf(file_path, 0., 0., 0.)
+    return ds.where(ds.elevation < 89., drop=True).drop_dims('sweep')
+
+
+def test_winds_match_act(ppi):
+    act_ds = ppi.copy()
+    act_ds['signal_to_noise_ratio'] = act_ds['intensity'] - 1
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference = act.retrievals.compute_winds_from_ppi(act_ds, intensity_name='intensity')
+    winds = vad.compute_winds_from_ppi(ppi)
+
+    u, v = _uv(winds['wind_speed'].values, winds['wind_direction'].values)
+    u_act, v_act = _uv(reference['wind_speed'].values, reference['wind_direction'].values)
+    np.testing.assert_allclose(u, u_act, atol=1e-6)
+    np.testing.assert_allclose(v, v_act, atol=1e-6)
+    np.testing.assert_allclose(winds['residual'].values, reference['residual'].values,
+                               atol=1e-6)
+    np.testing.assert_allclose(winds['height'].values, reference['height'].values)
+
+
+def test_fit_recovers_u_v_w(ppi):
+    # ACT does not return w, so all three components are checked against
+    # the synthetic wind field
+    fit = vad.fit_ppi_winds(np.radians(ppi['elevation'].values),
+                            np.radians(ppi['azimuth'].values),
+                            ppi['radial_velocity'].values,
+                            ppi['intensity'].values - 1)
+    for name, truth in zip(['u', 'v', 'w'], WIND):
+        np.testing.assert_allclose(fit[name], truth, atol=0.1)
@@ -0,0 +1,66 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from wind_history import WindHistory
+
+HEIGHTS = np.array([100., 200.])
+START = datetime.datetime(2024, 1, 1, 12)
+
+
+def _profiles(history, speeds):
+    # One profile a minute, blowing from the north
+    for minute, speed in enumerate(speeds):
+        history.append_profile(START + datetime.timedelta(minutes=minute), HEIGHTS,
+                               np.full(2, speed), np.zeros(2))
+
+
+def test_window_ends_at_the_cycle_time():
+    history = WindHistory()
+    _profiles(history, np.arange(21.))
+    heights, speed, direction = history.mean_profile(
+        5, now=START + datetime.timedelta(minutes=20))
+    np.testing.assert_allclose(speed, np.mean(np.arange(15., 21.)))
+    np.testing.assert_allclose(np.mod(direction + 180., 360.) - 180., 0., atol=1e-9)
+    # Profiles after the cycle time are left out
+    heights, speed, direction = history.mean_profile(
+        2, now=START + datetime.timedelta(minutes=10))
+    np.testing.assert_allclose(speed, np.mean([8., 9., 10.]))
+
+
+def test_stale_history_gives_no_profile():
+    history = WindHistory()
+    _profiles(history, np.arange(21.))
+    later = START + datetime.timedelta(hours=2)
+    assert history.mean_profile(30, now=later) is None
+    assert history.mean_profile(30) is None
+
+
+def test_radial_velocity_window():
+    history = WindHistory()
+    ranges = np.array([30., 60., 90.])
+    rng = np.random.default_rng(0)
+    blocks = [rng.normal(size=(10, 3)) for _ in range(3)]
+    for i, block in enumerate(blocks):
+        times = np.datetime64(START) + np.timedelta64(i * 60, 's') + \
+            np.arange(10) * np.timedelta64(1, 's')
+        history.update_radial_velocity(times, ranges, block)
+    now = START + datetime.timedelta(minutes=2, seconds=30)
+    r, count, mean, variance = history.radial_velocity_stats(1.5, now=now)
+    recent = np.concatenate(blocks[1:])
+    np.testing.assert_array_equal(count, 20)
+    np.testing.assert_allclose(mean, recent.mean(axis=0))
+    np.testing.assert_allclose(variance, recent.var(axis=0))
+    assert history.radial_velocity_stats(10, now=now + datetime.timedelta(hours=1)) is None
+
+
+def test_save_and_load(tmp_path):
+    history = WindHistory(capacity=30)
+    _profiles(history, np.arange(5.))
+    file_path = str(tmp_path / 'history.npz')
+    history.save(file_path)
+    loaded = WindHistory.load(file_path, capacity=30)
+    now = START + datetime.timedelta(minutes=4)
+    for a, b in zip(history.mean_profile(10, now=now), loaded.mean_profile(10, now=now)):
+        np.testing.assert_allclose(a, b)
@@ -1,20 +1,359 @@
 import numpy as np
-import act
-import glob
-import utils
-import os
-import argparse
+import itertools
+import collections
 import pandas as pd
 import xarray as xr
 
 from datetime import datetime, timedelta
-from scipy.stats import mode
+from sweeps import segment_sweeps
 
 def convert_to_hours_minutes_seconds(decimal_hour, initial_time):
     delta = timedelta(hours=decimal_hour)
     return datetime(initial_time.year, initial_time.month, initial_time.day) + delta
 
+
+def _start_hour(start_time):
+    # The hours since midnight of the file's start time
+    start_time = pd.Timestamp(start_time)
+    return (start_time - start_time.normalize()) / pd.Timedelta(hours=1)
+
+
+def unwrap_hours(decimal_time, start_hour):
+    """
+    Returns the hours of the rays since midnight of the day the file started.
+
+    The lidar's decimal time goes back to 0 at midnight, so in a file that
+    spans midnight the rays after it appear to be the earliest. Every step
+    back of more than 12 hours from the previous ray, starting from the
+    file's start hour, is taken as a new day.
+
+    Parameters
+    ----------
+    decimal_time: float array
+        The decimal time of the rays [hours].
+    start_hour: float
+        The start time of the file [hours since midnight].
+    """
+    hours = np.mod(np.asarray(decimal_time, dtype=float), 24.)
+    previous = np.concatenate([[np.mod(start_hour, 24.)], hours])[:-1]
+    return hours + 24. * np.cumsum(hours - previous < -12.)
+
+
+def decimal_time_to_datetime64(decimal_time, start_time):
+    """
+    Converts the decimal times of the rays to datetime64[ns], correcting
+    for files that span midnight (see :func:`unwrap_hours`).
+
+    Equivalent to :func:`convert_to_hours_minutes_seconds` for each ray,
+    to the microsecond, but in one array operation.
+
+    Parameters
+    ----------
+    decimal_time: float array
+        The decimal time of the rays [hours].
+    start_time: datetime
+        The start time of the file from its header.
+    """
+    day = pd.Timestamp(start_time).normalize().to_datetime64().astype('datetime64[ns]')
+    hours = unwrap_hours(decimal_time, _start_hour(start_time))
+    return day + np.round(hours * 3.6e9).astype('int64').astype('timedelta64[us]')
+
+HEADER_N = 17
+
+
+def _parse_hpl_header(lines):
+    """
+    Parses the 17-line header of a Halo Photonics .hpl file.
+
+    Parameters
+    ----------
+    lines: list of str
+        The header lines of the file.
+
+    Returns
+    -------
+    data_temp: dict
+        The header fields in the same layout as :func:`hpl2dict`.
+    """
+    data_temp = dict()
+    data_temp['filename'] = lines[0].split()[-1]
+    data_temp['system_id'] = int(lines[1].split()[-1])
+    data_temp['number_of_gates'] = int(lines[2].split()[-1])
+    data_temp['range_gate_length_m'] = float(lines[3].split()[-1])
+    data_temp['gate_length_pts'] = int(lines[4].split()[-1])
+    data_temp['pulses_per_ray'] = int(lines[5].split()[-1])
+    data_temp['number_of_waypoints_in_file'] = int(lines[6].split()[-1])
+    data_temp['scan_type'] = ' '.join(lines[7].split()[2:])
+    data_temp['focus_range'] = lines[8].split()[-1]
+    data_temp['start_time'] = pd.to_datetime(' '.join(lines[9].split()[-2:]))
+    data_temp['resolution'] = ('%s %s' % (lines[10].split()[-1], 'm s-1'))
+    data_temp['range_gates'] = np.arange(0, data_temp['number_of_gates'])
+    data_temp['center_of_gates'] = (data_temp['range_gates'] + 0.5) * data_temp['range_gate_length_m']
+    return data_temp
+
+
+def _parse_ray_block(text, rays_n, gates_n):
+    """
+    Parses complete ray records of a .hpl file in bulk.
+
+    Every ray is one header line (decimal time, azimuth, elevation, pitch, roll)
+    followed by one line per range gate with 4 or 5 columns (gate, Doppler,
+    intensity, beta and optionally spectral width). Since every ray has the
+    same number of values the whole block is read with one np.fromstring call
+    into an array of exactly the right size and reshaped.
+
+    Parameters
+    ----------
+    text: bytes
+        The data section of the file, containing exactly rays_n rays.
+    rays_n: int
+        The number of rays in text.
+    gates_n: int
+        The number of range gates per ray.
+
+    Returns
+    -------
+    ray_vals: float 2D array
+        The [rays, 5] ray header values.
+    gate_vals: float 3D array
+        The [rays, gates, columns] gate values.
+    """
+    if rays_n == 0:
+        return np.empty((0, 5)), np.empty((0, gates_n, 4))
+    # The first gate line gives the number of columns, so the total number
+    # of values is known and fromstring does not have to grow its buffer
+    n_cols = len(text.lstrip().split(b'\n', 2)[1].split()) if gates_n > 0 else 4
+    if n_cols not in (4, 5):
+        raise ValueError('Range gate lines must have 4 or 5 columns.')
+    n_values = rays_n * (5 + gates_n * n_cols)
+    values = np.fromstring(text, sep=' ', count=n_values)
+    if values.size != n_values:
+        raise ValueError('Range gate lines must have 4 or 5 columns.')
+    values = values.reshape(rays_n, 5 + gates_n * n_cols)
+    return values[:, :5], values[:, 5:].reshape(rays_n, gates_n, n_cols)
+
+
 def hpl2dict(file_path):
+    """
+    Reads a Halo Photonics .hpl file into a dictionary.
+
+    The ray headers and range gate blocks are parsed in bulk rather than
+    line by line.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the .hpl file.
+
+    Returns
+    -------
+    data_temp: dict
+        The header fields, the per-ray azimuth, elevation, pitch, roll and
+        decimal_time and the [gates, rays] radial_velocity, intensity, beta
+        and spectral_width. Returns NaN if the number of lines does not match
+        the expected format.
+    """
+    # Binary mode avoids holding decoded and newline-translated copies of
+    # the whole file alongside the raw bytes
+    with open(file_path, 'rb') as hpl_file:
+        data_temp = read_hpl_header(hpl_file)
+        body = hpl_file.read()
+
+    gates_n = data_temp['number_of_gates']
+    lines_n = body.count(b'\n') + (len(body) > 0 and not body.endswith(b'\n'))
+    rays_n = lines_n / (gates_n + 1)
+
+    '''
+    number of lines does not match expected format if the number of range gates
+    was changed in the measuring period of the data file (especially possible for stare data)
+    '''
+    if not rays_n.is_integer():
+        print('Number of lines does not match expected format')
+        return np.nan
+
+    rays_n = int(rays_n)
+    data_temp['no_of_rays_in_file'] = rays_n
+    ray_vals, gate_vals = _parse_ray_block(body, rays_n, gates_n)
+    data_temp['decimal_time'] = ray_vals[:, 0] #hours
+    data_temp['azimuth'] = ray_vals[:, 1] #degrees
+    data_temp['elevation'] = ray_vals[:, 2] #degrees
+    data_temp['pitch'] = ray_vals[:, 3] #degrees
+    data_temp['roll'] = ray_vals[:, 4] #degrees
+    data_temp['radial_velocity'] = gate_vals[:, :, 1].T #m s-1
+    data_temp['intensity'] = gate_vals[:, :, 2].T #SNR+1
+    data_temp['beta'] = gate_vals[:, :, 3].T #m-1 sr-1
+    if gate_vals.shape[2] > 4:
+        data_temp['spectral_width'] = gate_vals[:, :, 4].T
+    else:
+        data_temp['spectral_width'] = np.broadcast_to(np.nan, (gates_n, rays_n))
+    return data_temp
+
+
+def read_hpl_header(file_obj):
+    """
+    Reads the header of an open .hpl file.
+
+    Parameters
+    ----------
+    file_obj: file
+        The .hpl file opened in binary mode, positioned at the start.
+
+    Returns
+    -------
+    header: dict
+        The header fields in the same layout as :func:`hpl2dict`.
+    """
+    lines = [file_obj.readline().decode('latin-1') for i in range(HEADER_N)]
+    return _parse_hpl_header(lines)
+
+
+def iter_hpl_chunks(file_path, chunk_size=500, offset=None):
+    """
+    Iterates over the rays of a .hpl file in fixed-size chunks.
+
+    Only one chunk of the file is held in memory at a time. A trailing ray
+    that is still being written by the lidar, including one whose last line
+    is not terminated yet, is not returned, and the offset of the last chunk
+    is left at its start.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the .hpl file.
+    chunk_size: int
+        The number of rays per chunk.
+    offset: int or None
+        Byte offset of the first ray to read. This must be the start of a ray,
+        for example the 'offset' of a previously returned chunk. Set to None
+        to start at the first ray.
+
+    Yields
+    ------
+    chunk: dict
+        The [rays] decimal_time, azimuth, elevation, pitch and roll and the
+        [rays, gates] radial_velocity, intensity, beta and spectral_width of
+        the chunk. 'header' holds the file header and 'offset' the byte offset
+        just past the last ray of the chunk.
+    """
+    with open(file_path, 'rb') as hpl_file:
+        header = read_hpl_header(hpl_file)
+        gates_n = header['number_of_gates']
+        if offset is not None:
+            hpl_file.seek(offset)
+        offset = hpl_file.tell()
+        while True:
+            lines = list(itertools.islice(hpl_file, chunk_size * (gates_n + 1)))
+            if lines and not lines[-1].endswith(b'\n'):
+                # The lidar is still writing the last line
+                lines.pop()
+            rays_n = len(lines) // (gates_n + 1)
+            if rays_n == 0:
+                return
+            lines = lines[:rays_n * (gates_n + 1)]
+            offset += sum(len(line) for line in lines)
+            ray_vals, gate_vals = _parse_ray_block(b''.join(lines), rays_n, gates_n)
+            chunk = {'header': header, 'offset': offset,
+                     'decimal_time': ray_vals[:, 0].copy(),
+                     'azimuth': ray_vals[:, 1].copy(),
+                     'elevation': ray_vals[:, 2].copy(),
+                     'pitch': ray_vals[:, 3].copy(),
+                     'roll': ray_vals[:, 4].copy()}
+            for i, name in enumerate(['radial_velocity', 'intensity', 'beta', 'spectral_width']):
+                if i + 1 < gate_vals.shape[2]:
+                    chunk[name] = np.ascontiguousarray(gate_vals[:, :, i + 1])
+                else:
+                    chunk[name] = np.full((rays_n, gates_n), np.nan)
+            yield chunk
+            if len(lines) < chunk_size * (gates_n + 1):
+                return
+
+
+def read_hpl(file_path, last_n_rays=None, start_time=None, chunk_size=500):
+    """
+    Reads a subset of the rays in a .hpl file by streaming it in chunks.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the .hpl file.
+    last_n_rays: int or None
+        Only keep the last last_n_rays rays of the file.
+    start_time: datetime or None
+        Only keep the rays at or after this time.
+    chunk_size: int
+        The number of rays parsed at a time.
+
+    Returns
+    -------
+    data_temp: dict
+        The selected rays in the same layout as :func:`hpl2dict`.
+    """
+    chunks = collections.deque()
+    n_kept = 0
+    header = None
+    for chunk in iter_hpl_chunks(file_path, chunk_size=chunk_size):
+        header = chunk.pop('header')
+        chunk.pop('offset')
+        if start_time is not None:
+            day = pd.Timestamp(header['start_time']).normalize()
+            min_hour = (pd.Timestamp(start_time) - day) / pd.Timedelta(hours=1)
+            hours = unwrap_hours(chunk['decimal_time'], _start_hour(header['start_time']))
+            keep = hours >= min_hour
+            if not np.any(keep):
+                continue
+            chunk = {name: value[keep] for name, value in chunk.items()}
+        chunks.append(chunk)
+        n_kept += chunk['decimal_time'].size
+        if last_n_rays is not None:
+            while n_kept - chunks[0]['decimal_time'].size >= last_n_rays:
+                n_kept -= chunks.popleft()['decimal_time'].size
+
+    if header is None:
+        with open(file_path, 'rb') as hpl_file:
+            header = read_hpl_header(hpl_file)
+    gates_n = header['number_of_gates']
+    data_temp = dict(header)
+    for name in ['decimal_time', 'azimuth', 'elevation', 'pitch', 'roll']:
+        data_temp[name] = np.concatenate([np.empty(0)] + [chunk[name] for chunk in chunks])
+    for name in ['radial_velocity', 'intensity', 'beta', 'spectral_width']:
+        data_temp[name] = np.concatenate(
+            [np.empty((0, gates_n))] + [chunk[name] for chunk in chunks]).T
+    return _select_rays(data_temp, last_n_rays=last_n_rays)
+
+
+def _select_rays(data_temp, last_n_rays=None, start_time=None):
+    """
+    Selects the last N rays and/or the rays after a given time from a
+    dictionary in the :func:`hpl2dict` layout.
+    """
+    keep = np.ones(data_temp['decimal_time'].size, dtype=bool)
+    if start_time is not None:
+        day = pd.Timestamp(data_temp['start_time']).normalize()
+        min_hour = (pd.Timestamp(start_time) - day) / pd.Timedelta(hours=1)
+        keep &= unwrap_hours(data_temp['decimal_time'],
+                             _start_hour(data_temp['start_time'])) >= min_hour
+    if last_n_rays is not None:
+        keep[:max(keep.size - last_n_rays, 0)] = False
+    if not np.all(keep):
+        # A trailing run of rays is selected with a slice so that the
+        # result stays a view, e.g. of a memory-mapped sidecar
+        first = np.argmax(keep) if np.any(keep) else keep.size
+        if np.all(keep[first:]):
+            keep = slice(first, None)
+        data_temp = dict(data_temp)
+        for name in ['decimal_time', 'azimuth', 'elevation', 'pitch', 'roll']:
+            data_temp[name] = data_temp[name][keep]
+        for name in ['radial_velocity', 'intensity', 'beta', 'spectral_width']:
+            data_temp[name] = data_temp[name][:, keep]
+    data_temp['no_of_rays_in_file'] = data_temp['decimal_time'].size
+    return data_temp
+
+
+def hpl2dict_loop(file_path):
+    """
+    Reference implementation of :func:`hpl2dict` that parses every range gate
+    line separately. Kept for benchmarking and validating the bulk parser.
+    """
     #import hpl files into intercal storage
     with open(file_path, 'r') as text_file:
         lines=text_file.readlines()
@@ -82,59 +421,50 @@ def hpl2dict(file_path):
     return data_temp
 
 
-def read_as_netcdf(file, lat, lon, alt):
-    field_dict = hpl2dict(file)
-    initial_time = pd.to_datetime(field_dict['start_time'])
-
-    time = pd.to_datetime([convert_to_hours_minutes_seconds(x, initial_time) for x in field_dict['decimal_time']])
+def read_as_netcdf(file, lat, lon, alt, last_n_rays=None, start_time=None, cache=None,
+                   reflectivity=True):
+    if cache is not None:
+        field_dict = _select_rays(cache.load(file), last_n_rays=last_n_rays,
+                                  start_time=start_time)
+    elif last_n_rays is None and start_time is None:
+        field_dict = hpl2dict(file)
+    else:
+        field_dict = read_hpl(file, last_n_rays=last_n_rays, start_time=start_time)
+    time = decimal_time_to_datetime64(field_dict['decimal_time'], field_dict['start_time'])
+    azimuth = np.array(field_dict['azimuth'])
+    azimuth[azimuth >= 360.0] -= 360.0
+    elevation = np.array(field_dict['elevation'])
+    sweeps = segment_sweeps(azimuth, elevation)
+    # Rays moving between sweeps are masked by index as each moment is
+    # copied once into a float32 (time, range) array
+    transitions = np.flatnonzero(sweeps['ray_sweep'] < 0)
+    moments = {}
+    for field in ['radial_velocity', 'beta', 'intensity', 'spectral_width']:
+        moments[field] = np.ascontiguousarray(field_dict[field].T, dtype=np.float32)
+        moments[field][transitions] = np.nan
+    center_of_gates = field_dict['center_of_gates']
+    # Nothing refers to the float64 parse buffer any more
+    del field_dict
 
-    ds = xr.Dataset(coords={'range':field_dict['center_of_gates'],
+    ds = xr.Dataset(coords={'range': center_of_gates,
                             'time': time,
-                            'azimuth': ('time', field_dict['azimuth']),
-                            'elevation': ('time', field_dict['elevation'])} ,
-                    data_vars={'radial_velocity':(['time', 'range'],
-                                                  field_dict['radial_velocity'].T),
-                               'beta': (('time', 'range'), 
-                                        field_dict['beta'].T),
-                               'intensity': (('time', 'range'),
-                                             field_dict['intensity'].T),
-                               'spectral_width': (('time', 'range'),
-                                             field_dict['spectral_width'].T)
-                              }
-                   )
-    # Fake field for PYDDA
-    ds['reflectivity'] = -99 * xr.ones_like(ds['beta'])
-    ds['azimuth'] = xr.where(ds['azimuth'] >= 360.0, ds['azimuth'] - 360.0, ds['azimuth'])
-    diff_azimuth = ds['azimuth'].diff(dim='time').values
-    diff_elevation = ds['elevation'].diff(dim='time').values
-    unique_elevations = np.unique(ds["elevation"].values)
-    if len(ds['time'].values) == 6 or mode(ds["elevation"].values) == 60.0:
-        unique_elevations = np.array([60])
-    counts = np.zeros_like(unique_elevations)
-    print(ds['elevation'])
-    for i in range(len(unique_elevations)):
-        counts[i] = np.sum(ds["elevation"].values == unique_elevations[i])
-    
-    if np.sum(np.abs(diff_azimuth) > 0.02) <= 2  and not np.all(ds['elevation'] == 90.0):
-        sweep_mode = 'rhi'
-        n_sweeps = 1
-    elif np.all(ds['elevation'] == 90.0) or np.all(np.isclose(ds['elevation'], 60.0)):
-        sweep_mode = 'vertical_pointing'
-        n_sweeps = 1
-    else:
-        # We will filter out the transitions between sweeps
-        diff_elevation = xr.DataArray(np.pad(np.abs(diff_elevation), (1, 0), constant_values=(0, 0)), dims='time')
-        sweep_mode = "azimuth_surveillance"
-        ds = ds.where(diff_elevation < 0.01)
-    ds['sweep_mode'] = xr.DataArray(np.array([sweep_mode.lower()], dtype='S32'), dims=['string_length_32'])
-    ds['azimuth'] = xr.where(ds['azimuth'] < 360., ds['azimuth'], ds['azimuth'] - 360.)
-    
-    if sweep_mode == 'rhi':
-        ds['fixed_angle'] = ('sweep', np.unique(ds['azimuth'].data[np.argwhere(np.abs(diff_azimuth) < 0.01) + 1]))
-    elif sweep_mode == "azimuth_surveillance" or sweep_mode == "vertical_pointing":
-        ds['fixed_angle'] = ('sweep', np.unique(ds['elevation'].data))
-        n_sweeps = len(np.unique(ds['elevation'].data))
-    ds['sweep_number'] = ('sweep', np.arange(0, n_sweeps))
+                            'azimuth': ('time', azimuth),
+                            'elevation': ('time', elevation)},
+                    data_vars={field: (('time', 'range'), moments[field]) for field in moments})
+    if reflectivity:
+        # Fake field for PYDDA, a read-only view of a single value
+        ds['reflectivity'] = (('time', 'range'),
+                              np.broadcast_to(np.float32(-99.), moments['beta'].shape))
+    ds['sweep_mode'] = ('sweep', sweeps['sweep_mode'].astype('S32'))
+    ds['sweep_mode'].attrs["long_name"] = "scan_mode_for_sweep"
+    ds['fixed_angle'] = ('sweep', sweeps['fixed_angle'])
+    ds['fixed_angle'].attrs["long_name"] = "ray_target_fixed_angle"
+    ds['fixed_angle'].attrs["units"] = "degrees"
+    ds['sweep_start_ray_index'] = ('sweep', sweeps['sweep_start_ray_index'])
+    ds['sweep_start_ray_index'].attrs["long_name"] = "index_of_first_ray_in_sweep"
+    ds['sweep_end_ray_index'] = ('sweep', sweeps['sweep_end_ray_index'])
+    ds['sweep_end_ray_index'].attrs["long_name"] = "index_of_last_ray_in_sweep"
+    ds['sweep_number'] = ('sweep', sweeps['sweep_number'])
     ds['sweep_number'].attrs["long_name"] = "sweep_index_number_0_based"
     ds['sweep_number'].attrs["units"] = ""
     ds['sweep_number'].attrs["_FillValue"] = -9999
@@ -150,21 +480,6 @@ def read_as_netcdf(file, lat, lon, alt):
     ds["altitude"].attrs["long_name"] = alt
     ds["altitude"].attrs["units"] = "meters"
     ds["altitude"].attrs["_FillValue"] = -9999.
-    num_rays = ds.dims['time']
-    diff_elevation = ds["elevation"].diff(dim='time').values
-    transitions = np.argwhere(np.abs(diff_elevation) > 0.01)
-    
-    end_indicies = [0]
-    last_ind = 0
-    for i, t in enumerate(transitions):
-        if t - last_ind < 2:
-            print(t)
-        else:
-            end_indicies.append(t[0])
-            last_ind = t
-    end_indicies.append(num_rays - 1)
-    end_indicies = np.array(end_indicies)
-    
     ds.attrs["Conventions"] = "CF-1.7"
     return ds
 
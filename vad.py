@@ -0,0 +1,193 @@
+"""
+Batched velocity-azimuth display (VAD) wind retrieval.
+
+This is a drop-in replacement for act.retrievals.compute_winds_from_ppi
+that fits every range gate of a PPI scan in one set of linear-algebra calls
+instead of looping gate by gate. It follows the same least-squares method
+(Newsom et al. 2016) and returns the same variables.
+"""
+import warnings
+
+import numpy as np
+import xarray as xr
+
+WIND_ATTRS = {
+    'wind_speed': {'long_name': 'Wind speed', 'units': 'm/s'},
+    'wind_direction': {'long_name': 'Wind direction', 'units': 'degree'},
+    'wind_speed_error': {'long_name': 'Wind speed error', 'units': 'm/s'},
+    'wind_direction_error': {'long_name': 'Wind direction error', 'units': 'degree'},
+    'signal_to_noise_ratio': {'long_name': 'Signal to noise ratio mean over PPI scan', 'units': '1'},
+    'residual': {'long_name': 'Residual values (Square Root of Chi Square)', 'units': 'm/s'},
+    'correlation': {'long_name': 'Correlation coefficient', 'units': '1'},
+}
+
+
+def _scan_slices(azimuth):
+    # Split the rays into PPI scans the same way ACT does: a new scan starts
+    # every time the azimuth returns to the first azimuth of the file.
+    azimuth_rounded = np.round(azimuth).astype(int)
+    index = np.flatnonzero(azimuth_rounded == azimuth_rounded[0])
+    if index.size == 1:
+        num_scans = azimuth.size
+    else:
+        num_scans = index[1] - index[0]
+    return [slice(start, min(start + num_scans, azimuth.size)) for start in index]
+
+
+def fit_ppi_winds(elevation, azimuth, doppler, snr, snr_threshold=0.008,
+                  condition_limit=1.0e4):
+    """
+    Fits the wind vector at every range gate of one PPI scan.
+
+    Parameters
+    ----------
+    elevation, azimuth: float 1D array
+        The [rays] elevation and azimuth angles [radians].
+    doppler: float 2D array
+        The [rays, gates] radial velocity.
+    snr: float 2D array
+        The [rays, gates] signal to noise ratio.
+    snr_threshold: float
+        Gates with a lower signal to noise ratio are not used.
+    condition_limit: float
+        Gates whose normal matrix has a larger condition number are not fit.
+
+    Returns
+    -------
+    fit: dict
+        The [gates] u, v, w wind components, their errors, the residual,
+        chi square and the correlation between fitted and observed radial
+        velocities. Gates that could not be fit are NaN.
+    """
+    # Unit vectors along each ray, [rays, 3]
+    xyz = np.stack([np.sin(azimuth) * np.cos(elevation),
+                    np.cos(azimuth) * np.cos(elevation),
+                    np.sin(elevation)], axis=1)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=RuntimeWarning)
+        mask = (snr >= snr_threshold) & np.isfinite(doppler)
+    weight = mask.astype(float)
+    ur = np.where(mask, doppler, 0.)
+    count = mask.sum(axis=0)
+
+    # Normal equations for every gate at once, [gates, 3, 3] and [gates, 3]
+    a = np.einsum('ri,rj,rg->gij', xyz, xyz, weight)
+    b = np.einsum('ri,rg->gi', xyz, ur)
+
+    n_gates = doppler.shape[1]
+    fit = {name: np.full(n_gates, np.nan) for name in
+           ['u', 'v', 'w', 'u_err', 'v_err', 'w_err', 'residual', 'chisq', 'corr']}
+    valid = count >= 4
+    if np.any(valid):
+        valid[valid] = np.linalg.matrix_rank(a[valid]) == 3
+    if not np.any(valid):
+        return fit
+    ainv = np.linalg.inv(a[valid])
+    condition = np.linalg.norm(a[valid], axis=(1, 2)) * np.linalg.norm(ainv, axis=(1, 2))
+    valid[valid] = condition < condition_limit
+    ainv = ainv[condition < condition_limit]
+    if not np.any(valid):
+        return fit
+
+    coef = np.einsum('gi,gij->gj', b[valid], ainv)
+    w_mask = weight[:, valid]
+    n = count[valid]
+    ur_fit = (xyz @ coef.T) * w_mask
+    ur_obs = ur[:, valid]
+    chisq = np.sum((ur_fit - ur_obs) ** 2, axis=0)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=RuntimeWarning)
+        fit_anom = (ur_fit - np.sum(ur_fit, axis=0) / n) * w_mask
+        obs_anom = (ur_obs - np.sum(ur_obs, axis=0) / n) * w_mask
+        corr = np.sum(fit_anom * obs_anom, axis=0) / np.sqrt(
+            np.sum(fit_anom ** 2, axis=0) * np.sum(obs_anom ** 2, axis=0))
+        fit['u_err'][valid] = np.sqrt((chisq / (n - 3)) * ainv[:, 0, 0])
+        fit['v_err'][valid] = np.sqrt((chisq / (n - 3)) * ainv[:, 1, 1])
+        fit['w_err'][valid] = np.sqrt((chisq / (n - 3)) * ainv[:, 2, 2])
+    fit['u'][valid] = coef[:, 0]
+    fit['v'][valid] = coef[:, 1]
+    fit['w'][valid] = coef[:, 2]
+    fit['chisq'][valid] = chisq
+    fit['residual'][valid] = np.sqrt(chisq / n)
+    fit['corr'][valid] = corr
+    return fit
+
+
+def compute_winds_from_ppi(ds, elevation_name='elevation', azimuth_name='azimuth',
+                           radial_velocity_name='radial_velocity',
+                           intensity_name='intensity', snr_threshold=0.008,
+                           condition_limit=1.0e4):
+    """
+    Converts Doppler lidar PPI scans into profiles of horizontal wind speed
+    and direction.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        The dataset containing the PPI scans, with (time, range) moments.
+    elevation_name, azimuth_name, radial_velocity_name: str
+        The names of the elevation, azimuth and radial velocity variables.
+    intensity_name: str
+        The name of the intensity (SNR + 1) variable.
+    snr_threshold: float
+        Gates with a lower signal to noise ratio are not used.
+    condition_limit: float
+        Gates whose normal matrix has a larger condition number are not fit.
+
+    Returns
+    -------
+    winds: xarray.Dataset or None
+        The (time, height) wind_speed, wind_direction and their errors,
+        signal_to_noise_ratio, residual and correlation, with one time step
+        per PPI scan, the same as act.retrievals.compute_winds_from_ppi.
+        Returns None if the dataset has no rays.
+    """
+    azimuth = ds[azimuth_name].values
+    if azimuth.size == 0:
+        return None
+    elevation = np.radians(ds[elevation_name].values)
+    doppler = ds[radial_velocity_name].transpose('time', ...).values
+    snr = ds[intensity_name].transpose('time', ...).values - 1
+    rng = ds['range'].values
+    height_units = ds['range'].attrs.get('units', 'm' if rng[0] > 0 else 'km')
+    times = ds['time'].values
+
+    scan_times = []
+    heights = []
+    fields = {name: [] for name in WIND_ATTRS}
+    for sl in _scan_slices(azimuth):
+        fit = fit_ppi_winds(elevation[sl], np.radians(azimuth[sl]), doppler[sl], snr[sl],
+                            snr_threshold=snr_threshold, condition_limit=condition_limit)
+        u, v = fit['u'], fit['v']
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=RuntimeWarning)
+            wspd = np.sqrt(u ** 2 + v ** 2)
+            fields['wind_speed'].append(wspd)
+            fields['wind_direction'].append(np.degrees(np.arctan2(u, v) + np.pi))
+            fields['wind_speed_error'].append(
+                np.sqrt((u * fit['u_err']) ** 2 + (v * fit['v_err']) ** 2) / wspd)
+            fields['wind_direction_error'].append(
+                np.degrees(np.sqrt((u * fit['v_err']) ** 2 + (v * fit['u_err']) ** 2) / wspd ** 2))
+            fields['signal_to_noise_ratio'].append(np.nanmean(snr[sl], axis=0))
+        fields['residual'].append(fit['residual'])
+        fields['correlation'].append(fit['corr'])
+        scan_times.append(times[sl][0] + (times[sl][-1] - times[sl][0]) / 2)
+        heights.append(rng * np.median(np.sin(elevation[sl])))
+
+    if all(np.array_equal(height, heights[0]) for height in heights):
+        return _winds_dataset(scan_times, heights[0], height_units,
+                              {name: np.stack(value) for name, value in fields.items()})
+    # Scans at different elevations have different heights, so align them
+    return xr.concat([_winds_dataset(scan_times[i:i + 1], heights[i], height_units,
+                                     {name: value[i][np.newaxis] for name, value in fields.items()})
+                      for i in range(len(scan_times))], 'time')
+
+
+def _winds_dataset(scan_times, height, height_units, fields):
+    return xr.Dataset(
+        {name: (('time', 'height'), fields[name], attrs) for name, attrs in WIND_ATTRS.items()},
+        {
+            'time': ('time', np.array(scan_times), {'long_name': 'Time in UTC'}),
+            'height': ('height', height,
+                       {'long_name': 'Height to center of bin', 'units': height_units}),
+        })
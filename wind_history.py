@@ -0,0 +1,236 @@
+"""
+Rolling history of wind profiles and radial velocity statistics.
+
+Keeps the recent VAD profiles and per-range-gate radial velocity statistics
+in fixed-size ring buffers so that trigger decisions can use smoothed windows
+(e.g. the last 10 or 30 minutes) without re-reading old .hpl files. The
+radial velocity statistics of each batch of new rays are reduced to a count,
+mean and sum of squared deviations (Welford), and batches are merged with
+the parallel form of the same update when a window is queried.
+"""
+import datetime
+import os
+
+import numpy as np
+
+
+class _Ring(object):
+    # Fixed-capacity ring buffer of timestamped arrays
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.full(capacity, np.datetime64('NaT', 'ns'))
+        self.data = {}
+        self.next = 0
+
+    def append(self, time, **arrays):
+        if not self.data:
+            for name, value in arrays.items():
+                self.data[name] = np.full((self.capacity,) + np.shape(value), np.nan)
+        self.times[self.next] = np.datetime64(time, 'ns')
+        for name, value in arrays.items():
+            self.data[name][self.next] = value
+        self.next = (self.next + 1) % self.capacity
+
+    def clear(self):
+        self.times[:] = np.datetime64('NaT', 'ns')
+        self.data = {}
+        self.next = 0
+
+    def window(self, start, end):
+        keep = (self.times >= np.datetime64(start, 'ns')) & (self.times <= np.datetime64(end, 'ns'))
+        return {name: value[keep] for name, value in self.data.items()}
+
+    def latest_time(self):
+        if np.all(np.isnat(self.times)):
+            return None
+        return self.times[~np.isnat(self.times)].max()
+
+
+def block_stats(values):
+    """
+    Reduces a [samples, gates] block to its per-gate count, mean and sum of
+    squared deviations from the mean, ignoring NaNs.
+    """
+    valid = np.isfinite(values)
+    count = valid.sum(axis=0)
+    total = np.where(valid, values, 0.).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    m2 = np.where(valid, (values - mean) ** 2, 0.).sum(axis=0)
+    return count, np.where(count > 0, mean, 0.), m2
+
+
+def merge_stats(count, mean, m2):
+    """
+    Merges [blocks, gates] counts, means and sums of squared deviations into
+    the per-gate statistics of all blocks combined.
+    """
+    total = count.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged_mean = (count * mean).sum(axis=0) / total
+        merged_m2 = m2.sum(axis=0) + (count * (mean - merged_mean) ** 2).sum(axis=0)
+    return total, merged_mean, merged_m2
+
+
+class WindHistory(object):
+    """
+    Ring buffers of recent VAD profiles and radial velocity statistics.
+
+    Parameters
+    ----------
+    capacity: int
+        The number of profiles and of radial velocity batches kept.
+    """
+    def __init__(self, capacity=720):
+        self.capacity = capacity
+        self.profiles = _Ring(capacity)
+        self.velocity = _Ring(capacity)
+        self.heights = None
+        self.ranges = None
+
+    def append_profile(self, time, heights, wind_speed, wind_direction):
+        """
+        Adds a VAD wind profile.
+
+        Parameters
+        ----------
+        time: datetime64
+            The time of the profile.
+        heights: float 1D array
+            The heights of the profile.
+        wind_speed, wind_direction: float 1D array
+            The wind speed and direction at each height.
+        """
+        time = np.datetime64(time, 'ns')
+        latest = self.profiles.latest_time()
+        if latest is not None and time <= latest:
+            return
+        if self.heights is None or not np.array_equal(self.heights, heights):
+            if self.heights is not None:
+                print("Profile heights changed, resetting the wind history")
+            self.profiles.clear()
+            self.heights = np.asarray(heights, dtype=float)
+        # Stored as components so that windows are vector averages
+        direction = np.radians(wind_direction)
+        self.profiles.append(time, u=-wind_speed * np.sin(direction),
+                             v=-wind_speed * np.cos(direction))
+
+    def update_radial_velocity(self, times, ranges, radial_velocity):
+        """
+        Adds the statistics of the rays newer than any already seen.
+
+        Parameters
+        ----------
+        times: datetime64 1D array
+            The [rays] time of each ray.
+        ranges: float 1D array
+            The [gates] range of each gate.
+        radial_velocity: float 2D array
+            The [rays, gates] radial velocity, NaN where masked.
+        """
+        times = np.asarray(times, dtype='datetime64[ns]')
+        if self.ranges is None or not np.array_equal(self.ranges, ranges):
+            if self.ranges is not None:
+                print("Range gates changed, resetting the radial velocity history")
+            self.velocity.clear()
+            self.ranges = np.asarray(ranges, dtype=float)
+        latest = self.velocity.latest_time()
+        new = np.ones(times.size, dtype=bool) if latest is None else times > latest
+        if not np.any(new):
+            return
+        count, mean, m2 = block_stats(np.asarray(radial_velocity)[new])
+        self.velocity.append(times[new].max(), count=count, mean=mean, m2=m2)
+
+    def mean_profile(self, minutes, now=None):
+        """
+        Vector-averaged wind profile over the last minutes.
+
+        Parameters
+        ----------
+        minutes: float
+            The length of the window.
+        now: datetime or None
+            The end of the window, e.g. the time of the cycle. Defaults to the
+            current time.
+
+        Returns
+        -------
+        heights, wind_speed, wind_direction: float 1D array
+            The profile, or None if there are no profiles in the window.
+        """
+        window = self.profiles.window(*self._window(minutes, now))
+        if not window or window['u'].shape[0] == 0:
+            return None
+        with np.errstate(invalid='ignore'):
+            u = np.nanmean(window['u'], axis=0)
+            v = np.nanmean(window['v'], axis=0)
+        wind_speed = np.sqrt(u ** 2 + v ** 2)
+        wind_direction = np.mod(np.degrees(np.arctan2(u, v)) + 180., 360.)
+        return self.heights, wind_speed, wind_direction
+
+    def radial_velocity_stats(self, minutes, now=None, ddof=0):
+        """
+        Per-gate radial velocity statistics over the last minutes.
+
+        The variance is normalized by count - ddof, so the default matches
+        xarray's std. The window is the same as in :meth:`mean_profile`.
+
+        Returns
+        -------
+        ranges, count, mean, variance: 1D arrays
+            The statistics, or None if there are no rays in the window.
+        """
+        window = self.velocity.window(*self._window(minutes, now))
+        if not window or window['count'].shape[0] == 0:
+            return None
+        count, mean, m2 = merge_stats(window['count'], window['mean'], window['m2'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(count > ddof, m2 / (count - ddof), np.nan)
+        return self.ranges, count, mean, variance
+
+    def _window(self, minutes, now):
+        # Measured from the cycle's time rather than the newest sample, so
+        # that stale samples fall out of the window when the data stops
+        if now is None:
+            now = datetime.datetime.now()
+        end = np.datetime64(now, 'ns')
+        return end - np.timedelta64(int(minutes * 60e9), 'ns'), end
+
+    def save(self, file_path):
+        """Saves the history to a compressed .npz file."""
+        arrays = {}
+        for prefix, ring in [('profile', self.profiles), ('velocity', self.velocity)]:
+            arrays[prefix + '_times'] = ring.times
+            arrays[prefix + '_next'] = ring.next
+            for name, value in ring.data.items():
+                arrays['%s_%s' % (prefix, name)] = value
+        if self.heights is not None:
+            arrays['heights'] = self.heights
+        if self.ranges is not None:
+            arrays['ranges'] = self.ranges
+        tmp_name = file_path + '.tmp.npz'
+        np.savez_compressed(tmp_name, **arrays)
+        os.replace(tmp_name, file_path)
+
+    @classmethod
+    def load(cls, file_path, capacity=720):
+        """
+        Loads a history saved with :meth:`save`, or returns an empty one if
+        the file does not exist or was saved with a different capacity.
+        """
+        history = cls(capacity)
+        if not os.path.exists(file_path):
+            return history
+        with np.load(file_path) as saved:
+            if saved['profile_times'].size != capacity:
+                print("Ignoring wind history with a different capacity in %s" % file_path)
+                return history
+            history.heights = saved['heights'] if 'heights' in saved else None
+            history.ranges = saved['ranges'] if 'ranges' in saved else None
+            for prefix, ring in [('profile', history.profiles), ('velocity', history.velocity)]:
+                ring.times = saved[prefix + '_times']
+                ring.next = int(saved[prefix + '_next'])
+                for key in saved.files:
+                    if key.startswith(prefix + '_') and key not in (prefix + '_times', prefix + '_next'):
+                        ring.data[key[len(prefix) + 1:]] = saved[key]
+        return history